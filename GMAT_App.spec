@@ -1,7 +1,7 @@
 # -*- mode: python ; coding: utf-8 -*-
 from PyInstaller.utils.hooks import collect_all
 
-datas = [('app.py', '.'), ('ai_logic.py', '.'), ('db.py', '.'), ('study_guide.py', '.'), ('.env', '.'), ('.streamlit', '.streamlit')]
+datas = [('app.py', '.'), ('ai_logic.py', '.'), ('db.py', '.'), ('study_guide.py', '.'), ('exam_pool.py', '.'), ('rate_limiter.py', '.'), ('gemini_async.py', '.'), ('json_stream.py', '.'), ('schemas.py', '.'), ('llm_cache.py', '.'), ('prompts.py', '.'), ('model_router.py', '.'), ('write_behind.py', '.'), ('.env', '.'), ('.streamlit', '.streamlit')]
 binaries = []
 hiddenimports = ['streamlit', 'google.generativeai', 'psycopg2', 'dotenv']
 tmp_ret = collect_all('streamlit')
@@ -6,8 +6,17 @@ import re
 from difflib import SequenceMatcher
 from dotenv import load_dotenv
 import time
-from db import save_questions, get_cached_questions
-from concurrent.futures import ThreadPoolExecutor, as_completed
+from rate_limiter import get_limiter, RateLimitTimeout
+import llm_cache
+import model_router
+import write_behind
+from db import get_cached_questions_by_topics, claim_pooled_question_set, question_fingerprint, _get_int_config
+from concurrent.futures import FIRST_COMPLETED, wait
+import asyncio
+import gemini_async
+from json_stream import MalformedJSONError
+from schemas import QUESTION_FIELDS, QUESTION_GROUP_SCHEMA, QUESTION_SCHEMA, validate
+from prompts import PromptTemplate, truncate
 from functools import lru_cache
 
 # Load environment variables
@@ -129,21 +138,9 @@ def _align_correct_answer(options: list, correct_answer: str) -> str | None:
     return None
 
 
-def generate_question_variant(seed_question, max_attempts: int = 3):
-    """Tạo 1 biến thể câu hỏi (dùng cho hàm batch bên dưới) với retry khi JSON lỗi."""
-    model = _get_model()
-    if model is None:
-        print("❌ Model không được khởi tạo")
-        return None
-
-    topic = seed_question.get('topic', 'Kiến thức tổng hợp')
-    is_visual = topic.lower() in ['pattern recognition', 'letter pattern', 'logic puzzle', 'number pattern']
-    q_type = seed_question.get('type', 'general')
-
-    if q_type == 'data_sufficiency':
-        prompt = f"""
+_DS_VARIANT_PROMPT = PromptTemplate('variant_data_sufficiency', """
         Bạn là chuyên gia ra đề GMAT. Hãy tạo 1 biến thể MỚI cho câu hỏi dạng Data Sufficiency sau:
-        Câu gốc: "{seed_question['content']}"
+        Câu gốc: "{content}"
         
         Nhiệm vụ:
         1. Giữ nguyên cấu trúc câu hỏi (Câu hỏi chính + 2 Dữ kiện).
@@ -152,18 +149,18 @@ def generate_question_variant(seed_question, max_attempts: int = 3):
         
         Output JSON:
         {{
-            "question": "Câu hỏi chính...\n(1) Dữ kiện 1...\n(2) Dữ kiện 2...",
+            "question": "Câu hỏi chính...\\n(1) Dữ kiện 1...\\n(2) Dữ kiện 2...",
             "options": ["A. Chỉ (1) là đủ...", "B. Chỉ (2) là đủ...", "C. Cả (1) và (2) mới đủ", "D. Mỗi dữ kiện riêng lẻ đủ", "E. Cả hai dữ kiện đều không đủ"],
             "correct_answer": "Chọn đúng option tương ứng logic mới",
             "step_by_step_thinking": "Phân tích dữ kiện 1... Phân tích dữ kiện 2... Kết hợp...",
             "explanation": "Giải thích ngắn gọn."
         }}
-        """
-    else:
-        prompt = f"""
+        """)
+
+_VARIANT_PROMPT = PromptTemplate('variant', """
         Bạn là chuyên gia ra đề thi GMAT cao cấp.
         Chủ đề: {topic}
-        Câu mẫu: "{seed_question['content']}"
+        Câu mẫu: "{content}"
 
         Nhiệm vụ: Tạo 1 câu hỏi trắc nghiệm MỚI cùng DẠNG/KỸ NĂNG với câu mẫu (không cần giữ nguyên cấu trúc), nhưng KHÓ HƠN:
         1. Toán học: Tăng độ khó bằng số liệu lẻ (không tròn), kết hợp 2-3 bước tính hoặc 2 khái niệm trong cùng một bài.
@@ -186,68 +183,325 @@ def generate_question_variant(seed_question, max_attempts: int = 3):
             "correct_answer": "Chép y nguyên text của lựa chọn đúng vào đây",
             "explanation": "Tóm tắt vì sao đáp án đúng, nhắc lại công thức/suy luận chính và số kết quả"
         }}
-        """
+        """)
+
+
+def _prompt_budget() -> int:
+    """Ngân sách token input cho prompt sinh câu hỏi (PROMPT_QUESTION_MAX_TOKENS)"""
+    return _get_int_config("PROMPT_QUESTION_MAX_TOKENS", 1500)
+
+
+def _build_variant_prompt(seed_question) -> str:
+    """Prompt tạo biến thể cho 1 câu gốc (dùng chung cho bản sync và async)."""
+    template = _DS_VARIANT_PROMPT if seed_question.get('type', 'general') == 'data_sufficiency' else _VARIANT_PROMPT
+    # Câu gốc quá dài (bảng số liệu, đoạn văn...) thì cắt cho vừa ngân sách
+    max_chars = max(200, (_prompt_budget() - template.static_tokens) * 4)
+    return template.render(
+        topic=seed_question.get('topic', 'Kiến thức tổng hợp'),
+        content=truncate(seed_question['content'], max_chars)
+    )
+
+
+def _parse_variant_response(clean_text: str, seed_question) -> dict:
+    """Parse + chuẩn hóa câu trả lời của Gemini. Lỗi JSON/đáp án -> raise để caller thử lại."""
+    return _normalize_variant(json.loads(clean_text), seed_question)
+
+
+def _normalize_variant(data: dict, seed_question) -> dict:
+    """Gắn metadata câu gốc, kiểm tra đáp án khớp lựa chọn và làm sạch options."""
+    errors = validate(data, QUESTION_SCHEMA)
+    if errors:
+        raise ValueError(f"Response does not match schema: {'; '.join(errors[:3])}")
+    topic = seed_question.get('topic', 'Kiến thức tổng hợp')
+
+    # --- SỬA LỖI: Giữ nguyên metadata từ câu gốc ---
+    data['type'] = seed_question.get('type', 'general')  # Giữ nguyên type của câu gốc (math/logic)
+    data['topic'] = topic  # QUAN TRỌNG: Gán lại topic để lưu vào DB
+    data['image_url'] = seed_question.get('image_url')  # Giữ link ảnh nếu câu gốc có
+    # -------------------------------------------
+
+    # Đảm bảo đáp án khớp với một lựa chọn
+    options = data.get('options') or []
+    correct = data.get('correct_answer') or ''
+    print(f"🔍 Đang kiểm tra đáp án: {correct[:50]}...")
+    aligned = _align_correct_answer(options, correct)
+    if not aligned:
+        raise ValueError("Correct answer does not align with options")
+    print(f"✓ Đáp án hợp lệ và khớp với lựa chọn")
+
+    # Chuẩn hóa lại danh sách lựa chọn và đáp án để hiển thị nhất quán
+    cleaned_opts = []
+    seen = set()
+    for opt in options:
+        if not isinstance(opt, str):
+            continue
+        opt_clean = opt.strip()
+        if opt_clean and opt_clean not in seen:
+            cleaned_opts.append(opt_clean)
+            seen.add(opt_clean)
+
+    data['options'] = cleaned_opts
+    data['correct_answer'] = aligned
+    print(f"✅ Hoàn tất kiểm tra câu hỏi - Topic: {topic}, Số lựa chọn: {len(cleaned_opts)}")
+    return data
+
+
+def _variant_config(deadline: float | None) -> tuple:
+    """Config generate_content + số giây còn lại trước deadline (None = không giới hạn)."""
+    config = {
+        'temperature': 0.9,
+        'max_output_tokens': 8192,
+        # Structured output: Gemini trả đúng các trường của câu hỏi, không cần gỡ markdown/sửa JSON
+        'response_mime_type': 'application/json',
+        'response_schema': QUESTION_SCHEMA
+    }
+    remaining = None
+    if deadline is not None:
+        remaining = deadline - time.monotonic()
+        config['http_options'] = {'timeout': int(max(remaining, 0) * 1000)}
+    return config, remaining
+
+
+def generate_question_variant(seed_question, max_attempts: int = 3, deadline: float | None = None):
+    """Tạo 1 biến thể câu hỏi với retry khi JSON lỗi (bản đồng bộ; batch dùng generate_question_variant_async).
+
+    deadline: mốc time.monotonic() phải xong (cả thời gian chờ rate limit lẫn gọi API).
+    """
+    model = _get_model()
+    if model is None:
+        print("❌ Model không được khởi tạo")
+        return None
+
+    topic = seed_question.get('topic', 'Kiến thức tổng hợp')
+    prompt = _build_variant_prompt(seed_question)
 
     for attempt in range(1, max_attempts + 1):
+        config, remaining = _variant_config(deadline)
+        if remaining is not None and remaining <= 1:
+            print(f"⏰ Hết thời gian cho câu hỏi (topic: {topic})")
+            return None
+        clean_text = ''
+        model_name = model_router.choose_model('variant', seed_question.get('type'), topic, attempt)
         try:
-            # Call generate_content with google-genai Client API
-            response = model.models.generate_content(
-                model='gemini-2.5-pro',
-                contents=prompt,
-                config={
-                    'temperature': 0.9,
-                    'max_output_tokens': 8192
-                }
-            )
-            clean_text = _clean_response_text(response)
-            data = json.loads(clean_text)
-            print(f"✅ Tạo câu hỏi thành công (attempt {attempt})")
-            
-            # --- SỬA LỖI: Giữ nguyên metadata từ câu gốc ---
-            data['type'] = seed_question.get('type', 'general')  # Giữ nguyên type của câu gốc (math/logic)
-            data['topic'] = topic  # QUAN TRỌNG: Gán lại topic để lưu vào DB
-            data['image_url'] = seed_question.get('image_url')  # Giữ link ảnh nếu câu gốc có
-            # -------------------------------------------
-
-            # Đảm bảo đáp án khớp với một lựa chọn
-            options = data.get('options') or []
-            correct = data.get('correct_answer') or ''
-            print(f"🔍 Đang kiểm tra đáp án: {correct[:50]}...")
-            aligned = _align_correct_answer(options, correct)
-            if not aligned:
-                raise ValueError("Correct answer does not align with options")
-            print(f"✓ Đáp án hợp lệ và khớp với lựa chọn")
-
-            # Chuẩn hóa lại danh sách lựa chọn và đáp án để hiển thị nhất quán
-            cleaned_opts = []
-            seen = set()
-            for opt in options:
-                if not isinstance(opt, str):
-                    continue
-                opt_clean = opt.strip()
-                if opt_clean and opt_clean not in seen:
-                    cleaned_opts.append(opt_clean)
-                    seen.add(opt_clean)
-
-            data['options'] = cleaned_opts
-            data['correct_answer'] = aligned
-            print(f"✅ Hoàn tất kiểm tra câu hỏi - Topic: {topic}, Số lựa chọn: {len(cleaned_opts)}")
+            with model_router.track(model_name, 'variant'):
+                # Call generate_content with google-genai Client API (qua llm_cache + rate limiter dùng chung)
+                response = llm_cache.generate_content(
+                    model,
+                    model=model_name,
+                    contents=prompt,
+                    config=config,
+                    cache=False,  # temperature 0.9: mỗi lần gọi phải ra câu mới
+                    timeout=remaining
+                )
+                clean_text = _clean_response_text(response)
+                data = _parse_variant_response(clean_text, seed_question)
+            print(f"✅ Tạo câu hỏi thành công (attempt {attempt}, {model_name})")
             return data
         except json.JSONDecodeError as e:
             print(f"❌ Lỗi JSON (attempt {attempt}/{max_attempts}): {e}")
             print(f"Response text: {clean_text[:200]}")
-            if attempt < max_attempts:
-                time.sleep(1 * attempt)  # Exponential backoff
+        except RateLimitTimeout as e:
+            print(f"❌ Hết thời gian chờ rate limit: {e}")
+            break
+        except Exception as e:
+            # Lỗi 429 đã được rate_limited_call chờ theo Retry-After; lần thử lại đi qua limiter nên không cần sleep
+            print(f"❌ Lỗi khi tạo câu (attempt {attempt}/{max_attempts}): {e}")
+
+    return None
+
+
+def _check_variant_field(fields: dict, key: str, value):
+    """Kiểm tra sớm khi stream: đáp án vừa tới mà không khớp lựa chọn nào thì dừng luôn,
+    không chờ model viết xong phần explanation."""
+    fields[key] = value
+    if key == 'correct_answer' and 'options' in fields:
+        if not _align_correct_answer(fields['options'] or [], value or ''):
+            raise ValueError("Correct answer does not align with options (stream aborted)")
+
+
+async def generate_question_variant_async(seed_question, max_attempts: int = 3, deadline: float | None = None):
+    """Bản asyncio của generate_question_variant (client.aio), chạy trên loop của gemini_async.
+
+    Hủy task (future.cancel()) là dừng ngay, kể cả khi đang chờ Gemini trả lời.
+    Mặc định dùng generate_content_stream (GEMINI_STREAMING): JSON được parse dần,
+    sai cấu trúc hoặc đáp án lệch thì bỏ response ngay khi phát hiện.
+    """
+    model = _get_model()
+    if model is None:
+        print("❌ Model không được khởi tạo")
+        return None
+
+    topic = seed_question.get('topic', 'Kiến thức tổng hợp')
+    prompt = _build_variant_prompt(seed_question)
+
+    for attempt in range(1, max_attempts + 1):
+        config, remaining = _variant_config(deadline)
+        if remaining is not None and remaining <= 1:
+            print(f"⏰ Hết thời gian cho câu hỏi (topic: {topic})")
+            return None
+        clean_text = ''
+        model_name = model_router.choose_model('variant', seed_question.get('type'), topic, attempt)
+        try:
+            with model_router.track(model_name, 'variant'):
+                if gemini_async.streaming_enabled():
+                    fields = {}
+                    response = await gemini_async.generate_content_stream(
+                        model,
+                        model=model_name,
+                        contents=prompt,
+                        config=config,
+                        timeout=remaining,
+                        cache=False,
+                        on_field=lambda key, value: _check_variant_field(fields, key, value)
+                    )
+                    if response.data is not None:
+                        data = _normalize_variant(response.data, seed_question)
+                    else:
+                        # Stream kết thúc khi JSON chưa đóng -> parse lại toàn bộ text như bản thường
+                        clean_text = _clean_response_text(response)
+                        data = _parse_variant_response(clean_text, seed_question)
+                else:
+                    response = await gemini_async.generate_content(
+                        model,
+                        model=model_name,
+                        contents=prompt,
+                        config=config,
+                        timeout=remaining,
+                        cache=False
+                    )
+                    clean_text = _clean_response_text(response)
+                    data = _parse_variant_response(clean_text, seed_question)
+            print(f"✅ Tạo câu hỏi thành công (attempt {attempt}, {model_name})")
+            return data
+        except (json.JSONDecodeError, MalformedJSONError) as e:
+            print(f"❌ Lỗi JSON (attempt {attempt}/{max_attempts}): {e}")
+            print(f"Response text: {clean_text[:200]}")
+        except (RateLimitTimeout, asyncio.TimeoutError) as e:
+            print(f"⏰ Hết thời gian cho câu hỏi (topic: {topic}): {e!r}")
+            break
         except Exception as e:
             print(f"❌ Lỗi khi tạo câu (attempt {attempt}/{max_attempts}): {e}")
-            if attempt < max_attempts:
-                time.sleep(2 * attempt)  # Exponential backoff
 
     return None
 
-def generate_question_batch(seeds, start_idx=0, progress_callback=None):
-    """Generate multiple questions concurrently"""
-    results = []
+_GROUP_PROMPT = PromptTemplate('variant_group', """
+        Bạn là chuyên gia ra đề thi GMAT cao cấp. Dưới đây là {count} câu mẫu, mỗi câu có số thứ tự [i]:
+        {samples}
+
+        Nhiệm vụ: Với MỖI câu mẫu, tạo đúng 1 câu hỏi trắc nghiệm MỚI cùng DẠNG/KỸ NĂNG (không cần giữ nguyên cấu trúc), nhưng KHÓ HƠN:
+        1. Toán học: Tăng độ khó bằng số liệu lẻ (không tròn), kết hợp 2-3 bước tính hoặc 2 khái niệm trong cùng một bài.
+        2. Logic: Giữ loại suy luận nhưng có thể đổi cấu trúc câu hỏi; thêm bẫy lựa chọn gần đúng, distractor sát đáp án đúng.
+        3. Pattern: Quy luật mới phức tạp hơn (ít nhất 2 tầng quy luật) nhưng vẫn nhất quán và giải được.
+        4. Dạng data_sufficiency: giữ cấu trúc (Câu hỏi chính + 2 Dữ kiện), đổi số liệu để LOGIC SUY LUẬN thay đổi; options LUÔN là 5 lựa chọn chuẩn (A: Chỉ (1) đủ, B: Chỉ (2) đủ, C: Cả (1) và (2) mới đủ, D: Mỗi dữ kiện riêng lẻ đủ, E: Cả hai đều không đủ).
+
+        YÊU CẦU QUAN TRỌNG (bắt buộc):
+        - step_by_step_thinking có dạng "Bước 1: ... Bước 2: ..." kèm số liệu, công thức và kết quả trung gian.
+        - explanation: CHỈ ghi kết quả cuối cùng + lý do TẠI SAO là đáp án đúng (không lặp lại các bước tính).
+        - correct_answer: chép y nguyên text của lựa chọn đúng trong options.
+        - seed_index: số thứ tự [i] của câu mẫu tương ứng.
+        - Trả về MẢNG JSON gồm đúng {count} phần tử, mỗi phần tử chỉ có các trường: seed_index, {fields}.
+        """)
+
+
+def _build_group_prompt(seeds) -> str:
+    """1 prompt cho nhiều câu gốc: hướng dẫn chung gửi 1 lần thay vì lặp lại cho từng câu."""
+    # Ngân sách chung chia đều cho các câu mẫu
+    max_chars = max(200, (_prompt_budget() * len(seeds) - _GROUP_PROMPT.static_tokens) * 4 // len(seeds))
+    samples = "\n".join(
+        f"[{i}] (Chủ đề: {seed.get('topic', 'Kiến thức tổng hợp')}; Dạng: {seed.get('type', 'general')}) \"{truncate(seed['content'], max_chars)}\""
+        for i, seed in enumerate(seeds)
+    )
+    return _GROUP_PROMPT.render(count=len(seeds), samples=samples, fields=", ".join(QUESTION_FIELDS))
+
+
+async def generate_question_group_async(seeds, max_attempts: int = 3, deadline: float | None = None) -> list:
+    """Sinh biến thể cho nhiều câu gốc trong 1 request (structured output dạng mảng).
+
+    Mỗi phần tử được kiểm tra riêng; lần thử sau chỉ gửi lại các câu gốc bị lỗi.
+    Trả về list cùng thứ tự `seeds` (None cho câu không tạo được).
+    """
+    results = [None] * len(seeds)
+    model = _get_model()
+    if model is None:
+        print("❌ Model không được khởi tạo")
+        return results
+
+    for attempt in range(1, max_attempts + 1):
+        missing = [i for i, q in enumerate(results) if q is None]
+        if not missing:
+            break
+        group = [seeds[i] for i in missing]
+        config, remaining = _variant_config(deadline)
+        if remaining is not None and remaining <= 1:
+            print(f"⏰ Hết thời gian cho nhóm {len(group)} câu")
+            break
+        config.update({
+            'max_output_tokens': min(65536, 8192 * len(group)),
+            'response_schema': QUESTION_GROUP_SCHEMA
+        })
+        # Nhóm cùng topic/dạng nên chọn model theo câu đầu tiên
+        model_name = model_router.choose_model('variant', group[0].get('type'), group[0].get('topic'), attempt)
+        try:
+            with model_router.track(model_name, 'variant') as outcome:
+                outcome['total'] = len(group)
+                response = await gemini_async.generate_content(
+                    model,
+                    model=model_name,
+                    contents=_build_group_prompt(group),
+                    config=config,
+                    timeout=remaining,
+                    cache=False
+                )
+                items = json.loads(_clean_response_text(response))
+
+                for item in items if isinstance(items, list) else []:
+                    try:
+                        pos = int(item.pop('seed_index'))
+                        if not 0 <= pos < len(group) or results[missing[pos]] is not None:
+                            continue
+                        results[missing[pos]] = _normalize_variant(item, group[pos])
+                    except Exception as e:
+                        print(f"🚫 Bỏ 1 câu trong nhóm: {e}")
+                ok = sum(1 for i in missing if results[i] is not None)
+                outcome['ok'] = ok
+        except (RateLimitTimeout, asyncio.TimeoutError) as e:
+            print(f"⏰ Hết thời gian cho nhóm {len(group)} câu: {e!r}")
+            break
+        except Exception as e:
+            print(f"❌ Lỗi khi tạo nhóm {len(group)} câu (attempt {attempt}/{max_attempts}): {e}")
+            continue
+        print(f"✅ Nhóm {len(group)} câu (attempt {attempt}, {model_name}): {ok} câu hợp lệ")
+
+    return results
+
+
+def _group_seeds(seeds, batch_size: int) -> list:
+    """Chia chỉ số seed thành nhóm <= batch_size, gom các câu cùng topic/dạng vào 1 nhóm."""
+    by_kind = {}
+    for idx, seed in enumerate(seeds):
+        by_kind.setdefault((seed.get('topic'), seed.get('type')), []).append(idx)
+    groups = []
+    for indices in by_kind.values():
+        groups.extend(indices[i:i + batch_size] for i in range(0, len(indices), batch_size))
+    return groups
+
+
+def generate_question_batch(seeds, start_idx=0, progress_callback=None, num_questions=None,
+                            concurrency=None, question_timeout=None, batch_size=None):
+    """Generate multiple questions concurrently
+
+    Chạy tối đa `concurrency` câu cùng lúc (mặc định GEMINI_CONCURRENCY), mỗi câu có hạn
+    `question_timeout` giây (mặc định GEMINI_QUESTION_TIMEOUT = 180). Đủ `num_questions`
+    câu hợp lệ (mặc định = số seed) thì hủy phần còn lại. Kết quả giữ thứ tự của seeds.
+    batch_size > 1 (mặc định GEMINI_BATCH_SIZE): gộp tối đa batch_size câu cùng topic/dạng
+    vào 1 request thay vì mỗi câu 1 request.
+    """
+    if not seeds:
+        return []
+    num_questions = len(seeds) if num_questions is None else num_questions
+    concurrency = min(len(seeds), concurrency or gemini_async.get_concurrency())
+    question_timeout = question_timeout or _get_int_config("GEMINI_QUESTION_TIMEOUT", 180)
+    batch_size = max(1, batch_size or _get_int_config("GEMINI_BATCH_SIZE", 5))
     visual_keywords = ['hình', 'shape', 'ảnh', 'diagram', 'figure', 'biểu đồ']
 
     def _extract_number(text: str) -> float | None:
@@ -323,49 +577,179 @@ def generate_question_batch(seeds, start_idx=0, progress_callback=None):
             return False
         return True
     
-    # Giảm concurrency để tránh lỗi 429 (giới hạn ~7 RPM tài khoản hiện tại)
-    with ThreadPoolExecutor(max_workers=1) as executor:
-        # Submit all tasks
-        future_to_idx = {executor.submit(generate_question_variant, seed): (idx, seed) 
-                        for idx, seed in enumerate(seeds)}
-        
-        # Process completed tasks
-        for future in as_completed(future_to_idx):
-            idx, seed = future_to_idx[future]
-            try:
-                new_q = future.result()
-                if new_q:
-                    text = (new_q.get('question') or '').lower()
-                    has_image = bool(new_q.get('image_url'))
-                    if any(k in text for k in visual_keywords) and not has_image:
-                        print(f"🚫 Bỏ qua câu hỏi thiếu hình ảnh: {text[:60]}...")
-                    elif not _is_valid(new_q):
-                        print(f"🚫 Bỏ qua câu hỏi sai định dạng đáp án")
-                    else:
-                        results.append(new_q)
-                        print(f"✅ Câu {start_idx + idx + 1} - Tạo thành công")
-                else:
-                    print(f"⚠️ Câu {start_idx + idx + 1} - Thất bại")
-            except Exception as e:
-                print(f"❌ Lỗi khi tạo câu {start_idx + idx + 1}: {e}")
-
-            # Tăng lên 15s để an toàn hơn với giới hạn API
-            # 60s / 15s = 4 requests/phút (rất an toàn, tránh quá tải)
-            print(f"⏳ Chờ 15s trước khi tạo câu tiếp theo...")
-            time.sleep(15)
-            
-            if progress_callback:
-                progress_callback((start_idx + idx + 1) / (start_idx + len(seeds)))
+    def _accept(new_q: dict | None, idx: int) -> bool:
+        if not new_q:
+            print(f"⚠️ Câu {start_idx + idx + 1} - Thất bại")
+            return False
+        text = (new_q.get('question') or '').lower()
+        has_image = bool(new_q.get('image_url'))
+        if any(k in text for k in visual_keywords) and not has_image:
+            print(f"🚫 Bỏ qua câu hỏi thiếu hình ảnh: {text[:60]}...")
+            return False
+        if not _is_valid(new_q):
+            print(f"🚫 Bỏ qua câu hỏi sai định dạng đáp án")
+            return False
+        print(f"✅ Câu {start_idx + idx + 1} - Tạo thành công")
+        return True
+
+    # Nhịp gọi API do rate_limiter (GEMINI_RPM) điều phối; ở đây chỉ giới hạn số request đang chạy.
+    # Các câu chạy dạng coroutine trên event loop của gemini_async, script chỉ chờ future.
+    accepted = {}  # idx -> câu hợp lệ, sắp lại theo thứ tự seed khi trả về
+    done_count = 0
+    pending = set()
+    groups = _group_seeds(seeds, batch_size)
+    concurrency = min(concurrency, len(groups))
+    try:
+        # Deadline tính từ lúc nhóm có slot chạy, không phải lúc xếp hàng
+        def _factory(indices):
+            if len(indices) == 1:
+                async def _single():
+                    return [await generate_question_variant_async(
+                        seeds[indices[0]], deadline=time.monotonic() + question_timeout)]
+                return _single
+            return lambda: generate_question_group_async(
+                [seeds[i] for i in indices], deadline=time.monotonic() + question_timeout)
+
+        futures = gemini_async.submit_bounded([_factory(indices) for indices in groups], concurrency)
+        future_to_indices = dict(zip(futures, groups))
+        pending = set(futures)
+        # Chốt chặn cho cả batch: mỗi slot xử lý tuần tự ceil(số nhóm / concurrency) nhóm
+        batch_deadline = time.monotonic() + question_timeout * (-(-len(groups) // concurrency)) + 5
+
+        while pending and len(accepted) < num_questions:
+            remaining = batch_deadline - time.monotonic()
+            if remaining <= 0:
+                print(f"⏰ Hết thời gian batch, bỏ {len(pending)} câu chưa xong")
+                break
+            done, pending = wait(pending, timeout=remaining, return_when=FIRST_COMPLETED)
+            for future in done:
+                indices = future_to_indices[future]
+                done_count += len(indices)
+                try:
+                    new_qs = future.result()
+                except Exception as e:
+                    print(f"❌ Lỗi khi tạo câu {', '.join(str(start_idx + i + 1) for i in indices)}: {e!r}")
+                    new_qs = [None] * len(indices)
+                for idx, new_q in zip(indices, new_qs):
+                    if len(accepted) < num_questions and _accept(new_q, idx):
+                        accepted[idx] = new_q
+
+                if progress_callback:
+                    # Có câu dư (num_questions < số seed) thì tiến độ tính theo số câu đã đạt
+                    progress_callback(min(1.0, max(
+                        (start_idx + done_count) / (start_idx + len(seeds)),
+                        len(accepted) / num_questions if num_questions else 0.0
+                    )))
+
+        if pending and len(accepted) >= num_questions:
+            print(f"✂️ Đã đủ {num_questions} câu, hủy {len(pending)} câu còn lại")
+    finally:
+        # Hủy coroutine còn lại (kể cả đang chờ Gemini) để không tốn quota
+        for future in pending:
+            future.cancel()
+
+    if progress_callback:
+        progress_callback(1.0)
+    return [accepted[idx] for idx in sorted(accepted)]
+
+# Tỉ lệ câu cũ (DB) trong mỗi đề - phần còn lại là câu AI mới
+CACHED_RATIO = 0.3
+# Tăng tỷ lệ ưu tiên topic yếu để luyện tập trọng tâm
+WEAK_TOPIC_BOOST_RATIO = 0.45
+
+def split_exam_counts(num_questions: int) -> tuple:
+    """(số câu cũ từ DB, số câu AI mới) cho một đề num_questions câu"""
+    target_cached = int(num_questions * CACHED_RATIO)
+    return target_cached, num_questions - target_cached
+
+def speculative_seed_count(needed: int) -> int:
+    """Số câu gốc gửi đi để có `needed` câu hợp lệ: dư thêm GEMINI_OVERGENERATE_PERCENT % (mặc định 25)
+
+    generate_question_batch dừng ngay khi đủ `needed` câu và hủy phần dư, nên câu bị
+    loại (sai đáp án, thiếu hình) được bù trong cùng lượt thay vì phải gọi thêm vòng nữa.
+    """
+    percent = max(0, _get_int_config("GEMINI_OVERGENERATE_PERCENT", 25))
+    if needed <= 0 or percent == 0:
+        return max(needed, 0)
+    return needed + max(1, -(-needed * percent // 100))
+
+def _get_user_weak_topics(user_id) -> list:
+    if not user_id:
+        return []
+    try:
+        from db import get_weak_topics
+        weak_topics_data = get_weak_topics(user_id, limit=5)
+        weak_topics = [item['topic'] for item in weak_topics_data]
+        if weak_topics:
+            print(f"🎯 Phát hiện điểm yếu: {', '.join(weak_topics)}")
+        return weak_topics
+    except Exception as e:
+        print(f"⚠️ Không thể lấy weak topics: {e}")
+        return []
+
+def _cached_topic_weights(seed_data, weak_topics) -> dict:
+    """Trọng số topic cho phần câu cũ - weak topics chiếm WEAK_TOPIC_BOOST_RATIO"""
+    seed_topics = {s.get('topic', 'general') for s in seed_data}
+    weak_in_bank = [t for t in weak_topics if t]
+    other_topics = [t for t in seed_topics if t not in weak_in_bank]
+    topic_weights = {}
+    if weak_in_bank and other_topics:
+        for t in weak_in_bank:
+            topic_weights[t] = WEAK_TOPIC_BOOST_RATIO / len(weak_in_bank)
+        for t in other_topics:
+            topic_weights[t] = (1 - WEAK_TOPIC_BOOST_RATIO) / len(other_topics)
+    else:
+        topic_weights = {t: 1.0 for t in (weak_in_bank or seed_topics)}
+    return topic_weights
+
+def select_seeds(seed_data, count: int, weak_topics=None) -> list:
+    """Chọn `count` câu gốc: ưu tiên weak topics, phần còn lại xen kẽ đều giữa các topic"""
+    weak_topics = weak_topics or []
+    topic_buckets = {}
+    for s in seed_data:
+        t = s.get('topic', 'general')
+        topic_buckets.setdefault(t, []).append(s)
     
-    return results
+    selected_seeds = []
+    
+    # Ưu tiên weak topics trước
+    if weak_topics:
+        weak_count = int(count * WEAK_TOPIC_BOOST_RATIO)
+        for topic in weak_topics:
+            if topic in topic_buckets and len(selected_seeds) < weak_count:
+                # Lấy nhiều câu từ topic yếu
+                available = topic_buckets[topic]
+                take = min(len(available), weak_count - len(selected_seeds))
+                selected_seeds.extend(random.sample(available, take))
+        print(f"✅ Đã thêm {len(selected_seeds)} câu từ weak topics")
+    
+    # Phần còn lại chọn đa dạng từ các topic khác
+    bucket_list = list(topic_buckets.values())
+    random.shuffle(bucket_list)
+
+    # Lấy xen kẽ giữa các bucket để tăng độ trộn, mỗi vòng lại xáo thứ tự bucket
+    while len(selected_seeds) < count and bucket_list:
+        random.shuffle(bucket_list)
+        for bucket in bucket_list:
+            if bucket:
+                selected_seeds.append(random.choice(bucket))
+                if len(selected_seeds) >= count:
+                    break
+    # Fallback
+    if len(selected_seeds) < count:
+        selected_seeds.extend(random.choices(seed_data, k=count - len(selected_seeds)))
+    return selected_seeds
 
-def generate_full_exam(seed_data, num_questions=30, num_general=0, progress_callback=None, max_retries_per_question=4, user_id=None):
+def generate_full_exam(seed_data, num_questions=30, num_general=0, progress_callback=None, max_retries_per_question=4, user_id=None, use_pool=True):
     """
     Tạo bộ đề thi: Ưu tiên câu hỏi mới từ AI (~70%) trộn với câu hỏi cũ (~30%).
     Ưu tiên các topic mà user hay trả lời sai (nếu có user_id).
     
     Args:
         user_id: ID của user để lấy weak topics (optional)
+        use_pool: lấy phần câu AI từ exam_pool (sinh sẵn ở background) nếu có,
+            chỉ gọi Gemini trực tiếp khi pool không còn bộ đủ câu. Bỏ qua khi user có
+            weak topics (câu trong pool không sinh theo điểm yếu)
     """
     exam_questions = []
 
@@ -374,105 +758,71 @@ def generate_full_exam(seed_data, num_questions=30, num_general=0, progress_call
         return exam_questions
 
     # 1. CẤU HÌNH TỈ LỆ (ưu tiên câu mới để tăng độ đa dạng/khó)
-    target_cached = int(num_questions * 0.3)  # 30% cũ
-    target_new = num_questions - target_cached # 70% mới
+    target_cached, target_new = split_exam_counts(num_questions)
 
     print(f"📋 Kế hoạch tạo đề: {target_cached} câu cũ (DB) + {target_new} câu mới (AI)")
     
     # 1.5 LẤY WEAK TOPICS NẾU CÓ USER_ID
-    weak_topics = []
-    weak_topic_boost_ratio = 0.45  # Tăng tỷ lệ ưu tiên topic yếu để luyện tập trọng tâm
-    if user_id:
+    weak_topics = _get_user_weak_topics(user_id)
+
+    # 2. BỘ CÂU AI SINH SẴN (exam_pool) - không phải chờ Gemini
+    pooled = []
+    if use_pool and weak_topics:
+        print("🎯 Có weak topics -> tạo câu AI theo điểm yếu, không dùng exam pool")
+    elif use_pool:
         try:
-            from db import get_weak_topics
-            weak_topics_data = get_weak_topics(user_id, limit=5)
-            weak_topics = [item['topic'] for item in weak_topics_data]
-            if weak_topics:
-                print(f"🎯 Phát hiện điểm yếu: {', '.join(weak_topics)}")
+            pooled = claim_pooled_question_set(target_new) or []
         except Exception as e:
-            print(f"⚠️ Không thể lấy weak topics: {e}")
-
-    # 2. LẤY CÂU HỎI TỪ CACHE (DB)
-    cached_part = get_cached_questions(target_cached, randomize=True)
+            print(f"⚠️ Không đọc được exam pool: {e}")
+        if pooled:
+            print(f"⚡ Lấy {len(pooled)} câu AI sinh sẵn từ exam pool")
+            if progress_callback:
+                progress_callback(1.0)
+
+    # 3. LẤY CÂU HỎI TỪ CACHE (DB) - cũng ưu tiên weak topics như phần AI
+    # Câu trong pool đã được lưu vào DB -> loại ra để không trùng trong đề
+    cached_part = get_cached_questions_by_topics(
+        _cached_topic_weights(seed_data, weak_topics),
+        target_cached,
+        exclude_hashes={question_fingerprint(q) for q in pooled}
+    )
     if cached_part:
         print(f"✅ Đã lấy {len(cached_part)} câu từ Cache")
         exam_questions.extend(cached_part)
+    exam_questions.extend(pooled)
     
     # Tính số câu thực sự cần tạo mới (phòng trường hợp DB chưa có gì thì phải tạo hết)
+    # Bộ câu từ pool đã đủ phần AI -> chỉ gọi AI khi DB thiếu câu cũ
     actual_needed_new = num_questions - len(exam_questions)
     
     if actual_needed_new > 0:
         print(f"🤖 Đang AI tạo mới {actual_needed_new} câu...")
-        print(f"⏱️  Thời gian ước tính: ~{actual_needed_new * 15 / 60:.1f} phút (15s/câu)")
-        
-        # --- CHỌN SEED DATA VỚI ƯU TIÊN WEAK TOPICS ---
-        topic_buckets = {}
-        for s in seed_data:
-            t = s.get('topic', 'general')
-            topic_buckets.setdefault(t, []).append(s)
+        rpm = max(1, get_limiter().rpm)
+        print(f"⏱️  Thời gian ước tính: ~{actual_needed_new / rpm:.1f} phút (giới hạn {rpm} RPM, song song {gemini_async.get_concurrency()})")
         
-        selected_seeds = []
-        
-        # Ưu tiên weak topics trước (30% số câu)
-        if weak_topics:
-            weak_count = int(actual_needed_new * weak_topic_boost_ratio)
-            for topic in weak_topics:
-                if topic in topic_buckets and len(selected_seeds) < weak_count:
-                    # Lấy nhiều câu từ topic yếu
-                    available = topic_buckets[topic]
-                    take = min(len(available), weak_count - len(selected_seeds))
-                    selected_seeds.extend(random.sample(available, take))
-            print(f"✅ Đã thêm {len(selected_seeds)} câu từ weak topics")
-        
-        # Phần còn lại chọn đa dạng từ các topic khác
-        remaining_needed = actual_needed_new - len(selected_seeds)
-        bucket_list = list(topic_buckets.values())
-        random.shuffle(bucket_list)
+        # --- CHỌN SEED DATA VỚI ƯU TIÊN WEAK TOPICS (dư vài câu để bù câu bị loại) ---
+        selected_seeds = select_seeds(seed_data, speculative_seed_count(actual_needed_new), weak_topics)
 
-        # Lấy xen kẽ giữa các bucket để tăng độ trộn, mỗi vòng lại xáo thứ tự bucket
-        while len(selected_seeds) < actual_needed_new and bucket_list:
-            random.shuffle(bucket_list)
-            for bucket in bucket_list:
-                if bucket:
-                    selected_seeds.append(random.choice(bucket))
-                    if len(selected_seeds) >= actual_needed_new:
-                        break
-        # Fallback
-        if len(selected_seeds) < actual_needed_new:
-            selected_seeds.extend(random.choices(seed_data, k=actual_needed_new - len(selected_seeds)))
-
-        # --- GỌI API TẠO CÂU MỚI (Dùng hàm batch đã tối ưu ở bước trước) ---
-        newly_generated = generate_question_batch(selected_seeds, 0, progress_callback)
+        # --- GỌI API TẠO CÂU MỚI: đủ actual_needed_new câu hợp lệ thì hủy phần dư ---
+        newly_generated = generate_question_batch(selected_seeds, 0, progress_callback, num_questions=actual_needed_new)
         
-        # Lưu câu MỚI vào DB ngay lập tức
+        # Lưu câu MỚI vào DB qua hàng đợi ghi nền (không chặn việc trả đề)
         if newly_generated:
-            try:
-                saved = save_questions(newly_generated)
-                print(f"💾 Đã lưu {saved} câu mới vào DB")
-            except Exception as e:
-                print(f"⚠️ Lỗi lưu DB: {e}")
-            
+            write_behind.save_questions(newly_generated)
             exam_questions.extend(newly_generated)
 
-    # 3. KIỂM TRA VÀ BỔ SUNG NẾU THIẾU (FALLBACK)
+    # 4. LOẠI CÂU TRÙNG (cùng fingerprint với db) VÀ BỔ SUNG NẾU THIẾU (FALLBACK)
+    unique = {}
+    for q in exam_questions:
+        unique.setdefault(question_fingerprint(q), q)
+    exam_questions = list(unique.values())
     if len(exam_questions) < num_questions:
         missing = num_questions - len(exam_questions)
         print(f"⚠️ Vẫn thiếu {missing} câu, lấy thêm từ Cache bù vào...")
-        extra_cached = get_cached_questions(limit=100, randomize=True)
-        
-        existing_hashes = set()
-        for q in exam_questions:
-            h = (q.get('question', '') + q.get('correct_answer', '')).strip().lower()
-            existing_hashes.add(h)
-            
-        for q in extra_cached:
-            h = (q.get('question', '') + q.get('correct_answer', '')).strip().lower()
-            if h not in existing_hashes:
-                exam_questions.append(q)
-                if len(exam_questions) >= num_questions:
-                    break
+        # Câu đã có trong đề bị loại ngay trong truy vấn (anti-join theo fingerprint)
+        exam_questions.extend(get_cached_questions_by_topics({}, missing, exclude_hashes=set(unique)))
 
-    # 4. XÁO TRỘN CUỐI CÙNG
+    # 5. XÁO TRỘN CUỐI CÙNG
     random.shuffle(exam_questions)
     
     print(f"🎉 Hoàn tất đề thi: {len(exam_questions)} câu.")
@@ -48,13 +48,14 @@ st.markdown("""
 # Đặt trong try-except để bắt lỗi thiếu thư viện hoặc lỗi code
 try:
     from ai_logic import generate_full_exam
-    from db import init_db, get_cached_questions, save_questions
+    from db import init_db, get_cached_questions
 except Exception as e:
     st.error(f"❌ Lỗi Import module: {e}")
     st.stop()
 
 # --- KHỞI TẠO DB AN TOÀN ---
 # Đây là đoạn quan trọng nhất giúp app không bị connection refused
+# init_db() chỉ migrate schema ở lần chạy đầu của process, các lần rerun sau không chạm DB
 try:
     init_db()
 except Exception as e:
@@ -429,6 +430,117 @@ def _format_theory_dict(theory_dict):
     
     return "\n".join(lines)
 
+def _render_topic_guide(topic):
+    """Hiển thị guide của 1 topic trong 1 expander (dùng cả khi đang stream lẫn khi xem lại)"""
+    stats = topic.get('stats', {})
+    correct = stats.get('correct', 0)
+    total = stats.get('total', 1)
+    wrong = stats.get('wrong', 0)
+    accuracy = (correct / total * 100) if total > 0 else 0
+
+    topic_title = _clean_html(topic.get('topic', 'Chủ đề'))
+    with st.expander(f"📚 {topic_title} - {correct}/{total} đúng ({accuracy:.0f}%)"):
+        # Lý thuyết chi tiết
+        if 'theory' in topic and topic['theory']:
+            st.markdown("### 📖 Lý thuyết cơ bản")
+            # Convert theory to markdown format (it contains newlines that should be preserved)
+            theory_text = topic['theory']
+            if isinstance(theory_text, str):
+                # Replace escaped newlines with actual newlines for markdown rendering
+                theory_text = _clean_html(theory_text)
+                theory_text = theory_text.replace('\\n\\n', '\n\n').replace('\\n', '\n')
+                st.markdown(theory_text)
+            elif isinstance(theory_text, dict):
+                # Convert structured theory dictionary to readable markdown
+                formatted_theory = _format_theory_dict(theory_text)
+                st.markdown(formatted_theory)
+            else:
+                st.write(theory_text)
+            st.markdown("---")
+
+        # Chi tiết các khái niệm
+        if 'detailed_concepts' in topic and topic['detailed_concepts']:
+            st.markdown("### 💡 Các khái niệm chi tiết")
+            for concept in topic['detailed_concepts']:
+                with st.container():
+                    st.markdown(f"**{_clean_html(concept.get('concept_name', ''))}**")
+                    st.write(_clean_html(concept.get('explanation', '')))
+                    if concept.get('example'):
+                        example_txt = _clean_html(concept['example']).replace('`', '')
+                        st.markdown(example_txt)
+                    st.markdown("")
+            st.markdown("---")
+
+        # Phương pháp từng bước
+        if 'step_by_step_method' in topic and topic['step_by_step_method']:
+            st.markdown("### 📝 Phương pháp làm bài từng bước")
+            for step in topic['step_by_step_method']:
+                st.write(f"**{_clean_html(step)}**")
+            st.markdown("---")
+
+        # Phân tích lỗi sai của học sinh
+        if 'mistake_analysis' in topic and topic['mistake_analysis']:
+            st.markdown("### 🔍 Phân tích bài làm của bạn")
+            for idx, mistake in enumerate(topic['mistake_analysis'], 1):
+                with st.container():
+                    st.markdown(f"**Câu {idx}: {_clean_html(mistake.get('question_summary', ''))}**")
+                    st.error(f"❌ **Lỗi của bạn:** {_format_multistep_text(mistake.get('user_mistake', ''))}")
+                    st.warning(f"⚠️ **Tại sao sai:** {_format_multistep_text(mistake.get('why_wrong', ''))}")
+                    st.success(f"✅ **Cách đúng:** {_format_multistep_text(mistake.get('correct_approach', ''))}")
+                    st.markdown("")
+            st.markdown("---")
+
+        col1, col2 = st.columns(2)
+
+        with col1:
+            # Lỗi phổ biến
+            if 'common_mistakes' in topic and topic['common_mistakes']:
+                st.markdown("### ⚠️ Lỗi phổ biến khác")
+                for mistake in topic['common_mistakes']:
+                    st.write(f"• {_clean_html(mistake)}")
+                st.markdown("")
+
+            # Mẹo tăng độ chính xác
+            if 'tips_for_accuracy' in topic and topic['tips_for_accuracy']:
+                st.markdown("### 🎯 Mẹo tăng tỷ lệ đúng")
+                for tip in topic['tips_for_accuracy']:
+                    st.write(f"• {_clean_html(tip)}")
+                st.markdown("")
+
+            # Bài tập thực hành
+            if 'practice_drills' in topic and topic['practice_drills']:
+                st.markdown("### 🧪 Bài tập luyện thêm")
+                for drill in topic['practice_drills']:
+                    st.write(f"• {_clean_html(drill)}")
+
+        with col2:
+            # Metric
+            st.metric("Tỉ lệ đúng", f"{accuracy:.0f}%", 
+                     delta=f"{wrong} câu sai" if wrong > 0 else "Hoàn hảo!")
+
+            # Mẹo tăng tốc độ
+            if 'tips_for_speed' in topic and topic['tips_for_speed']:
+                st.markdown("### ⚡ Mẹo tăng tốc độ")
+                for tip in topic['tips_for_speed']:
+                    st.write(f"• {_clean_html(tip)}")
+                st.markdown("")
+
+            # Công thức quan trọng
+            if 'key_formulas' in topic and topic['key_formulas']:
+                st.markdown("### 📐 Công thức cần nhớ")
+                for formula in topic['key_formulas']:
+                    if isinstance(formula, dict):
+                        # Format formula dict
+                        formula_text = f"**{_clean_html(formula.get('formula', ''))}**\n\n"
+                        if formula.get('explanation'):
+                            formula_text += f"*{_clean_html(formula['explanation'])}*\n\n"
+                        if formula.get('usage'):
+                            formula_text += f"Sử dụng: {_clean_html(formula['usage'])}"
+                        st.markdown(formula_text)
+                    else:
+                        formula_txt = _clean_html(formula).replace('`', '')
+                        st.markdown(formula_txt)
+
 @st.cache_data(ttl=3600, show_spinner=False)  # Cache for 1 hour
 def load_seed_data():
     try:
@@ -437,6 +549,18 @@ def load_seed_data():
     except:
         return []
 
+@st.cache_resource(show_spinner=False)
+def start_exam_pool_worker():
+    """Khởi động worker sinh đề sẵn (exam_pool.py) - 1 lần cho mỗi process"""
+    try:
+        from exam_pool import start_worker
+        return start_worker(load_seed_data())
+    except Exception as e:
+        print(f"⚠️ Không khởi động được exam pool: {e}")
+        return False
+
+start_exam_pool_worker()
+
 def format_time(seconds):
     mins, secs = divmod(seconds, 60)
     return f"{int(mins):02d}:{int(secs):02d}"
@@ -474,13 +598,6 @@ if (/iPhone|iPad|iPod/.test(navigator.userAgent) && /Safari/.test(navigator.user
 # --- GIAO DIỆN CHÍNH ---
 st.title("📝 Hệ thống Thi thử GMAT")
 
-# --- KẾT NỐI DB AN TOÀN ---
-try:
-    init_db()
-except Exception as e:
-    st.error(f"⚠️ Không thể kết nối Database: {e}")
-    st.info("Kiểm tra lại Streamlit Secrets (DB_PASSWORD, DB_HOST...)")
-
 # 1. MÀN HÌNH CHỜ (READY)
 if st.session_state.exam_state == "READY":
     st.markdown("""
@@ -781,11 +898,10 @@ elif st.session_state.exam_state == "FINISHED":
         # Lưu thống kê câu sai vào DB
         if wrong_topics:
             try:
-                from db import save_wrong_answer
-                user_id = st.session_state.session_id
-                for item in wrong_topics:
-                    save_wrong_answer(user_id, item['topic'], item['qtype'])
-                print(f"✅ Đã lưu {len(wrong_topics)} câu sai vào thống kê")
+                import write_behind
+                # Ghi nền (write_behind), 1 upsert cho cả lượt nộp bài - trang kết quả không phải chờ DB
+                write_behind.save_wrong_answers(st.session_state.session_id, wrong_topics)
+                print(f"✅ Đã đưa {len(wrong_topics)} câu sai vào hàng đợi thống kê")
             except Exception as e:
                 print(f"⚠️ Lỗi lưu thống kê: {e}")
         
@@ -919,41 +1035,47 @@ elif st.session_state.exam_state == "FINISHED":
         
         # CACHE: Kiểm tra xem đã tạo study guide chưa để tránh gọi API lại
         if 'cached_study_guide' not in st.session_state:
-            # Progress bar với thông tin chi tiết
+            # Progress thật theo số topic đã xong; guide nào xong là hiển thị ngay
             progress_text = st.empty()
             progress_bar = st.progress(0)
+            live_area = st.empty()
             
             progress_text.text("🔍 Phân tích kết quả bài thi...")
-            progress_bar.progress(25)
             
             try:
-                from study_guide import generate_study_guide, format_study_guide_html
-                
-                progress_text.text("🤖 AI đang tạo tài liệu ôn tập chi tiết...")
-                progress_bar.progress(50)
+                from study_guide import iter_study_guide, summarize_study_guide, study_model_error
                 
-                # GỌI API DUY NHẤT - Kết quả sẽ được cache
-                study_data = generate_study_guide(questions, answers)
-                
-                progress_bar.progress(75)
-                progress_text.text("✨ Đang định dạng nội dung...")
+                # Không có API key/model -> báo lỗi như trước, không âm thầm dùng guide dự phòng
+                study_data = study_model_error()
+                if study_data is None:
+                    guides = {}
+                    live = live_area.container()
+                    for event in iter_study_guide(questions, answers):
+                        guides[event['position']] = event['guide']
+                        progress_bar.progress(event['completed'] / event['total'])
+                        progress_text.text(
+                            f"🤖 AI đang tạo tài liệu ôn tập... {event['completed']}/{event['total']} chủ đề"
+                        )
+                        with live:
+                            _render_topic_guide(event['guide'])
+                    
+                    # Thứ tự ưu tiên (nhiều câu sai trước)
+                    study_data = summarize_study_guide([guides[pos] for pos in sorted(guides)])
                 
                 # Lưu vào cache để không phải gọi lại
                 st.session_state.cached_study_guide = study_data
                 
-                progress_bar.progress(100)
-                progress_text.text("✅ Hoàn thành!")
-                
-                import time
-                time.sleep(0.5)
+                # Bản hiển thị đầy đủ (tabs + tải xuống) bên dưới thay cho bản stream
                 progress_text.empty()
                 progress_bar.empty()
+                live_area.empty()
                 
                 print("✅ Đã cache study guide vào session_state")
                 
             except Exception as e:
                 progress_text.empty()
                 progress_bar.empty()
+                live_area.empty()
                 
                 st.error(f"❌ Lỗi khi tạo tài liệu ôn tập: {e}")
                 st.info("💡 Vui lòng kiểm tra:")
@@ -989,114 +1111,7 @@ elif st.session_state.exam_state == "FINISHED":
                     topics = study_data.get('topics', [])
                     if topics:
                         for topic in topics:
-                            stats = topic.get('stats', {})
-                            correct = stats.get('correct', 0)
-                            total = stats.get('total', 1)
-                            wrong = stats.get('wrong', 0)
-                            accuracy = (correct / total * 100) if total > 0 else 0
-                            
-                            topic_title = _clean_html(topic.get('topic', 'Chủ đề'))
-                            with st.expander(f"📚 {topic_title} - {correct}/{total} đúng ({accuracy:.0f}%)"):
-                                # Lý thuyết chi tiết
-                                if 'theory' in topic and topic['theory']:
-                                    st.markdown("### 📖 Lý thuyết cơ bản")
-                                    # Convert theory to markdown format (it contains newlines that should be preserved)
-                                    theory_text = topic['theory']
-                                    if isinstance(theory_text, str):
-                                        # Replace escaped newlines with actual newlines for markdown rendering
-                                        theory_text = _clean_html(theory_text)
-                                        theory_text = theory_text.replace('\\n\\n', '\n\n').replace('\\n', '\n')
-                                        st.markdown(theory_text)
-                                    elif isinstance(theory_text, dict):
-                                        # Convert structured theory dictionary to readable markdown
-                                        formatted_theory = _format_theory_dict(theory_text)
-                                        st.markdown(formatted_theory)
-                                    else:
-                                        st.write(theory_text)
-                                    st.markdown("---")
-                                
-                                # Chi tiết các khái niệm
-                                if 'detailed_concepts' in topic and topic['detailed_concepts']:
-                                    st.markdown("### 💡 Các khái niệm chi tiết")
-                                    for concept in topic['detailed_concepts']:
-                                        with st.container():
-                                            st.markdown(f"**{_clean_html(concept.get('concept_name', ''))}**")
-                                            st.write(_clean_html(concept.get('explanation', '')))
-                                            if concept.get('example'):
-                                                example_txt = _clean_html(concept['example']).replace('`', '')
-                                                st.markdown(example_txt)
-                                            st.markdown("")
-                                    st.markdown("---")
-                                
-                                # Phương pháp từng bước
-                                if 'step_by_step_method' in topic and topic['step_by_step_method']:
-                                    st.markdown("### 📝 Phương pháp làm bài từng bước")
-                                    for step in topic['step_by_step_method']:
-                                        st.write(f"**{_clean_html(step)}**")
-                                    st.markdown("---")
-                                
-                                # Phân tích lỗi sai của học sinh
-                                if 'mistake_analysis' in topic and topic['mistake_analysis']:
-                                    st.markdown("### 🔍 Phân tích bài làm của bạn")
-                                    for idx, mistake in enumerate(topic['mistake_analysis'], 1):
-                                        with st.container():
-                                            st.markdown(f"**Câu {idx}: {_clean_html(mistake.get('question_summary', ''))}**")
-                                            st.error(f"❌ **Lỗi của bạn:** {_format_multistep_text(mistake.get('user_mistake', ''))}")
-                                            st.warning(f"⚠️ **Tại sao sai:** {_format_multistep_text(mistake.get('why_wrong', ''))}")
-                                            st.success(f"✅ **Cách đúng:** {_format_multistep_text(mistake.get('correct_approach', ''))}")
-                                            st.markdown("")
-                                    st.markdown("---")
-                                
-                                col1, col2 = st.columns(2)
-                                
-                                with col1:
-                                    # Lỗi phổ biến
-                                    if 'common_mistakes' in topic and topic['common_mistakes']:
-                                        st.markdown("### ⚠️ Lỗi phổ biến khác")
-                                        for mistake in topic['common_mistakes']:
-                                            st.write(f"• {_clean_html(mistake)}")
-                                        st.markdown("")
-                                    
-                                    # Mẹo tăng độ chính xác
-                                    if 'tips_for_accuracy' in topic and topic['tips_for_accuracy']:
-                                        st.markdown("### 🎯 Mẹo tăng tỷ lệ đúng")
-                                        for tip in topic['tips_for_accuracy']:
-                                            st.write(f"• {_clean_html(tip)}")
-                                        st.markdown("")
-                                    
-                                    # Bài tập thực hành
-                                    if 'practice_drills' in topic and topic['practice_drills']:
-                                        st.markdown("### 🧪 Bài tập luyện thêm")
-                                        for drill in topic['practice_drills']:
-                                            st.write(f"• {_clean_html(drill)}")
-                                
-                                with col2:
-                                    # Metric
-                                    st.metric("Tỉ lệ đúng", f"{accuracy:.0f}%", 
-                                             delta=f"{wrong} câu sai" if wrong > 0 else "Hoàn hảo!")
-                                    
-                                    # Mẹo tăng tốc độ
-                                    if 'tips_for_speed' in topic and topic['tips_for_speed']:
-                                        st.markdown("### ⚡ Mẹo tăng tốc độ")
-                                        for tip in topic['tips_for_speed']:
-                                            st.write(f"• {_clean_html(tip)}")
-                                        st.markdown("")
-                                    
-                                    # Công thức quan trọng
-                                    if 'key_formulas' in topic and topic['key_formulas']:
-                                        st.markdown("### 📐 Công thức cần nhớ")
-                                        for formula in topic['key_formulas']:
-                                            if isinstance(formula, dict):
-                                                # Format formula dict
-                                                formula_text = f"**{_clean_html(formula.get('formula', ''))}**\n\n"
-                                                if formula.get('explanation'):
-                                                    formula_text += f"*{_clean_html(formula['explanation'])}*\n\n"
-                                                if formula.get('usage'):
-                                                    formula_text += f"Sử dụng: {_clean_html(formula['usage'])}"
-                                                st.markdown(formula_text)
-                                            else:
-                                                    formula_txt = _clean_html(formula).replace('`', '')
-                                                    st.markdown(formula_txt)
+                            _render_topic_guide(topic)
                     else:
                         st.warning("Không có dữ liệu ôn tập")
             
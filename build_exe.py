@@ -71,6 +71,15 @@ def build_exe(console: bool = False):
         "--add-data=ai_logic.py;.",  # Thêm ai_logic.py
         "--add-data=db.py;.",  # Thêm db.py
         "--add-data=study_guide.py;.",  # Thêm study_guide.py
+        "--add-data=exam_pool.py;.",  # Thêm exam_pool.py
+        "--add-data=rate_limiter.py;.",  # Thêm rate_limiter.py
+        "--add-data=gemini_async.py;.",  # Thêm gemini_async.py
+        "--add-data=json_stream.py;.",  # Thêm json_stream.py
+        "--add-data=schemas.py;.",  # Thêm schemas.py
+        "--add-data=llm_cache.py;.",  # Thêm llm_cache.py
+        "--add-data=prompts.py;.",  # Thêm prompts.py
+        "--add-data=model_router.py;.",  # Thêm model_router.py
+        "--add-data=write_behind.py;.",  # Thêm write_behind.py
         "--add-data=.env;.",  # Thêm file .env (nếu có)
         "--add-data=.streamlit;.streamlit",  # Thêm thư mục .streamlit với cấu hình
         "--hidden-import=streamlit",
@@ -1,7 +1,14 @@
 import os
 import json
+import atexit
+import time
 import hashlib
+import pathlib
+import random
+import re
 import sqlite3
+import threading
+import unicodedata
 from typing import List, Dict, Any, Optional
 from contextlib import contextmanager
 from dotenv import load_dotenv
@@ -22,352 +29,1016 @@ try:
 except ImportError:
     PSYCOPG2_AVAILABLE = False
 
+# Path to Supabase CA certificate
+_CA_CERT_PATH = pathlib.Path(__file__).parent / "supabase-ca.crt"
+
+def _get_config(key: str, default: Any = None) -> Any:
+    """Lấy biến từ os.environ (Azure) hoặc st.secrets (Streamlit Cloud)"""
+    value = os.getenv(key)
+    if value:
+        return value
+    try:
+        return st.secrets.get(key, default)
+    except Exception:
+        # Không có secrets.toml (chạy local/script) -> dùng default
+        return default
+
+def _get_int_config(key: str, default: int) -> int:
+    try:
+        return int(_get_config(key, default))
+    except (TypeError, ValueError):
+        return default
+
+# --- CẤU HÌNH CONNECTION POOL ---
+# DB_POOL_MIN / DB_POOL_MAX: số kết nối idle giữ sẵn / tối đa cho mỗi process
+# DB_POOL_TIMEOUT: số giây chờ tối đa khi pool đã dùng hết kết nối
+# DB_POOL_HEALTHCHECK_SECONDS: kết nối idle lâu hơn ngưỡng này sẽ được "ping" trước khi dùng
+_pool: Optional["pool.ThreadedConnectionPool"] = None
+_pool_slots: Optional[threading.BoundedSemaphore] = None
+_pool_lock = threading.Lock()
+_backend_lock = threading.Lock()
+_stats_lock = threading.Lock()
+_pool_last_used: Dict[int, float] = {}
+_pool_stats = {
+    'checkouts': 0,
+    'in_use': 0,
+    'connections_opened': 0,
+    'connections_discarded': 0,
+    'health_check_failures': 0,
+    'wait_seconds_total': 0.0,
+}
+
+# DB_RETRY_SECONDS: chu kỳ thử lại PostgreSQL khi đang fallback SQLite
+_retry_thread: Optional[threading.Thread] = None
+_retry_stop = threading.Event()
+
+# SQLite fallback: 1 kết nối dùng chung (WAL mode), tuần tự hóa bằng lock
+_sqlite_conn: Optional[sqlite3.Connection] = None
+_sqlite_lock = threading.RLock()
+
+def _postgres_connect_kwargs() -> Dict[str, Any]:
+    """Tham số kết nối PostgreSQL (SSL + TCP keepalive)"""
+    return dict(
+        host=_get_config("DB_HOST"),
+        database=_get_config("DB_NAME"),
+        user=_get_config("DB_USER"),
+        password=_get_config("DB_PASSWORD"),
+        port=_get_config("DB_PORT"),
+        sslmode='require',
+        sslrootcert=str(_CA_CERT_PATH),
+        # Giới hạn thời gian bắt tay để cold start không bị treo khi DB không tới được
+        connect_timeout=_get_int_config("DB_CONNECT_TIMEOUT", 5),
+        # TCP keepalive để phát hiện socket chết (Supabase pooler hay cắt kết nối idle)
+        keepalives=1,
+        keepalives_idle=30,
+        keepalives_interval=10,
+        keepalives_count=3
+    )
+
+if PSYCOPG2_AVAILABLE:
+    class _CountingPool(pool.ThreadedConnectionPool):
+        """ThreadedConnectionPool có đếm số kết nối thật sự được mở"""
+        def _connect(self, key=None):
+            conn = super()._connect(key)
+            with _stats_lock:
+                _pool_stats['connections_opened'] += 1
+            return conn
+
 # --- CẤU HÌNH KẾT NỐI DATABASE ---
 def _get_db_type():
-    """Xác định loại database đang sử dụng"""
+    """Xác định loại database đang sử dụng.
+    
+    Không mở kết nối thử riêng: khởi tạo pool chính là bước kiểm tra PostgreSQL.
+    Nếu thất bại thì tạm dùng SQLite và thử lại PostgreSQL ở background.
+    """
     global _db_type
     if _db_type is not None:
         return _db_type
     
-    # Helper để lấy biến từ os.environ hoặc st.secrets
-    def get_config(key):
-        return os.getenv(key) or st.secrets.get(key)
-    
-    # Kiểm tra nếu có DB_HOST và psycopg2 available
-    if PSYCOPG2_AVAILABLE and get_config("DB_HOST"):
+    with _backend_lock:
+        if _db_type is not None:
+            return _db_type
+        started = time.monotonic()
+        
+        # Kiểm tra nếu có DB_HOST và psycopg2 available
+        if _postgres_configured():
+            try:
+                _get_pool()
+                _db_type = "postgresql"
+            except Exception as e:
+                print(f"⚠️ PostgreSQL connection failed: {e}")
+                print("📁 Fallback to SQLite for local development")
+                _db_type = "sqlite"
+                _start_backend_retry()
+        else:
+            _db_type = "sqlite"
+        
+        print(f"🗄️ Database backend: {_db_type} (ready in {(time.monotonic() - started) * 1000:.0f} ms)")
+    return _db_type
+
+def _postgres_configured() -> bool:
+    return PSYCOPG2_AVAILABLE and bool(_get_config("DB_HOST"))
+
+def _create_pool():
+    """Tạo pool mới và kiểm tra có mượn được kết nối (timeout DB_CONNECT_TIMEOUT)"""
+    minconn = max(0, _get_int_config("DB_POOL_MIN", 2))
+    maxconn = max(1, minconn, _get_int_config("DB_POOL_MAX", 10))
+    new_pool = _CountingPool(minconn, maxconn, **_postgres_connect_kwargs())
+    try:
+        # minconn = 0 thì pool chưa mở kết nối nào -> mượn thử 1 kết nối
+        probe = new_pool.getconn()
+        _pool_last_used[id(probe)] = time.monotonic()
+        new_pool.putconn(probe)
+    except Exception:
+        new_pool.closeall()
+        raise
+    print(f"🔌 PostgreSQL pool ready (min={minconn}, max={maxconn})")
+    return new_pool
+
+def _get_pool():
+    """Khởi tạo (lazy) connection pool dùng chung cho cả process"""
+    global _pool, _pool_slots
+    if _pool is not None:
+        return _pool
+    with _pool_lock:
+        if _pool is None:
+            new_pool = _create_pool()
+            # ThreadedConnectionPool báo lỗi ngay khi hết kết nối -> semaphore để chờ thay vì lỗi
+            _pool_slots = threading.BoundedSemaphore(new_pool.maxconn)
+            _pool = new_pool
+    return _pool
+
+def _start_backend_retry():
+    """Thread nền: thử kết nối lại PostgreSQL, thành công thì chuyển backend từ SQLite sang"""
+    global _retry_thread
+    if _retry_thread is not None and _retry_thread.is_alive():
+        return
+    _retry_thread = threading.Thread(target=_backend_retry_loop, name="db-backend-retry", daemon=True)
+    _retry_thread.start()
+
+def _backend_retry_loop():
+    global _db_type
+    delay = max(1, _get_int_config("DB_RETRY_SECONDS", 30))
+    while not _retry_stop.wait(delay):
+        started = time.monotonic()
         try:
-            # Path to Supabase CA certificate
-            import pathlib
-            ca_cert_path = pathlib.Path(__file__).parent / "supabase-ca.crt"
-            
-            # Test connection with SSL
-            conn = psycopg2.connect(
-                host=get_config("DB_HOST"),
-                database=get_config("DB_NAME"),
-                user=get_config("DB_USER"),
-                password=get_config("DB_PASSWORD"),
-                port=get_config("DB_PORT"),
-                sslmode='require',
-                sslrootcert=str(ca_cert_path)
-            )
-            conn.close()
+            _get_pool()
+        except Exception as e:
+            delay = min(delay * 2, 300)
+            print(f"⚠️ PostgreSQL still unreachable, retry in {delay}s: {e}")
+            continue
+        with _backend_lock:
             _db_type = "postgresql"
-            return _db_type
+        print(f"🗄️ Database backend promoted: sqlite -> postgresql ({(time.monotonic() - started) * 1000:.0f} ms)")
+        print("ℹ️ Dữ liệu ghi vào SQLite trong lúc fallback không được chuyển sang PostgreSQL")
+        try:
+            init_db()
         except Exception as e:
-            print(f"⚠️ PostgreSQL connection failed: {e}")
-            print("📁 Fallback to SQLite for local development")
-    
-    _db_type = "sqlite"
-    return _db_type
+            print(f"⚠️ init_db after promotion failed: {e}")
+        return
+
+def _is_healthy(conn) -> bool:
+    """Kiểm tra kết nối trước khi cho mượn: socket đã đóng hoặc idle lâu thì ping lại"""
+    if conn.closed:
+        return False
+    last_used = _pool_last_used.get(id(conn))
+    if last_used is None:
+        return True  # Kết nối vừa mở
+    if time.monotonic() - last_used < _get_int_config("DB_POOL_HEALTHCHECK_SECONDS", 30):
+        return True
+    try:
+        c = conn.cursor()
+        c.execute("SELECT 1")
+        c.fetchone()
+        conn.rollback()
+        return True
+    except Exception as e:
+        print(f"⚠️ Stale DB connection dropped: {e}")
+        with _stats_lock:
+            _pool_stats['health_check_failures'] += 1
+        return False
+
+def _checkout_postgres():
+    db_pool = _get_pool()
+    timeout = _get_int_config("DB_POOL_TIMEOUT", 30)
+    started = time.monotonic()
+    if not _pool_slots.acquire(timeout=timeout):
+        raise pool.PoolError(f"Connection pool exhausted (waited {timeout}s)")
+    try:
+        # Bỏ các kết nối chết (server đóng/timeout) cho tới khi có kết nối dùng được
+        for _ in range(db_pool.maxconn + 1):
+            conn = db_pool.getconn()
+            if _is_healthy(conn):
+                break
+            _discard_postgres(conn)
+        else:
+            raise pool.PoolError("No healthy database connection available")
+    except Exception:
+        _pool_slots.release()
+        raise
+    with _stats_lock:
+        _pool_stats['checkouts'] += 1
+        _pool_stats['in_use'] += 1
+        _pool_stats['wait_seconds_total'] += time.monotonic() - started
+    return conn
+
+def _discard_postgres(conn):
+    _pool_last_used.pop(id(conn), None)
+    with _stats_lock:
+        _pool_stats['connections_discarded'] += 1
+    try:
+        _pool.putconn(conn, close=True)
+    except Exception:
+        pass
+
+def _release_postgres(conn, broken: bool = False):
+    try:
+        # Dọn transaction chưa commit (trước đây conn.close() tự rollback)
+        if not broken and not conn.closed and \
+                conn.get_transaction_status() != psycopg2.extensions.TRANSACTION_STATUS_IDLE:
+            conn.rollback()
+    except Exception:
+        broken = True
+    try:
+        if broken or conn.closed:
+            _discard_postgres(conn)
+        else:
+            _pool_last_used[id(conn)] = time.monotonic()
+            _pool.putconn(conn)
+            if conn.closed:
+                # Pool chỉ giữ tối đa DB_POOL_MIN kết nối idle, phần dư bị đóng
+                _pool_last_used.pop(id(conn), None)
+    finally:
+        _pool_slots.release()
+        with _stats_lock:
+            _pool_stats['in_use'] -= 1
+
+def _get_sqlite_conn() -> sqlite3.Connection:
+    """Kết nối SQLite dùng chung (WAL mode) - gọi khi đang giữ _sqlite_lock"""
+    global _sqlite_conn
+    if _sqlite_conn is None:
+        conn = sqlite3.connect(_db_path, check_same_thread=False, timeout=30)
+        conn.row_factory = sqlite3.Row
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        _sqlite_conn = conn
+    return _sqlite_conn
 
 def get_db_connection():
-    """Lấy kết nối database (PostgreSQL hoặc SQLite)"""
-    # Helper để lấy biến từ os.environ (Azure) hoặc st.secrets (Streamlit Cloud)
-    def get_config(key):
-        return os.getenv(key) or st.secrets.get(key)
+    """Mượn kết nối database (PostgreSQL pool hoặc SQLite dùng chung).
     
+    Phải trả lại bằng release_db_connection() - ưu tiên dùng get_conn().
+    """
     db_type = _get_db_type()
     
     if db_type == "postgresql":
         try:
-            # Path to Supabase CA certificate
-            import pathlib
-            ca_cert_path = pathlib.Path(__file__).parent / "supabase-ca.crt"
-            
-            return psycopg2.connect(
-                host=get_config("DB_HOST"),
-                database=get_config("DB_NAME"),
-                user=get_config("DB_USER"),
-                password=get_config("DB_PASSWORD"),
-                port=get_config("DB_PORT"),
-                sslmode='require',
-                sslrootcert=str(ca_cert_path)
-            )
+            return _checkout_postgres()
         except Exception as e:
             print(f"❌ DB Connection Error: {e}")
             raise e
     else:
-        # SQLite fallback
-        return sqlite3.connect(_db_path, check_same_thread=False)
+        # SQLite fallback: tuần tự hóa truy cập vào kết nối dùng chung
+        _sqlite_lock.acquire()
+        try:
+            conn = _get_sqlite_conn()
+        except Exception:
+            _sqlite_lock.release()
+            raise
+        with _stats_lock:
+            _pool_stats['checkouts'] += 1
+            _pool_stats['in_use'] += 1
+        return conn
+
+def release_db_connection(conn, broken: bool = False):
+    """Trả kết nối về pool; broken=True để đóng hẳn kết nối lỗi"""
+    if isinstance(conn, sqlite3.Connection):
+        try:
+            if conn.in_transaction:
+                conn.rollback()
+        finally:
+            with _stats_lock:
+                _pool_stats['in_use'] -= 1
+            _sqlite_lock.release()
+    else:
+        _release_postgres(conn, broken=broken)
 
 @contextmanager
 def get_conn():
-    """Context manager for database connections"""
+    """Context manager for database connections (pooled)"""
     conn = get_db_connection()
+    broken = False
     try:
         yield conn
-    except Exception:
-        conn.rollback()
+    except Exception as e:
+        if PSYCOPG2_AVAILABLE and isinstance(e, (psycopg2.OperationalError, psycopg2.InterfaceError)):
+            broken = True  # Socket hỏng -> không trả lại pool
+        try:
+            conn.rollback()
+        except Exception:
+            broken = True
         raise
     finally:
-        conn.close()
+        release_db_connection(conn, broken=broken)
 
-def init_db():
-    """Khởi tạo bảng database (PostgreSQL hoặc SQLite)"""
+def get_pool_stats() -> Dict[str, Any]:
+    """Số liệu connection pool (giám sát/hiển thị debug)"""
+    with _stats_lock:
+        stats = dict(_pool_stats)
+    stats['backend'] = _db_type or 'unknown'
+    if _pool is not None:
+        stats['min_size'] = _pool.minconn
+        stats['max_size'] = _pool.maxconn
+        stats['idle'] = len(getattr(_pool, '_pool', []))
+    return stats
+
+def close_pool():
+    """Đóng toàn bộ kết nối (gọi khi tắt process)"""
+    global _pool, _sqlite_conn
+    _retry_stop.set()
+    with _pool_lock:
+        if _pool is not None:
+            _pool.closeall()
+            _pool = None
+            _pool_last_used.clear()
+    with _sqlite_lock:
+        if _sqlite_conn is not None:
+            _sqlite_conn.close()
+            _sqlite_conn = None
+
+atexit.register(close_pool)
+
+# --- SCHEMA MIGRATIONS ---
+# Mỗi migration chạy đúng 1 lần cho mỗi database và được ghi vào bảng schema_migrations.
+# Thay đổi schema mới: viết hàm _migration_xxx(c, db_type) (idempotent) và thêm vào _MIGRATIONS.
+_MIGRATION_LOCK_ID = 731_004  # pg_advisory_lock: tránh 2 process migrate cùng lúc
+_schema_ready: set = set()
+_schema_lock = threading.Lock()
+
+def _migration_initial_schema(c, db_type: str):
+    """Bảng questions, user_wrong_answers, study_guide_cache"""
+    if db_type == "postgresql":
+        # PostgreSQL dùng SERIAL cho auto-increment
+        c.execute(
+            """
+            CREATE TABLE IF NOT EXISTS questions (
+                id SERIAL PRIMARY KEY,
+                qhash TEXT UNIQUE,
+                question TEXT NOT NULL,
+                options TEXT,
+                correct_answer TEXT,
+                explanation TEXT,
+                image_url TEXT,
+                topic TEXT,
+                qtype TEXT,
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            );
+            """
+        )
+        c.execute("CREATE INDEX IF NOT EXISTS idx_created_at ON questions(created_at DESC);")
+        c.execute("CREATE INDEX IF NOT EXISTS idx_qtype ON questions(qtype);")
+        
+        # Bảng thống kê câu trả lời sai của user
+        c.execute(
+            """
+            CREATE TABLE IF NOT EXISTS user_wrong_answers (
+                id SERIAL PRIMARY KEY,
+                user_id TEXT NOT NULL,
+                topic TEXT NOT NULL,
+                qtype TEXT,
+                wrong_count INTEGER DEFAULT 1,
+                last_wrong_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                UNIQUE(user_id, topic)
+            );
+            """
+        )
+        c.execute("CREATE INDEX IF NOT EXISTS idx_user_topic ON user_wrong_answers(user_id, topic);")
+        
+        # Bảng cache AI study guide responses
+        c.execute(
+            """
+            CREATE TABLE IF NOT EXISTS study_guide_cache (
+                id SERIAL PRIMARY KEY,
+                topic TEXT NOT NULL UNIQUE,
+                guide_data JSONB NOT NULL,
+                version INTEGER DEFAULT 1,
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                accessed_count INTEGER DEFAULT 0,
+                last_accessed_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            );
+            """
+        )
+        c.execute("CREATE INDEX IF NOT EXISTS idx_topic_cache ON study_guide_cache(topic);")
+    else:
+        # SQLite
+        c.execute(
+            """
+            CREATE TABLE IF NOT EXISTS questions (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                qhash TEXT UNIQUE,
+                question TEXT NOT NULL,
+                options TEXT,
+                correct_answer TEXT,
+                explanation TEXT,
+                image_url TEXT,
+                topic TEXT,
+                qtype TEXT,
+                created_at DATETIME DEFAULT CURRENT_TIMESTAMP
+            );
+            """
+        )
+        c.execute("CREATE INDEX IF NOT EXISTS idx_created_at ON questions(created_at DESC);")
+        c.execute("CREATE INDEX IF NOT EXISTS idx_qtype ON questions(qtype);")
+        
+        # Bảng thống kê câu trả lời sai của user
+        c.execute(
+            """
+            CREATE TABLE IF NOT EXISTS user_wrong_answers (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                user_id TEXT NOT NULL,
+                topic TEXT NOT NULL,
+                qtype TEXT,
+                wrong_count INTEGER DEFAULT 1,
+                last_wrong_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+                UNIQUE(user_id, topic)
+            );
+            """
+        )
+        c.execute("CREATE INDEX IF NOT EXISTS idx_user_topic ON user_wrong_answers(user_id, topic);")
+        
+        # Bảng cache AI study guide responses
+        c.execute(
+            """
+            CREATE TABLE IF NOT EXISTS study_guide_cache (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                topic TEXT NOT NULL UNIQUE,
+                guide_data TEXT NOT NULL,
+                version INTEGER DEFAULT 1,
+                created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+                updated_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+                accessed_count INTEGER DEFAULT 0,
+                last_accessed_at DATETIME DEFAULT CURRENT_TIMESTAMP
+            );
+            """
+        )
+        c.execute("CREATE INDEX IF NOT EXISTS idx_topic_cache ON study_guide_cache(topic);")
+
+def _add_column_if_missing(c, db_type: str, table: str, column: str, ddl: str):
+    if db_type == "postgresql":
+        c.execute(f"ALTER TABLE {table} ADD COLUMN IF NOT EXISTS {column} {ddl}")
+    else:
+        c.execute(f"PRAGMA table_info({table})")
+        if column not in [row[1] for row in c.fetchall()]:
+            c.execute(f"ALTER TABLE {table} ADD COLUMN {column} {ddl}")
+
+def _migration_cache_versioning(c, db_type: str):
+    """Thêm version/updated_at cho study_guide_cache (database tạo trước khi có 2 cột này)"""
+    _add_column_if_missing(c, db_type, 'study_guide_cache', 'version', 'INTEGER DEFAULT 1')
+    # SQLite không cho ADD COLUMN với default không phải hằng số
+    updated_at_ddl = 'TIMESTAMP DEFAULT CURRENT_TIMESTAMP' if db_type == "postgresql" else 'DATETIME'
+    _add_column_if_missing(c, db_type, 'study_guide_cache', 'updated_at', updated_at_ddl)
+    c.execute("CREATE INDEX IF NOT EXISTS idx_version_cache ON study_guide_cache(version DESC);")
+
+def _migration_question_rand_key(c, db_type: str):
+    """Cột rand_key (ngẫu nhiên cố định mỗi câu) + index để lấy mẫu ngẫu nhiên không cần ORDER BY RANDOM()"""
+    if db_type == "postgresql":
+        _add_column_if_missing(c, db_type, 'questions', 'rand_key', 'DOUBLE PRECISION DEFAULT random()')
+        c.execute("UPDATE questions SET rand_key = random() WHERE rand_key IS NULL;")
+    else:
+        # SQLite không cho ADD COLUMN với default là biểu thức -> save_questions tự gán rand_key
+        _add_column_if_missing(c, db_type, 'questions', 'rand_key', 'REAL')
+        c.execute("UPDATE questions SET rand_key = abs(random()) / 9223372036854775808.0 WHERE rand_key IS NULL;")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_rand_key ON questions(rand_key);")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_topic_qtype_rand ON questions(topic, qtype, rand_key);")
+
+def _migration_topic_rand_index(c, db_type: str):
+    """Index (topic, rand_key) cho lấy mẫu theo topic không lọc qtype"""
+    c.execute("CREATE INDEX IF NOT EXISTS idx_topic_rand ON questions(topic, rand_key);")
+
+def _migration_exam_pool(c, db_type: str):
+    """Bảng exam_pool: các bộ câu hỏi AI sinh sẵn (exam_pool.py), lấy ra khi user tạo đề"""
+    if db_type == "postgresql":
+        c.execute(
+            """
+            CREATE TABLE IF NOT EXISTS exam_pool (
+                id SERIAL PRIMARY KEY,
+                questions JSONB NOT NULL,
+                num_questions INTEGER NOT NULL,
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            );
+            """
+        )
+    else:
+        c.execute(
+            """
+            CREATE TABLE IF NOT EXISTS exam_pool (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                questions TEXT NOT NULL,
+                num_questions INTEGER NOT NULL,
+                created_at DATETIME DEFAULT CURRENT_TIMESTAMP
+            );
+            """
+        )
+
+def _migration_rate_limit_buckets(c, db_type: str):
+    """Bucket rate limit dùng chung giữa các process (rate_limiter.py, GEMINI_RATE_LIMIT_SHARED)"""
+    real = "DOUBLE PRECISION" if db_type == "postgresql" else "REAL"
+    c.execute(
+        f"""
+        CREATE TABLE IF NOT EXISTS rate_limit_buckets (
+            name TEXT PRIMARY KEY,
+            requests {real} NOT NULL,
+            tokens {real} NOT NULL,
+            updated_at {real} NOT NULL,
+            blocked_until {real} NOT NULL DEFAULT 0
+        );
+        """
+    )
+
+def _migration_llm_response_cache(c, db_type: str):
+    """Cache response Gemini theo (model, prompt, config) - llm_cache.py"""
+    real = "DOUBLE PRECISION" if db_type == "postgresql" else "REAL"
+    c.execute(
+        f"""
+        CREATE TABLE IF NOT EXISTS llm_response_cache (
+            cache_key TEXT PRIMARY KEY,
+            model TEXT NOT NULL,
+            response_text TEXT NOT NULL,
+            size_bytes INTEGER NOT NULL,
+            created_at {real} NOT NULL,
+            expires_at {real} NOT NULL,
+            last_hit_at {real},
+            hits INTEGER NOT NULL DEFAULT 0
+        );
+        """
+    )
+    c.execute("CREATE INDEX IF NOT EXISTS idx_llm_cache_expires ON llm_response_cache(expires_at);")
+
+def _migration_question_fingerprint(c, db_type: str):
+    """Cột fingerprint (question_fingerprint) + unique index: khóa chống trùng chung cho DB và đề thi"""
+    _add_column_if_missing(c, db_type, 'questions', 'fingerprint', 'TEXT')
+    c.execute("SELECT id, question, options, correct_answer FROM questions WHERE fingerprint IS NULL ORDER BY id")
+    seen = set()
+    updates = []
+    for row_id, question, options, correct_answer in c.fetchall():
+        try:
+            opts = json.loads(options) if options else []
+        except (json.JSONDecodeError, TypeError):
+            opts = []
+        fp = question_fingerprint({'question': question, 'options': opts, 'correct_answer': correct_answer})
+        # Câu cũ trùng nhau theo fingerprint mới: giữ câu đầu tiên, các câu sau để NULL
+        # (mọi truy vấn lấy câu cho đề lọc fingerprint IS NOT NULL - xem _exclude_fingerprints_sql)
+        if fp not in seen:
+            seen.add(fp)
+            updates.append((row_id, fp))
+    if updates:
+        if db_type == "postgresql":
+            extras.execute_values(
+                c,
+                "UPDATE questions AS q SET fingerprint = v.fp FROM (VALUES %s) AS v(id, fp) WHERE q.id = v.id",
+                updates,
+                page_size=_INSERT_PAGE_SIZE
+            )
+        else:
+            c.executemany("UPDATE questions SET fingerprint = ? WHERE id = ?", [(fp, row_id) for row_id, fp in updates])
+    c.execute("CREATE UNIQUE INDEX IF NOT EXISTS idx_questions_fingerprint ON questions(fingerprint);")
+
+_MIGRATIONS = [
+    (1, 'initial_schema', _migration_initial_schema),
+    (2, 'study_guide_cache_versioning', _migration_cache_versioning),
+    (3, 'question_rand_key', _migration_question_rand_key),
+    (4, 'topic_rand_index', _migration_topic_rand_index),
+    (5, 'exam_pool', _migration_exam_pool),
+    (6, 'rate_limit_buckets', _migration_rate_limit_buckets),
+    (7, 'llm_response_cache', _migration_llm_response_cache),
+    (8, 'question_fingerprint', _migration_question_fingerprint),
+]
+
+def run_migrations() -> List[int]:
+    """Áp dụng các migration chưa chạy theo thứ tự, trả về các version vừa áp dụng"""
     db_type = _get_db_type()
+    ph = "%s" if db_type == "postgresql" else "?"
+    applied: List[int] = []
     
     with get_conn() as conn:
         c = conn.cursor()
-        if db_type == "postgresql":
-            # PostgreSQL dùng SERIAL cho auto-increment
-            c.execute(
-                """
-                CREATE TABLE IF NOT EXISTS questions (
-                    id SERIAL PRIMARY KEY,
-                    qhash TEXT UNIQUE,
-                    question TEXT NOT NULL,
-                    options TEXT,
-                    correct_answer TEXT,
-                    explanation TEXT,
-                    image_url TEXT,
-                    topic TEXT,
-                    qtype TEXT,
-                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-                );
-                """
-            )
-            c.execute("CREATE INDEX IF NOT EXISTS idx_created_at ON questions(created_at DESC);")
-            c.execute("CREATE INDEX IF NOT EXISTS idx_qtype ON questions(qtype);")
-            
-            # Bảng thống kê câu trả lời sai của user
-            c.execute(
-                """
-                CREATE TABLE IF NOT EXISTS user_wrong_answers (
-                    id SERIAL PRIMARY KEY,
-                    user_id TEXT NOT NULL,
-                    topic TEXT NOT NULL,
-                    qtype TEXT,
-                    wrong_count INTEGER DEFAULT 1,
-                    last_wrong_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                    UNIQUE(user_id, topic)
-                );
-                """
-            )
-            c.execute("CREATE INDEX IF NOT EXISTS idx_user_topic ON user_wrong_answers(user_id, topic);")
-            
-            # Bảng cache AI study guide responses
-            c.execute(
-                """
-                CREATE TABLE IF NOT EXISTS study_guide_cache (
-                    id SERIAL PRIMARY KEY,
-                    topic TEXT NOT NULL UNIQUE,
-                    guide_data JSONB NOT NULL,
-                    version INTEGER DEFAULT 1,
-                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                    updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                    accessed_count INTEGER DEFAULT 0,
-                    last_accessed_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-                );
-                """
-            )
-            c.execute("CREATE INDEX IF NOT EXISTS idx_topic_cache ON study_guide_cache(topic);")
-            c.execute("CREATE INDEX IF NOT EXISTS idx_version_cache ON study_guide_cache(version DESC);")
-        else:
-            # SQLite
-            c.execute(
-                """
-                CREATE TABLE IF NOT EXISTS questions (
-                    id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    qhash TEXT UNIQUE,
-                    question TEXT NOT NULL,
-                    options TEXT,
-                    correct_answer TEXT,
-                    explanation TEXT,
-                    image_url TEXT,
-                    topic TEXT,
-                    qtype TEXT,
-                    created_at DATETIME DEFAULT CURRENT_TIMESTAMP
-                );
-                """
-            )
-            c.execute("CREATE INDEX IF NOT EXISTS idx_created_at ON questions(created_at DESC);")
-            c.execute("CREATE INDEX IF NOT EXISTS idx_qtype ON questions(qtype);")
-            
-            # Bảng thống kê câu trả lời sai của user
-            c.execute(
-                """
-                CREATE TABLE IF NOT EXISTS user_wrong_answers (
-                    id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    user_id TEXT NOT NULL,
-                    topic TEXT NOT NULL,
-                    qtype TEXT,
-                    wrong_count INTEGER DEFAULT 1,
-                    last_wrong_at DATETIME DEFAULT CURRENT_TIMESTAMP,
-                    UNIQUE(user_id, topic)
-                );
-                """
-            )
-            c.execute("CREATE INDEX IF NOT EXISTS idx_user_topic ON user_wrong_answers(user_id, topic);")
-            
-            # Bảng cache AI study guide responses
-            c.execute(
-                """
-                CREATE TABLE IF NOT EXISTS study_guide_cache (
-                    id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    topic TEXT NOT NULL UNIQUE,
-                    guide_data TEXT NOT NULL,
-                    version INTEGER DEFAULT 1,
-                    created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
-                    updated_at DATETIME DEFAULT CURRENT_TIMESTAMP,
-                    accessed_count INTEGER DEFAULT 0,
-                    last_accessed_at DATETIME DEFAULT CURRENT_TIMESTAMP
-                );
-                """
-            )
-            c.execute("CREATE INDEX IF NOT EXISTS idx_topic_cache ON study_guide_cache(topic);")
-            c.execute("CREATE INDEX IF NOT EXISTS idx_version_cache ON study_guide_cache(version DESC);")
+        c.execute(
+            """
+            CREATE TABLE IF NOT EXISTS schema_migrations (
+                version INTEGER PRIMARY KEY,
+                name TEXT NOT NULL,
+                applied_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            );
+            """
+        )
         conn.commit()
+        if db_type == "postgresql":
+            c.execute("SELECT pg_advisory_lock(%s)", (_MIGRATION_LOCK_ID,))
+        try:
+            c.execute("SELECT version FROM schema_migrations")
+            done = {row[0] for row in c.fetchall()}
+            for version, name, migrate in _MIGRATIONS:
+                if version in done:
+                    continue
+                try:
+                    migrate(c, db_type)
+                    c.execute(
+                        f"INSERT INTO schema_migrations (version, name) VALUES ({ph}, {ph})",
+                        (version, name)
+                    )
+                    conn.commit()
+                except Exception:
+                    conn.rollback()
+                    raise
+                applied.append(version)
+                print(f"🛠️ Applied migration {version:03d}_{name}")
+        finally:
+            if db_type == "postgresql":
+                c.execute("SELECT pg_advisory_unlock(%s)", (_MIGRATION_LOCK_ID,))
+                conn.commit()
+    return applied
 
-def _hash_question(q: Dict[str, Any]) -> str:
-    base = (q.get('question','') + '|' + q.get('correct_answer','')).strip().lower()
+def get_schema_version() -> int:
+    """Version migration cao nhất đã áp dụng (0 nếu chưa có)"""
+    with get_conn() as conn:
+        c = conn.cursor()
+        try:
+            c.execute("SELECT MAX(version) FROM schema_migrations")
+        except Exception:
+            return 0
+        row = c.fetchone()
+        return (row[0] or 0) if row else 0
+
+def init_db():
+    """Khởi tạo/migrate schema - chỉ chạy 1 lần mỗi process (cho mỗi backend).
+    
+    Streamlit chạy lại script ở mỗi lần tương tác; các lần gọi sau không chạm vào database.
+    """
+    db_type = _get_db_type()
+    if db_type in _schema_ready:
+        return
+    with _schema_lock:
+        if db_type in _schema_ready:
+            return
+        started = time.monotonic()
+        applied = run_migrations()
+        _schema_ready.add(db_type)
+        print(f"✅ Schema ready on {db_type} ({len(applied)} migration(s) applied, {(time.monotonic() - started) * 1000:.0f} ms)")
+
+_OPTION_PREFIX = re.compile(r'^\s*\(?[A-Ea-e][\.\):]\s+')
+
+def _normalize_text(text: Any) -> str:
+    """Chữ thường, bỏ dấu tiếng Việt, gộp khoảng trắng"""
+    text = unicodedata.normalize('NFKD', str(text or '')).replace('đ', 'd').replace('Đ', 'D')
+    text = ''.join(ch for ch in text if not unicodedata.combining(ch))
+    return ' '.join(text.lower().split())
+
+def question_fingerprint(q: Dict[str, Any]) -> str:
+    """Khóa chống trùng câu hỏi: không phân biệt khoảng trắng, dấu, hoa/thường và thứ tự options.
+
+    Lưu ở cột questions.fingerprint (unique index); generate_full_exam cũng dùng khóa
+    này để loại câu trùng trong đề.
+    """
+    options = sorted(_normalize_text(_OPTION_PREFIX.sub('', str(o))) for o in (q.get('options') or []))
+    correct = _normalize_text(_OPTION_PREFIX.sub('', str(q.get('correct_answer') or '')))
+    base = '\x1f'.join([_normalize_text(q.get('question')), correct] + options)
     return hashlib.sha256(base.encode('utf-8')).hexdigest()
 
+def _hash_question(q: Dict[str, Any]) -> str:
+    # qhash của câu mới = fingerprint; câu lưu trước migration 8 giữ qhash cũ
+    return question_fingerprint(q)
+
+# Số dòng mỗi câu lệnh INSERT nhiều giá trị (PostgreSQL execute_values)
+_INSERT_PAGE_SIZE = 500
+
+def _question_row(q: Dict[str, Any]) -> tuple:
+    fp = question_fingerprint(q)
+    return (
+        fp,
+        fp,
+        q.get('question', ''),
+        json.dumps(q.get('options', []), ensure_ascii=False),
+        q.get('correct_answer'),
+        q.get('explanation'),
+        q.get('image_url'),
+        q.get('topic'),
+        q.get('type'),
+        random.random()
+    )
+
 def save_questions(questions: List[Dict[str, Any]]) -> int:
+    """Lưu nhiều câu hỏi trong 1 transaction, trả về số câu MỚI được thêm (bỏ qua câu trùng fingerprint)"""
     if not questions:
         return 0
     
+    # Loại câu trùng ngay trong batch trước khi gửi xuống DB
+    rows_by_hash = {}
+    for q in questions:
+        row = _question_row(q)
+        rows_by_hash.setdefault(row[0], row)
+    rows = list(rows_by_hash.values())
+    
     db_type = _get_db_type()
-    saved = 0
     
     with get_conn() as conn:
         c = conn.cursor()
-        for q in questions:
-            qhash = _hash_question(q)
-            options_json = json.dumps(q.get('options', []), ensure_ascii=False)
-            
-            if db_type == "postgresql":
-                # PostgreSQL: dùng %s và ON CONFLICT
-                c.execute(
-                    """
-                    INSERT INTO questions (qhash, question, options, correct_answer, explanation, image_url, topic, qtype)
-                    VALUES (%s, %s, %s, %s, %s, %s, %s, %s)
-                    ON CONFLICT (qhash) DO NOTHING
-                    """,
-                    (
-                        qhash,
-                        q.get('question', ''),
-                        options_json,
-                        q.get('correct_answer'),
-                        q.get('explanation'),
-                        q.get('image_url'),
-                        q.get('topic'),
-                        q.get('type')
-                    )
-                )
-                # psycopg2: kiểm tra rowcount để xác định insert thành công
-                if c.rowcount > 0:
-                    saved += 1
-            else:
-                # SQLite: dùng ? và INSERT OR IGNORE
-                c.execute(
-                    """
-                    INSERT OR IGNORE INTO questions (qhash, question, options, correct_answer, explanation, image_url, topic, qtype)
-                    VALUES (?, ?, ?, ?, ?, ?, ?, ?)
-                    """,
-                    (
-                        qhash,
-                        q.get('question', ''),
-                        options_json,
-                        q.get('correct_answer'),
-                        q.get('explanation'),
-                        q.get('image_url'),
-                        q.get('topic'),
-                        q.get('type')
-                    )
-                )
-                if c.rowcount > 0:
-                    saved += 1
+        if db_type == "postgresql":
+            # PostgreSQL: 1 câu INSERT nhiều dòng mỗi trang, RETURNING chỉ trả các dòng thực sự được thêm
+            inserted = extras.execute_values(
+                c,
+                """
+                INSERT INTO questions (qhash, fingerprint, question, options, correct_answer, explanation, image_url, topic, qtype, rand_key)
+                VALUES %s
+                ON CONFLICT DO NOTHING
+                RETURNING id
+                """,
+                rows,
+                page_size=_INSERT_PAGE_SIZE,
+                fetch=True
+            )
+            saved = len(inserted)
+        else:
+            # SQLite: executemany + INSERT OR IGNORE, đếm qua total_changes
+            before = conn.total_changes
+            c.executemany(
+                """
+                INSERT OR IGNORE INTO questions (qhash, fingerprint, question, options, correct_answer, explanation, image_url, topic, qtype, rand_key)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+                """,
+                rows
+            )
+            saved = conn.total_changes - before
         conn.commit()
     return saved
 
-def get_cached_questions(limit: int = 30, randomize: bool = True) -> List[Dict[str, Any]]:
+_QUESTION_COLUMNS = "id, fingerprint, question, options, correct_answer, explanation, image_url, topic, qtype"
+# Số điểm bắt đầu ngẫu nhiên mỗi lần lấy mẫu (nhiều điểm -> mẫu ít bị "dính cụm" hơn)
+_SAMPLE_PROBES = 4
+
+def _row_to_question(row) -> Dict[str, Any]:
+    opts = []
+    try:
+        opts = json.loads(row['options']) if row['options'] else []
+    except (json.JSONDecodeError, TypeError):
+        opts = []
+    
+    return {
+        'type': row['qtype'] or 'general',
+        'question': row['question'],
+        'options': opts,
+        'correct_answer': row['correct_answer'],
+        'explanation': row['explanation'],
+        'image_url': row['image_url'],
+        'topic': row['topic']
+    }
+
+def _dict_cursor(conn, db_type: str):
+    """Cursor trả về dòng truy cập được theo tên cột (row['question'])"""
+    if db_type == "postgresql":
+        return conn.cursor(cursor_factory=extras.RealDictCursor)
+    conn.row_factory = sqlite3.Row
+    return conn.cursor()
+
+def _exclude_fingerprints_sql(db_type: str, exclude: List[str]) -> tuple:
+    """(điều kiện SQL, params) cho câu được lấy vào đề: loại câu có fingerprint trong `exclude`
+    (anti-join qua unique index) và câu trùng để NULL từ migration 8 - giống nhau trên cả 2 backend"""
+    ph = "%s" if db_type == "postgresql" else "?"
+    if db_type == "postgresql":
+        return f"fingerprint IS NOT NULL AND fingerprint <> ALL({ph})", [exclude]
+    if exclude:
+        return f"fingerprint IS NOT NULL AND fingerprint NOT IN ({', '.join([ph] * len(exclude))})", exclude
+    return "fingerprint IS NOT NULL", []
+
+def _sample_rows(c, db_type: str, limit: int, topic: Optional[str] = None, qtype: Optional[str] = None,
+                 exclude: Optional[List[str]] = None) -> list:
+    """Lấy ngẫu nhiên tối đa `limit` dòng qua index rand_key.
+    
+    Chọn vài điểm r ngẫu nhiên và đọc các dòng có rand_key >= r theo thứ tự index,
+    nên chi phí tỉ lệ với limit thay vì sắp xếp toàn bảng như ORDER BY RANDOM().
+    exclude: fingerprint các câu không lấy (đã có trong đề); câu fingerprint NULL không bao giờ được lấy.
+    """
+    if limit <= 0:
+        return []
+    ph = "%s" if db_type == "postgresql" else "?"
+    filters, filter_params = [], []
+    if topic is not None:
+        filters.append(f"topic = {ph}")
+        filter_params.append(topic)
+    if qtype is not None:
+        filters.append(f"qtype = {ph}")
+        filter_params.append(qtype)
+    exclude_sql, exclude_params = _exclude_fingerprints_sql(db_type, list(exclude or []))
+    filters.append(exclude_sql)
+    filter_params.extend(exclude_params)
+    
+    probes = min(_SAMPLE_PROBES, limit)
+    chunk = -(-limit // probes)
+    where = " AND ".join(filters + [f"rand_key >= {ph}"])
+    parts, params = [], []
+    for i in range(probes):
+        parts.append(
+            f"SELECT * FROM (SELECT {_QUESTION_COLUMNS} FROM questions "
+            f"WHERE {where} ORDER BY rand_key LIMIT {ph}) AS probe_{i}"
+        )
+        params.extend(filter_params + [random.random(), chunk])
+    c.execute(" UNION ALL ".join(parts), params)
+    
+    rows_by_id = {}
+    for row in c.fetchall():
+        rows_by_id.setdefault(row['id'], row)
+    
+    if len(rows_by_id) < limit:
+        # Điểm r rơi gần cuối dải [0, 1) -> vòng lại từ đầu index
+        where_all = " AND ".join(filters)
+        c.execute(
+            f"SELECT {_QUESTION_COLUMNS} FROM questions WHERE {where_all} "
+            f"AND rand_key IS NOT NULL ORDER BY rand_key LIMIT {ph}",
+            filter_params + [limit + len(rows_by_id)]
+        )
+        for row in c.fetchall():
+            if len(rows_by_id) >= limit:
+                break
+            rows_by_id.setdefault(row['id'], row)
+    
+    rows = list(rows_by_id.values())
+    random.shuffle(rows)
+    return rows[:limit]
+
+def get_cached_questions(limit: int = 30, randomize: bool = True,
+                         topic: Optional[str] = None, qtype: Optional[str] = None) -> List[Dict[str, Any]]:
+    """Lấy câu hỏi từ ngân hàng đề (ngẫu nhiên hoặc mới nhất), lọc theo topic/qtype nếu có"""
     db_type = _get_db_type()
     
     with get_conn() as conn:
-        if db_type == "postgresql":
-            # PostgreSQL: dùng RealDictCursor
-            c = conn.cursor(cursor_factory=extras.RealDictCursor)
-            order_by = "RANDOM()" if randomize else "created_at DESC"
-            c.execute(
-                f"""
-                SELECT question, options, correct_answer, explanation, image_url, topic, qtype
-                FROM questions
-                ORDER BY {order_by}
-                LIMIT %s
-                """,
-                (limit,)
-            )
-            rows = c.fetchall()
+        c = _dict_cursor(conn, db_type)
+        if randomize:
+            rows = _sample_rows(c, db_type, limit, topic, qtype)
         else:
-            # SQLite: dùng Row factory
-            conn.row_factory = sqlite3.Row
-            c = conn.cursor()
-            order_by = "RANDOM()" if randomize else "created_at DESC"
+            ph = "%s" if db_type == "postgresql" else "?"
+            filters, params = ["fingerprint IS NOT NULL"], []
+            if topic is not None:
+                filters.append(f"topic = {ph}")
+                params.append(topic)
+            if qtype is not None:
+                filters.append(f"qtype = {ph}")
+                params.append(qtype)
+            where = f"WHERE {' AND '.join(filters)}"
             c.execute(
                 f"""
-                SELECT question, options, correct_answer, explanation, image_url, topic, qtype
+                SELECT {_QUESTION_COLUMNS}
                 FROM questions
-                ORDER BY {order_by}
-                LIMIT ?
+                {where}
+                ORDER BY created_at DESC
+                LIMIT {ph}
                 """,
-                (limit,)
+                params + [limit]
             )
             rows = c.fetchall()
         
-        result: List[Dict[str, Any]] = []
-        for row in rows:
-            opts = []
-            try:
-                opts = json.loads(row['options']) if row['options'] else []
-            except (json.JSONDecodeError, TypeError):
-                opts = []
+        return [_row_to_question(row) for row in rows]
+
+def get_stratified_questions(strata: Dict[tuple, int]) -> List[Dict[str, Any]]:
+    """Lấy mẫu ngẫu nhiên theo tầng: {(topic, qtype): số câu}.
+    
+    qtype = None nghĩa là mọi dạng câu của topic đó. Tất cả tầng dùng chung 1 kết nối.
+    """
+    db_type = _get_db_type()
+    result: List[Dict[str, Any]] = []
+    
+    with get_conn() as conn:
+        c = _dict_cursor(conn, db_type)
+        for (topic, qtype), count in strata.items():
+            rows = _sample_rows(c, db_type, count, topic, qtype)
+            result.extend(_row_to_question(row) for row in rows)
+    return result
+
+def _allocate_quotas(weights: Dict[str, float], total: int) -> Dict[str, int]:
+    """Chia `total` câu theo trọng số (largest remainder) - tổng các quota đúng bằng total"""
+    positive = {k: float(w) for k, w in weights.items() if w and w > 0}
+    weight_sum = sum(positive.values())
+    if total <= 0 or weight_sum <= 0:
+        return {}
+    exact = {k: total * w / weight_sum for k, w in positive.items()}
+    quotas = {k: int(v) for k, v in exact.items()}
+    leftover = total - sum(quotas.values())
+    for k in sorted(exact, key=lambda k: exact[k] - quotas[k], reverse=True)[:leftover]:
+        quotas[k] += 1
+    return {k: q for k, q in quotas.items() if q > 0}
+
+def get_cached_questions_by_topics(topic_weights: Dict[str, float], limit: int,
+                                   exclude_hashes: Optional[set] = None) -> List[Dict[str, Any]]:
+    """Lấy ngẫu nhiên `limit` câu từ ngân hàng đề, chia theo trọng số topic.
+    
+    Args:
+        topic_weights: {topic: trọng số} - topic yếu của user có trọng số cao hơn
+        limit: tổng số câu cần lấy
+        exclude_hashes: fingerprint (question_fingerprint) các câu đã có trong đề, không lấy lại
+    
+    Mọi topic được lấy trong 1 câu truy vấn (UNION ALL, mỗi nhánh đi theo index
+    (topic, rand_key)); chỉ khi các topic không đủ câu mới lấy bù từ topic bất kỳ.
+    """
+    if limit <= 0:
+        return []
+    exclude = list(exclude_hashes or [])
+    quotas = _allocate_quotas(topic_weights, limit)
+    db_type = _get_db_type()
+    ph = "%s" if db_type == "postgresql" else "?"
+    
+    exclude_sql, exclude_params = _exclude_fingerprints_sql(db_type, exclude)
+    
+    picked: Dict[Any, Any] = {}
+    
+    with get_conn() as conn:
+        c = _dict_cursor(conn, db_type)
+        if quotas:
+            # Mỗi topic 2 nhánh: rand_key >= r và phần vòng lại rand_key < r -> luôn đủ quota nếu topic đủ câu
+            parts, params = [], []
+            for i, (topic, quota) in enumerate(quotas.items()):
+                r = random.random()
+                for wrap, cond in ((0, f"rand_key >= {ph}"), (1, f"rand_key < {ph}")):
+                    parts.append(
+                        f"SELECT * FROM (SELECT {_QUESTION_COLUMNS}, {wrap} AS wrap FROM questions "
+                        f"WHERE topic = {ph} AND {cond} AND {exclude_sql} "
+                        f"ORDER BY rand_key LIMIT {ph}) AS t{i}_{wrap}"
+                    )
+                    params.extend([topic, r] + exclude_params + [quota])
+            c.execute(" UNION ALL ".join(parts), params)
             
-            result.append({
-                'type': row['qtype'] or 'general',
-                'question': row['question'],
-                'options': opts,
-                'correct_answer': row['correct_answer'],
-                'explanation': row['explanation'],
-                'image_url': row['image_url'],
-                'topic': row['topic']
-            })
-        return result
+            taken: Dict[str, int] = {}
+            for row in sorted(c.fetchall(), key=lambda row: row['wrap']):
+                topic = row['topic']
+                if taken.get(topic, 0) < quotas[topic] and row['id'] not in picked:
+                    picked[row['id']] = row
+                    taken[topic] = taken.get(topic, 0) + 1
+        
+        missing = limit - len(picked)
+        if missing > 0:
+            # Topic yêu cầu thiếu câu -> lấy bù ngẫu nhiên từ toàn bộ ngân hàng
+            skip = exclude + [row['fingerprint'] for row in picked.values()]
+            for row in _sample_rows(c, db_type, missing, exclude=skip):
+                if len(picked) >= limit:
+                    break
+                if row['id'] not in picked:
+                    picked[row['id']] = row
+    
+    rows = list(picked.values())
+    random.shuffle(rows)
+    return [_row_to_question(row) for row in rows]
 
 def save_wrong_answer(user_id: str, topic: str, qtype: str = None):
     """Lưu thống kê câu trả lời sai của user theo topic"""
-    if not user_id or not topic:
-        return
+    save_wrong_answers_bulk(user_id, [{'topic': topic, 'qtype': qtype}])
+
+def save_wrong_answers_bulk(user_id: str, items: List[Dict[str, Any]]) -> int:
+    """Lưu thống kê nhiều câu sai ({'topic', 'qtype'}) trong 1 câu upsert nhiều dòng.
+    
+    Cộng dồn số câu sai theo topic trước (1 dòng mỗi topic), trả về số topic được cập nhật.
+    """
+    counts: Dict[str, list] = {}
+    for item in items or []:
+        topic = item.get('topic')
+        if not topic:
+            continue
+        entry = counts.setdefault(topic, [0, item.get('qtype')])
+        entry[0] += 1
+    if not user_id or not counts:
+        return 0
+    rows = [(user_id, topic, qtype, count) for topic, (count, qtype) in counts.items()]
     
     db_type = _get_db_type()
     
     with get_conn() as conn:
         c = conn.cursor()
         if db_type == "postgresql":
-            c.execute(
+            extras.execute_values(
+                c,
                 """
-                INSERT INTO user_wrong_answers (user_id, topic, qtype, wrong_count, last_wrong_at)
-                VALUES (%s, %s, %s, 1, CURRENT_TIMESTAMP)
+                INSERT INTO user_wrong_answers (user_id, topic, qtype, wrong_count)
+                VALUES %s
                 ON CONFLICT (user_id, topic) 
                 DO UPDATE SET 
-                    wrong_count = user_wrong_answers.wrong_count + 1,
+                    wrong_count = user_wrong_answers.wrong_count + EXCLUDED.wrong_count,
                     last_wrong_at = CURRENT_TIMESTAMP
                 """,
-                (user_id, topic, qtype)
+                rows,
+                page_size=_INSERT_PAGE_SIZE
             )
         else:
             # SQLite
             c.execute(
-                """
-                INSERT INTO user_wrong_answers (user_id, topic, qtype, wrong_count, last_wrong_at)
-                VALUES (?, ?, ?, 1, CURRENT_TIMESTAMP)
+                f"""
+                INSERT INTO user_wrong_answers (user_id, topic, qtype, wrong_count)
+                VALUES {", ".join(["(?, ?, ?, ?)"] * len(rows))}
                 ON CONFLICT (user_id, topic) 
                 DO UPDATE SET 
-                    wrong_count = wrong_count + 1,
+                    wrong_count = wrong_count + excluded.wrong_count,
                     last_wrong_at = CURRENT_TIMESTAMP
                 """,
-                (user_id, topic, qtype)
+                [value for row in rows for value in row]
             )
         conn.commit()
+    return len(rows)
 
 def get_weak_topics(user_id: str, limit: int = 5) -> List[Dict[str, Any]]:
     """Lấy danh sách các topic mà user hay trả lời sai nhất"""
@@ -405,3 +1076,245 @@ def get_weak_topics(user_id: str, limit: int = 5) -> List[Dict[str, Any]]:
         
         rows = c.fetchall()
         return [dict(row) for row in rows]
+
+def add_pooled_question_set(questions: List[Dict[str, Any]]) -> None:
+    """Đưa 1 bộ câu hỏi đã kiểm tra vào exam_pool"""
+    if not questions:
+        return
+    db_type = _get_db_type()
+    
+    with get_conn() as conn:
+        c = conn.cursor()
+        if db_type == "postgresql":
+            c.execute(
+                "INSERT INTO exam_pool (questions, num_questions) VALUES (%s, %s)",
+                (extras.Json(questions), len(questions))
+            )
+        else:
+            c.execute(
+                "INSERT INTO exam_pool (questions, num_questions) VALUES (?, ?)",
+                (json.dumps(questions, ensure_ascii=False), len(questions))
+            )
+        conn.commit()
+
+def claim_pooled_question_set(num_questions: int) -> Optional[List[Dict[str, Any]]]:
+    """Lấy `num_questions` câu từ 1 bộ trong exam_pool; None nếu không có bộ nào đủ câu.
+    
+    Chọn bộ nhỏ nhất còn đủ câu (phần dư của đề lớn được dùng trước); bộ lớn hơn
+    cần thì phần còn lại được trả lại pool trong cùng transaction, không bỏ phí.
+    PostgreSQL dùng FOR UPDATE SKIP LOCKED nên nhiều user cùng lúc không lấy trùng 1 bộ.
+    """
+    if num_questions <= 0:
+        return None
+    db_type = _get_db_type()
+    
+    with get_conn() as conn:
+        c = conn.cursor()
+        if db_type == "postgresql":
+            c.execute(
+                """
+                DELETE FROM exam_pool
+                WHERE id = (
+                    SELECT id FROM exam_pool
+                    WHERE num_questions >= %s
+                    ORDER BY num_questions, id
+                    LIMIT 1
+                    FOR UPDATE SKIP LOCKED
+                )
+                RETURNING questions
+                """,
+                (num_questions,)
+            )
+            row = c.fetchone()
+            questions = row[0] if row else None  # JSONB automatically parsed
+            rest = questions[num_questions:] if questions else []
+            if rest:
+                c.execute(
+                    "INSERT INTO exam_pool (questions, num_questions) VALUES (%s, %s)",
+                    (extras.Json(rest), len(rest))
+                )
+        else:
+            # SQLite: kết nối dùng chung đã được khóa -> SELECT + DELETE không bị chen ngang
+            c.execute(
+                "SELECT id, questions FROM exam_pool WHERE num_questions >= ? ORDER BY num_questions, id LIMIT 1",
+                (num_questions,)
+            )
+            row = c.fetchone()
+            if not row:
+                return None
+            c.execute("DELETE FROM exam_pool WHERE id = ?", (row[0],))
+            questions = json.loads(row[1])
+            rest = questions[num_questions:]
+            if rest:
+                c.execute(
+                    "INSERT INTO exam_pool (questions, num_questions) VALUES (?, ?)",
+                    (json.dumps(rest, ensure_ascii=False), len(rest))
+                )
+        conn.commit()
+        return questions[:num_questions] if questions else None
+
+def count_pooled_question_sets(min_questions: int = 1) -> int:
+    """Số bộ câu hỏi đang chờ trong exam_pool có ít nhất `min_questions` câu"""
+    db_type = _get_db_type()
+    ph = "%s" if db_type == "postgresql" else "?"
+    with get_conn() as conn:
+        c = conn.cursor()
+        c.execute(f"SELECT COUNT(*) FROM exam_pool WHERE num_questions >= {ph}", (min_questions,))
+        return c.fetchone()[0]
+
+def take_rate_limit_tokens(name: str, rpm: int, tokens: int = 0, tpm: int = 0) -> float:
+    """Trừ 1 request (+ `tokens` token) khỏi bucket chung trong DB.
+    
+    Trả về 0 nếu được phép gọi API ngay, ngược lại là số giây cần chờ.
+    Dùng time.time() nên các instance cần đồng bộ giờ hệ thống (NTP).
+    """
+    db_type = _get_db_type()
+    ph = "%s" if db_type == "postgresql" else "?"
+    now = time.time()
+    
+    with get_conn() as conn:
+        c = conn.cursor()
+        if db_type == "postgresql":
+            c.execute(
+                """
+                INSERT INTO rate_limit_buckets (name, requests, tokens, updated_at)
+                VALUES (%s, %s, %s, %s)
+                ON CONFLICT (name) DO NOTHING
+                """,
+                (name, rpm, tpm, now)
+            )
+            c.execute(
+                "SELECT requests, tokens, updated_at, blocked_until FROM rate_limit_buckets WHERE name = %s FOR UPDATE",
+                (name,)
+            )
+        else:
+            c.execute(
+                "INSERT OR IGNORE INTO rate_limit_buckets (name, requests, tokens, updated_at) VALUES (?, ?, ?, ?)",
+                (name, rpm, tpm, now)
+            )
+            c.execute(
+                "SELECT requests, tokens, updated_at, blocked_until FROM rate_limit_buckets WHERE name = ?",
+                (name,)
+            )
+        requests_left, tokens_left, updated_at, blocked_until = c.fetchone()
+        
+        elapsed = max(0.0, now - updated_at)
+        requests_left = min(rpm, requests_left + elapsed * rpm / 60.0) if rpm > 0 else 0
+        tokens_left = min(tpm, tokens_left + elapsed * tpm / 60.0) if tpm > 0 else 0
+        
+        wait = max(0.0, blocked_until - now)
+        if rpm > 0 and requests_left < 1:
+            wait = max(wait, (1 - requests_left) * 60.0 / rpm)
+        needed_tokens = min(tokens, tpm) if tpm > 0 else 0
+        if needed_tokens and tokens_left < needed_tokens:
+            wait = max(wait, (needed_tokens - tokens_left) * 60.0 / tpm)
+        if wait <= 0:
+            requests_left -= 1 if rpm > 0 else 0
+            tokens_left -= needed_tokens
+        
+        c.execute(
+            f"UPDATE rate_limit_buckets SET requests = {ph}, tokens = {ph}, updated_at = {ph} WHERE name = {ph}",
+            (requests_left, tokens_left, now, name)
+        )
+        conn.commit()
+        return wait
+
+def block_rate_limit(name: str, seconds: float) -> None:
+    """Báo cho mọi process: tạm dừng gọi API `name` trong `seconds` giây (sau lỗi 429)"""
+    db_type = _get_db_type()
+    until = time.time() + seconds
+    
+    with get_conn() as conn:
+        c = conn.cursor()
+        if db_type == "postgresql":
+            c.execute(
+                "UPDATE rate_limit_buckets SET blocked_until = GREATEST(blocked_until, %s) WHERE name = %s",
+                (until, name)
+            )
+        else:
+            c.execute(
+                "UPDATE rate_limit_buckets SET blocked_until = MAX(blocked_until, ?) WHERE name = ?",
+                (until, name)
+            )
+        conn.commit()
+
+def get_llm_response(cache_key: str) -> Optional[str]:
+    """Response đã cache (chưa hết hạn) theo cache_key, đồng thời tăng bộ đếm hits.
+
+    1 câu UPDATE ... RETURNING cho cả 2 DB (SQLite >= 3.35), không đọc rồi mới ghi.
+    """
+    db_type = _get_db_type()
+    ph = "%s" if db_type == "postgresql" else "?"
+    now = time.time()
+    
+    with get_conn() as conn:
+        c = conn.cursor()
+        c.execute(
+            f"""
+            UPDATE llm_response_cache SET hits = hits + 1, last_hit_at = {ph}
+            WHERE cache_key = {ph} AND expires_at > {ph}
+            RETURNING response_text
+            """,
+            (now, cache_key, now)
+        )
+        row = c.fetchone()
+        conn.commit()
+        return row[0] if row else None
+
+def put_llm_response(cache_key: str, model: str, response_text: str, ttl_seconds: float) -> None:
+    """Lưu/ghi đè response vào cache, hết hạn sau ttl_seconds"""
+    db_type = _get_db_type()
+    ph = "%s" if db_type == "postgresql" else "?"
+    now = time.time()
+    
+    with get_conn() as conn:
+        c = conn.cursor()
+        c.execute(
+            f"""
+            INSERT INTO llm_response_cache (cache_key, model, response_text, size_bytes, created_at, expires_at)
+            VALUES ({ph}, {ph}, {ph}, {ph}, {ph}, {ph})
+            ON CONFLICT (cache_key) DO UPDATE SET
+                response_text = EXCLUDED.response_text,
+                size_bytes = EXCLUDED.size_bytes,
+                created_at = EXCLUDED.created_at,
+                expires_at = EXCLUDED.expires_at
+            """,
+            (cache_key, model, response_text, len(response_text.encode('utf-8')), now, now + ttl_seconds)
+        )
+        conn.commit()
+
+def evict_llm_responses(max_bytes: int) -> int:
+    """Xóa response hết hạn, sau đó xóa response ít dùng gần đây nhất tới khi tổng dung lượng <= max_bytes"""
+    db_type = _get_db_type()
+    ph = "%s" if db_type == "postgresql" else "?"
+    
+    with get_conn() as conn:
+        c = conn.cursor()
+        c.execute(f"DELETE FROM llm_response_cache WHERE expires_at <= {ph}", (time.time(),))
+        deleted = c.rowcount
+        c.execute(
+            f"""
+            DELETE FROM llm_response_cache WHERE cache_key IN (
+                SELECT cache_key FROM (
+                    SELECT cache_key,
+                           SUM(size_bytes) OVER (
+                               ORDER BY COALESCE(last_hit_at, created_at) DESC, cache_key
+                           ) AS running_bytes
+                    FROM llm_response_cache
+                ) ranked
+                WHERE running_bytes > {ph}
+            )
+            """,
+            (max_bytes,)
+        )
+        deleted += c.rowcount
+        conn.commit()
+        return deleted
+
+def get_llm_cache_stats() -> Dict[str, int]:
+    """Số entry, tổng dung lượng và tổng lượt hit của llm_response_cache"""
+    with get_conn() as conn:
+        c = conn.cursor()
+        c.execute("SELECT COUNT(*), COALESCE(SUM(size_bytes), 0), COALESCE(SUM(hits), 0) FROM llm_response_cache")
+        entries, total_bytes, hits = c.fetchone()
+        return {'entries': entries, 'bytes': int(total_bytes), 'hits': int(hits)}
@@ -0,0 +1,84 @@
+"""Pool đề thi sinh sẵn
+
+Worker nền giữ sẵn EXAM_POOL_SIZE bộ câu hỏi AI (đã qua kiểm tra của
+generate_question_batch) trong bảng exam_pool, mỗi bộ đủ phần câu AI của 1 đề
+num_questions câu. Khi user bấm "KHỞI TẠO ĐỀ THI", generate_full_exam chỉ cần lấy
+đúng số câu AI của đề từ 1 bộ (đề nhỏ hơn thì phần dư được trả lại pool) thay vì
+chờ Gemini. User có weak topics thì không dùng pool (câu trong pool sinh không
+theo điểm yếu).
+
+Worker gọi Gemini trong rate_limiter.background_priority(): chỉ dùng lượt dư của
+limiter, nhường cho request của user đang chờ (tạo đề, study guide) và luôn chừa
+GEMINI_BACKGROUND_RESERVE lượt.
+
+Cấu hình (env hoặc Streamlit secrets):
+- EXAM_POOL_SIZE: số bộ câu hỏi giữ sẵn (0 = tắt worker), mặc định 2
+- EXAM_POOL_CHECK_SECONDS: chu kỳ kiểm tra pool, mặc định 60
+"""
+import threading
+
+from ai_logic import generate_question_batch, select_seeds, speculative_seed_count, split_exam_counts
+from db import (
+    add_pooled_question_set,
+    count_pooled_question_sets,
+    save_questions,
+    _get_int_config,
+)
+from rate_limiter import background_priority
+
+_worker: threading.Thread | None = None
+_worker_lock = threading.Lock()
+_stop = threading.Event()
+
+def refill_once(seed_data, set_size: int) -> bool:
+    """Sinh 1 bộ câu hỏi AI và đưa vào pool. Trả về False nếu Gemini không tạo được câu nào."""
+    seeds = select_seeds(seed_data, speculative_seed_count(set_size))
+    with background_priority():
+        questions = generate_question_batch(seeds, num_questions=set_size)
+    if not questions:
+        return False
+    try:
+        saved = save_questions(questions)
+        print(f"💾 [exam_pool] Đã lưu {saved} câu mới vào DB")
+    except Exception as e:
+        print(f"⚠️ [exam_pool] Lỗi lưu DB: {e}")
+    add_pooled_question_set(questions)
+    print(f"📦 [exam_pool] Đã thêm 1 bộ {len(questions)} câu vào pool")
+    return True
+
+def _worker_loop(seed_data, set_size: int):
+    target = _get_int_config("EXAM_POOL_SIZE", 2)
+    interval = max(5, _get_int_config("EXAM_POOL_CHECK_SECONDS", 60))
+    while not _stop.is_set():
+        try:
+            # Chỉ đếm bộ đủ câu cho 1 đề - phần dư nhỏ còn lại sau đề ngắn không tính
+            while not _stop.is_set() and count_pooled_question_sets(set_size) < target:
+                if not refill_once(seed_data, set_size):
+                    # Hết quota/lỗi API -> đợi chu kỳ sau
+                    break
+        except Exception as e:
+            print(f"⚠️ [exam_pool] Worker error: {e}")
+        _stop.wait(interval)
+
+def start_worker(seed_data, num_questions: int = 30) -> bool:
+    """Khởi động worker (1 lần mỗi process). Trả về True nếu worker đang chạy."""
+    global _worker
+    if not seed_data or _get_int_config("EXAM_POOL_SIZE", 2) <= 0:
+        return False
+    with _worker_lock:
+        if _worker is not None and _worker.is_alive():
+            return True
+        _, set_size = split_exam_counts(num_questions)
+        _stop.clear()
+        _worker = threading.Thread(
+            target=_worker_loop,
+            args=(seed_data, set_size),
+            name="exam-pool-worker",
+            daemon=True
+        )
+        _worker.start()
+        print(f"🚀 [exam_pool] Worker started (set size {set_size})")
+    return True
+
+def stop_worker():
+    _stop.set()
@@ -0,0 +1,206 @@
+"""Lớp gọi Gemini bất đồng bộ (asyncio)
+
+Streamlit chạy script trên thread đồng bộ, nên module này giữ 1 event loop
+riêng trên thread nền. Code đồng bộ gửi coroutine sang loop đó bằng
+run_sync()/submit(); các lời gọi client.aio.models.generate_content chạy
+chồng lên nhau thay vì chặn thread của script.
+
+Cấu hình (env hoặc Streamlit secrets):
+- GEMINI_CONCURRENCY: số request chạy song song tối đa, mặc định 4
+- GEMINI_STREAMING: "0" để tắt generate_content_stream (mặc định bật)
+"""
+import asyncio
+import concurrent.futures
+import contextlib
+import threading
+import time
+from typing import Any, Awaitable, Callable, Dict, List, Optional
+
+from db import _get_config, _get_int_config
+import llm_cache
+from json_stream import IncrementalJSONParser, MalformedJSONError
+from rate_limiter import RateLimiter, estimate_tokens, rate_limited_call_async, time_left
+
+_loop: Optional[asyncio.AbstractEventLoop] = None
+_loop_thread: Optional[threading.Thread] = None
+_loop_lock = threading.Lock()
+
+def get_concurrency() -> int:
+    """Số request Gemini chạy song song (GEMINI_CONCURRENCY) - rate limiter vẫn giữ RPM"""
+    return max(1, _get_int_config("GEMINI_CONCURRENCY", 4))
+
+def streaming_enabled() -> bool:
+    return str(_get_config("GEMINI_STREAMING", "1")).lower() not in ("0", "false", "no")
+
+def get_loop() -> asyncio.AbstractEventLoop:
+    """Event loop dùng chung của process, chạy trên 1 daemon thread (tạo lần đầu khi cần)"""
+    global _loop, _loop_thread
+    with _loop_lock:
+        if _loop is None or not _loop_thread.is_alive():
+            _loop = asyncio.new_event_loop()
+            _loop_thread = threading.Thread(target=_loop.run_forever, name="gemini-async-loop", daemon=True)
+            _loop_thread.start()
+        return _loop
+
+def submit(coro: Awaitable[Any]) -> concurrent.futures.Future:
+    """Gửi coroutine sang loop nền; future.cancel() sẽ hủy luôn coroutine"""
+    return asyncio.run_coroutine_threadsafe(coro, get_loop())
+
+def run_sync(coro: Awaitable[Any], timeout: Optional[float] = None) -> Any:
+    """Chạy coroutine trên loop nền và chờ kết quả từ code đồng bộ (script Streamlit)"""
+    future = submit(coro)
+    try:
+        return future.result(timeout)
+    except concurrent.futures.TimeoutError:
+        future.cancel()
+        raise
+
+def submit_bounded(factories: List[Callable[[], Awaitable[Any]]],
+                   concurrency: Optional[int] = None) -> List[concurrent.futures.Future]:
+    """Gửi nhiều coroutine, tối đa `concurrency` cái chạy cùng lúc (semaphore).
+
+    factories: hàm không tham số trả về coroutine - chỉ được gọi khi đã có slot,
+    nên deadline tính bên trong factory bắt đầu từ lúc thực sự chạy.
+    Trả về danh sách future theo đúng thứ tự factories.
+    """
+    semaphore = asyncio.Semaphore(concurrency or get_concurrency())
+
+    async def _run(factory):
+        async with semaphore:
+            return await factory()
+
+    return [submit(_run(factory)) for factory in factories]
+
+def gather(factories: List[Callable[[], Awaitable[Any]]], concurrency: Optional[int] = None,
+           timeout: Optional[float] = None) -> List[Any]:
+    """Fan-out kiểu asyncio.gather từ code đồng bộ.
+
+    Kết quả theo thứ tự factories; coroutine lỗi/quá `timeout` trả về exception
+    thay vì làm hỏng cả nhóm.
+    """
+    futures = submit_bounded(factories, concurrency)
+    done, pending = concurrent.futures.wait(futures, timeout=timeout)
+    for future in pending:
+        future.cancel()
+    results = []
+    for future in futures:
+        if future in pending:
+            results.append(TimeoutError("Gemini request timed out"))
+            continue
+        try:
+            results.append(future.result())
+        except BaseException as e:  # CancelledError không kế thừa Exception
+            results.append(e)
+    return results
+
+async def _cache_lookup(model: str, contents: Any, config: Optional[Dict[str, Any]], use_cache: bool,
+                        cache: bool = True):
+    """(cache_key, text đã cache) - đọc DB ở thread phụ để không chặn event loop"""
+    if not cache or not llm_cache.enabled():
+        return None, None
+    key = llm_cache.cache_key(model, contents, config)
+    if not use_cache:
+        return key, None
+    text = await asyncio.to_thread(llm_cache.get, key)
+    if text is not None:
+        print(f"♻️ LLM cache hit ({model})")
+    return key, text
+
+async def generate_content(client, *, model: str, contents: Any, config: Optional[Dict[str, Any]] = None,
+                           timeout: Optional[float] = None, limiter: Optional[RateLimiter] = None,
+                           ttl: Optional[int] = None, use_cache: bool = True, cache: bool = True):
+    """client.aio.models.generate_content qua llm_cache + rate limiter dùng chung, giới hạn `timeout` giây
+
+    use_cache=False: bỏ qua entry cũ (vd. response trước không qua kiểm tra) nhưng vẫn lưu kết quả mới.
+    cache=False: không dùng llm_cache (request không tất định, vd. sinh câu biến thể).
+    """
+    key, cached = await _cache_lookup(model, contents, config, use_cache, cache)
+    if cached is not None:
+        return llm_cache.CachedResponse(cached)
+
+    # Deadline chung cho mọi lần thử (chờ lượt, Retry-After, request) - không tính lại sau mỗi lỗi 429
+    deadline = time.monotonic() + timeout if timeout is not None else None
+
+    async def _call():
+        return await asyncio.wait_for(
+            client.aio.models.generate_content(model=model, contents=contents, config=config),
+            time_left(deadline)
+        )
+
+    response = await rate_limited_call_async(
+        _call,
+        estimated_tokens=estimate_tokens(contents),
+        limiter=limiter,
+        timeout=timeout
+    )
+    if key:
+        await asyncio.to_thread(llm_cache.put, key, model, getattr(response, 'text', None), ttl)
+    return response
+
+class StreamedResponse:
+    """Kết quả generate_content_stream đã gom lại (text, usage_metadata giống response thường)"""
+
+    def __init__(self, text: str, data: Optional[Dict[str, Any]], usage_metadata=None):
+        self.text = text
+        self.data = data  # object JSON đã parse dần; None nếu JSON chưa đóng hoặc sai cấu trúc
+        self.usage_metadata = usage_metadata
+
+async def generate_content_stream(client, *, model: str, contents: Any, config: Optional[Dict[str, Any]] = None,
+                                  timeout: Optional[float] = None, limiter: Optional[RateLimiter] = None,
+                                  on_field: Optional[Callable[[str, Any], None]] = None,
+                                  abort_on_malformed: bool = True, ttl: Optional[int] = None,
+                                  use_cache: bool = True, cache: bool = True) -> StreamedResponse:
+    """Stream response JSON của Gemini, parse dần từng field.
+
+    on_field(key, value) được gọi ngay khi 1 field cấp 1 hoàn tất; raise trong on_field
+    (vd. đáp án không khớp lựa chọn) sẽ dừng stream luôn, không tốn thêm token.
+    abort_on_malformed: sai cấu trúc JSON thì dừng ngay (MalformedJSONError); False thì
+    vẫn đọc hết text để caller tự sửa JSON.
+    Cache hit (llm_cache) đi qua cùng parser/on_field như khi stream thật; cache=False bỏ qua llm_cache.
+    """
+    parser = IncrementalJSONParser()
+    state = {'parsing': True}
+
+    def _feed(text: str):
+        if not state['parsing']:
+            return
+        try:
+            fields = parser.feed(text)
+        except MalformedJSONError:
+            if abort_on_malformed:
+                raise
+            state['parsing'] = False
+            return
+        if on_field:
+            for field, value in fields:
+                on_field(field, value)
+
+    key, cached = await _cache_lookup(model, contents, config, use_cache, cache)
+    if cached is not None:
+        _feed(cached)
+        return StreamedResponse(cached, parser.result() if state['parsing'] else None)
+
+    async def _consume():
+        parts = []
+        usage = None
+        stream = await client.aio.models.generate_content_stream(model=model, contents=contents, config=config)
+        async with contextlib.aclosing(stream):
+            async for chunk in stream:
+                usage = getattr(chunk, 'usage_metadata', None) or usage
+                text = chunk.text or ''
+                if not text:
+                    continue
+                parts.append(text)
+                _feed(text)
+        return StreamedResponse(''.join(parts), parser.result() if state['parsing'] else None, usage)
+
+    deadline = time.monotonic() + timeout if timeout is not None else None
+    response = await rate_limited_call_async(
+        lambda: asyncio.wait_for(_consume(), time_left(deadline)),
+        estimated_tokens=estimate_tokens(contents),
+        limiter=limiter,
+        timeout=timeout
+    )
+    if key:
+        await asyncio.to_thread(llm_cache.put, key, model, response.text, ttl)
+    return response
@@ -2,6 +2,8 @@ import google.genai as genai
 import json
 import os
 import time
+import llm_cache
+import model_router
 
 # --- CẤU HÌNH API ---
 from dotenv import load_dotenv
@@ -69,35 +71,26 @@ def process_pdf_to_json(pdf_path, output_path):
         - "logic": Các câu hỏi chuỗi số, logic ngôn ngữ.
         """
 
-    # 3. Sử dụng model Gemini 2.5 Pro
+    # 3. Sử dụng model pro (model_router: đọc PDF luôn cần model pro)
     
-    # Thử gửi request với retry
-    max_retries = 3
-    retry_count = 0
+    # Gửi request qua rate limiter dùng chung: lỗi 429 được chờ theo Retry-After rồi thử lại
     response = None
-    
-    while retry_count < max_retries:
-        try:
-            print(f"Đang gửi request đến Gemini... (Lần thử {retry_count + 1}/{max_retries})")
-            
-            # Call generate_content with google-genai Client API
-            response = client.models.generate_content(
-                model='gemini-2.5-pro',
+    try:
+        print("Đang gửi request đến Gemini...")
+        
+        model_name = model_router.choose_model('ingest_pdf')
+        with model_router.track(model_name, 'ingest_pdf'):
+            # Call generate_content with google-genai Client API (qua llm_cache + rate limiter)
+            response = llm_cache.generate_content(
+                client,
+                model=model_name,
                 contents=[sample_file, prompt],
                 config={
                     'response_mime_type': 'application/json'
                 }
             )
-            break  # Thành công thì thoát vòng lặp
-        except Exception as e:
-            retry_count += 1
-            if "quota" in str(e).lower() or "429" in str(e):
-                wait_time = 10 * retry_count  # Chờ 10s, 20s, 30s...
-                print(f"⚠️ Vượt quota. Chờ {wait_time}s trước khi thử lại...")
-                time.sleep(wait_time)
-            else:
-                print(f"❌ Lỗi: {e}")
-                break
+    except Exception as e:
+        print(f"❌ Lỗi: {e}")
     
     if response is None:
         print("❌ Không thể kết nối đến Gemini sau nhiều lần thử.")
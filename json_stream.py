@@ -0,0 +1,125 @@
+"""Parser JSON tăng dần cho response stream của Gemini
+
+Gemini trả về 1 object JSON phẳng theo từng chunk. IncrementalJSONParser nhận
+từng chunk (feed) và trả về các field cấp 1 ngay khi giá trị của field đó
+đóng lại, nên code gọi có thể kiểm tra `question`/`options` trước khi model
+viết xong `step_by_step_thinking`. Sai cấu trúc thì báo MalformedJSONError
+ngay, không phải chờ hết response mới biết.
+"""
+import json
+from typing import Any, Dict, List, Optional, Tuple
+
+class MalformedJSONError(ValueError):
+    """Response stream không phải 1 object JSON hợp lệ"""
+
+# Trạng thái khi đang ở cấp 1 của object
+_BEFORE, _KEY, _IN_KEY, _COLON, _VALUE_START, _VALUE, _DONE = range(7)
+
+class IncrementalJSONParser:
+    """Parse dần 1 object JSON; feed() trả về [(key, value)] của các field vừa hoàn tất"""
+
+    def __init__(self):
+        self._buf = ""
+        self._pos = 0
+        self._state = _BEFORE
+        self._in_string = False
+        self._escape = False
+        self._nesting = 0  # độ sâu {}/[] bên trong giá trị hiện tại
+        self._token_start = 0
+        self._key: Optional[str] = None
+        self.fields: Dict[str, Any] = {}
+
+    @property
+    def complete(self) -> bool:
+        return self._state == _DONE
+
+    def result(self) -> Optional[Dict[str, Any]]:
+        """Object đầy đủ nếu đã đóng '}' cuối cùng, ngược lại None"""
+        return self.fields if self.complete else None
+
+    def _fail(self, reason: str):
+        snippet = self._buf[max(0, self._pos - 20):self._pos + 20]
+        raise MalformedJSONError(f"{reason} at char {self._pos}: {snippet!r}")
+
+    def _emit_value(self, end: int, out: List[Tuple[str, Any]]):
+        raw = self._buf[self._token_start:end].strip()
+        try:
+            # strict=False: model hay để xuống dòng thật bên trong string
+            value = json.loads(raw, strict=False)
+        except json.JSONDecodeError as e:
+            self._fail(f"Invalid value for '{self._key}' ({e.msg})")
+        self.fields[self._key] = value
+        out.append((self._key, value))
+
+    def feed(self, chunk: str) -> List[Tuple[str, Any]]:
+        out: List[Tuple[str, Any]] = []
+        self._buf += chunk
+        buf = self._buf
+        while self._pos < len(buf):
+            ch = buf[self._pos]
+            state = self._state
+
+            if state == _BEFORE:
+                if ch == '`':
+                    # Bỏ qua ```json ở đầu: chờ đủ tới hết dòng
+                    newline = buf.find('\n', self._pos)
+                    if newline == -1:
+                        break
+                    self._pos = newline
+                elif ch == '{':
+                    self._state = _KEY
+                elif not ch.isspace():
+                    self._fail("Expected '{'")
+            elif state == _KEY:
+                if ch == '"':
+                    self._state = _IN_KEY
+                    self._token_start = self._pos
+                elif ch == '}':
+                    # Object rỗng hoặc dấu ',' thừa trước '}' - vẫn chấp nhận
+                    self._state = _DONE
+                elif not ch.isspace():
+                    self._fail("Expected field name")
+            elif state == _IN_KEY:
+                if self._escape:
+                    self._escape = False
+                elif ch == '\\':
+                    self._escape = True
+                elif ch == '"':
+                    self._key = json.loads(buf[self._token_start:self._pos + 1])
+                    self._state = _COLON
+            elif state == _COLON:
+                if ch == ':':
+                    self._state = _VALUE_START
+                elif not ch.isspace():
+                    self._fail("Expected ':'")
+            elif state == _VALUE_START:
+                if not ch.isspace():
+                    if ch in ',}]:':
+                        self._fail("Missing value")
+                    self._token_start = self._pos
+                    self._state = _VALUE
+                    continue  # xử lý lại ký tự này như 1 phần của giá trị
+            elif state == _VALUE:
+                if self._in_string:
+                    if self._escape:
+                        self._escape = False
+                    elif ch == '\\':
+                        self._escape = True
+                    elif ch == '"':
+                        self._in_string = False
+                elif ch == '"':
+                    self._in_string = True
+                elif ch in '{[':
+                    self._nesting += 1
+                elif ch in '}]' and self._nesting > 0:
+                    self._nesting -= 1
+                elif self._nesting == 0 and ch in ',}':
+                    self._emit_value(self._pos, out)
+                    self._state = _KEY if ch == ',' else _DONE
+                elif self._nesting == 0 and ch == ']':
+                    self._fail("Unbalanced ']'")
+            elif state == _DONE:
+                # Phần thừa sau '}' (``` đóng, khoảng trắng) - bỏ qua
+                break
+            self._pos += 1
+        return out
@@ -0,0 +1,129 @@
+"""Cache response Gemini theo nội dung request
+
+Key = sha256(model + generation config + prompt), nên cùng 1 câu gốc/topic hoặc
+cùng bộ câu sai gửi lại sẽ lấy response đã lưu trong database thay vì gọi API.
+Response chỉ được lưu khi gọi thành công; caller gọi lại với use_cache=False
+(vd. lần thử thứ 2 sau khi response cũ không qua kiểm tra) sẽ ghi đè entry cũ.
+Request không tất định (sinh câu biến thể, temperature cao - mỗi lần gọi phải ra
+câu mới) truyền cache=False: không đọc cũng không ghi cache.
+
+Cấu hình (env hoặc Streamlit secrets):
+- LLM_CACHE_ENABLED: "0" để tắt cache, mặc định bật
+- LLM_CACHE_TTL: thời gian sống mặc định (giây), mặc định 7 ngày
+- LLM_CACHE_MAX_MB: dung lượng tối đa, vượt thì xóa entry ít dùng nhất, mặc định 50
+"""
+import hashlib
+import json
+import threading
+from typing import Any, Dict, Optional
+
+from db import (
+    _get_config,
+    _get_int_config,
+    evict_llm_responses,
+    get_llm_cache_stats,
+    get_llm_response,
+    put_llm_response,
+)
+from rate_limiter import estimate_tokens, rate_limited_call
+
+# Sau bao nhiêu lần ghi thì chạy dọn cache 1 lần
+_EVICT_EVERY = 50
+
+_stats = {'hits': 0, 'misses': 0, 'writes': 0, 'evicted': 0, 'errors': 0}
+_stats_lock = threading.Lock()
+
+class CachedResponse:
+    """Response lấy từ cache - có .text như response của google-genai"""
+
+    def __init__(self, text: str):
+        self.text = text
+        self.usage_metadata = None
+        self.from_cache = True
+
+def enabled() -> bool:
+    return str(_get_config("LLM_CACHE_ENABLED", "1")).lower() not in ("0", "false", "no")
+
+def _count(name: str, amount: int = 1):
+    with _stats_lock:
+        _stats[name] += amount
+
+def _describe(part: Any) -> Any:
+    """Phần contents không phải text (file upload...) -> định danh ổn định để đưa vào key"""
+    if isinstance(part, (str, int, float, bool)) or part is None:
+        return part
+    if isinstance(part, (list, tuple)):
+        return [_describe(p) for p in part]
+    if isinstance(part, dict):
+        return {k: _describe(v) for k, v in part.items()}
+    # File upload: mỗi lần upload có uri mới, nên ưu tiên hash nội dung file
+    return (getattr(part, 'sha256_hash', None) or getattr(part, 'uri', None)
+            or getattr(part, 'name', None) or repr(part))
+
+def cache_key(model: str, contents: Any, config: Optional[Dict[str, Any]] = None) -> str:
+    # http_options (timeout theo deadline) không ảnh hưởng nội dung response
+    config = {k: v for k, v in (config or {}).items() if k != 'http_options'}
+    payload = json.dumps(
+        {'model': model, 'config': config, 'contents': _describe(contents)},
+        sort_keys=True, ensure_ascii=False, default=str
+    )
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+def get(key: str) -> Optional[str]:
+    """Response đã cache hoặc None (lỗi DB coi như miss)"""
+    try:
+        text = get_llm_response(key)
+    except Exception as e:
+        _count('errors')
+        print(f"⚠️ LLM cache read error: {e}")
+        return None
+    _count('hits' if text is not None else 'misses')
+    return text
+
+def put(key: str, model: str, text: str, ttl: Optional[int] = None) -> None:
+    if not text:
+        return
+    try:
+        put_llm_response(key, model, text, ttl or _get_int_config("LLM_CACHE_TTL", 7 * 24 * 3600))
+        _count('writes')
+        if _stats['writes'] % _EVICT_EVERY == 1:
+            evicted = evict_llm_responses(_get_int_config("LLM_CACHE_MAX_MB", 50) * 1024 * 1024)
+            _count('evicted', evicted)
+    except Exception as e:
+        _count('errors')
+        print(f"⚠️ LLM cache write error: {e}")
+
+def get_stats() -> Dict[str, Any]:
+    """Bộ đếm hit/miss của process + số liệu bảng cache trong DB"""
+    with _stats_lock:
+        stats = dict(_stats)
+    lookups = stats['hits'] + stats['misses']
+    stats['hit_rate'] = round(stats['hits'] / lookups, 3) if lookups else 0.0
+    try:
+        stats['stored'] = get_llm_cache_stats()
+    except Exception:
+        pass
+    return stats
+
+def generate_content(client, *, model: str, contents: Any, config: Optional[Dict[str, Any]] = None,
+                     ttl: Optional[int] = None, use_cache: bool = True, cache: bool = True,
+                     **call_kwargs) -> Any:
+    """client.models.generate_content (đồng bộ) qua cache + rate limiter dùng chung.
+
+    call_kwargs truyền tiếp cho rate_limited_call (timeout, limiter...).
+    """
+    key = cache_key(model, contents, config) if cache and enabled() else None
+    if key and use_cache:
+        text = get(key)
+        if text is not None:
+            print(f"♻️ LLM cache hit ({model})")
+            return CachedResponse(text)
+    prompt_text = contents if isinstance(contents, str) else " ".join(p for p in contents if isinstance(p, str))
+    response = rate_limited_call(
+        lambda: client.models.generate_content(model=model, contents=contents, config=config),
+        estimated_tokens=estimate_tokens(prompt_text),
+        **call_kwargs
+    )
+    if key:
+        put(key, model, getattr(response, 'text', None), ttl)
+    return response
@@ -0,0 +1,26 @@
+"""Chạy các schema migration còn thiếu (db._MIGRATIONS)
+
+Thay cho script migrate_cache_version.py trước đây: migration nào đã chạy
+được ghi vào bảng schema_migrations nên chạy lại script này luôn an toàn.
+"""
+from db import run_migrations, get_schema_version, _get_db_type
+
+def migrate():
+    print("=" * 60)
+    print(f"MIGRATING DATABASE ({_get_db_type()})")
+    print("=" * 60)
+    
+    applied = run_migrations()
+    if applied:
+        print(f"\n✓ Applied {len(applied)} migration(s): {applied}")
+    else:
+        print("\n✓ Schema already up to date")
+    
+    print(f"✓ Current schema version: {get_schema_version()}")
+    
+    print("\n" + "=" * 60)
+    print("MIGRATION COMPLETED ✓")
+    print("=" * 60)
+
+if __name__ == "__main__":
+    migrate()
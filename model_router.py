@@ -0,0 +1,143 @@
+"""Chọn model Gemini theo từng loại việc
+
+Phần lớn câu biến thể (phần trăm, dãy số, toán đố ngắn) chạy tốt trên model
+nhanh; chỉ các việc khó mới cần model pro:
+- study guide và đọc PDF đề thi
+- dạng câu/topic cấu hình trong GEMINI_PRO_TYPES / GEMINI_PRO_TOPICS
+- lần thử lại sau khi response của model nhanh không qua kiểm tra
+- model nhanh đang có tỉ lệ thành công thấp cho việc đó (chỉ xét các lời gọi trong
+  GEMINI_FAST_WINDOW_SECONDS gần nhất, hết cửa sổ thì model nhanh được thử lại)
+
+Mỗi lời gọi ghi lại latency + thành công/thất bại theo (model, task), xem get_stats().
+Thất bại chỉ tính response không qua kiểm tra (JSON/schema/đáp án); lỗi mạng/API
+(500, timeout...) chỉ được đếm riêng, không làm đổi model.
+
+Cấu hình (env hoặc Streamlit secrets):
+- GEMINI_MODEL_ROUTING: "auto" (mặc định) hoặc "pro" để luôn dùng model pro
+- GEMINI_FAST_MODEL: mặc định gemini-2.5-flash
+- GEMINI_PRO_MODEL: mặc định gemini-2.5-pro
+- GEMINI_PRO_TYPES: dạng câu luôn dùng pro, mặc định "data_sufficiency,visual_logic"
+- GEMINI_PRO_TOPICS: topic luôn dùng pro (phân cách bằng dấu phẩy), mặc định trống
+- GEMINI_FAST_MIN_SUCCESS: tỉ lệ thành công tối thiểu (%) của model nhanh, mặc định 70
+- GEMINI_FAST_WINDOW_SECONDS: cửa sổ thống kê dùng để chọn model, mặc định 600
+"""
+import asyncio
+import contextlib
+import threading
+import time
+from collections import deque
+from typing import Any, Dict, Optional
+
+from db import _get_config, _get_int_config
+from rate_limiter import RateLimitTimeout
+
+# Việc luôn cần model pro (phân tích dài, đầu vào PDF)
+PRO_TASKS = ('study_guide', 'ingest_pdf')
+
+# Cần ít nhất chừng này lần gọi (trong cửa sổ) mới xét tỉ lệ thành công của model nhanh
+_MIN_SAMPLES = 10
+# Số kết quả gần nhất giữ lại cho mỗi (model, task)
+_MAX_RECENT = 200
+
+_stats: Dict[tuple, Dict[str, float]] = {}
+_stats_lock = threading.Lock()
+
+def fast_model() -> str:
+    return str(_get_config("GEMINI_FAST_MODEL", "gemini-2.5-flash"))
+
+def pro_model() -> str:
+    return str(_get_config("GEMINI_PRO_MODEL", "gemini-2.5-pro"))
+
+def _config_set(key: str, default: str) -> set:
+    return {item.strip().lower() for item in str(_get_config(key, default)).split(",") if item.strip()}
+
+def choose_model(task: str, q_type: Optional[str] = None, topic: Optional[str] = None, attempt: int = 1) -> str:
+    """Model cho 1 lời gọi; attempt > 1 (lần trước không qua kiểm tra) thì chuyển sang pro"""
+    if str(_get_config("GEMINI_MODEL_ROUTING", "auto")).lower() == "pro" or task in PRO_TASKS or attempt > 1:
+        return pro_model()
+    if q_type and q_type.lower() in _config_set("GEMINI_PRO_TYPES", "data_sufficiency,visual_logic"):
+        return pro_model()
+    if topic and topic.lower() in _config_set("GEMINI_PRO_TOPICS", ""):
+        return pro_model()
+
+    fast = fast_model()
+    window = max(1, _get_int_config("GEMINI_FAST_WINDOW_SECONDS", 600))
+    with _stats_lock:
+        calls, ok = _recent_outcomes(_stats.get((fast, task)), time.monotonic() - window)
+    if calls >= _MIN_SAMPLES and ok * 100 < calls * _get_int_config("GEMINI_FAST_MIN_SUCCESS", 70):
+        return pro_model()
+    return fast
+
+def _recent_outcomes(stat: Optional[Dict[str, Any]], since: float) -> tuple:
+    """Gọi khi đang giữ _stats_lock: (calls, ok) của các lời gọi sau mốc `since`, bỏ kết quả cũ hơn"""
+    if not stat:
+        return 0, 0
+    recent = stat['recent']
+    while recent and recent[0][0] < since:
+        recent.popleft()
+    return sum(total for _, _, total in recent), sum(ok for _, ok, _ in recent)
+
+def record(model: str, task: str, seconds: float, ok: int = 1, total: int = 1, error: bool = False) -> None:
+    """Ghi latency + số kết quả hợp lệ (ok/total) của 1 lời gọi; error=True: lỗi mạng/API, không tính ok/total"""
+    with _stats_lock:
+        stat = _stats.setdefault((model, task), {
+            'requests': 0, 'calls': 0, 'ok': 0, 'errors': 0, 'seconds': 0.0,
+            'recent': deque(maxlen=_MAX_RECENT)
+        })
+        stat['requests'] += 1
+        stat['seconds'] += seconds
+        if error:
+            stat['errors'] += 1
+        else:
+            stat['calls'] += total
+            stat['ok'] += ok
+            stat['recent'].append((time.monotonic(), ok, total))
+    if error:
+        print(f"📊 {model} [{task}]: {seconds:.1f}s 💥 lỗi API")
+        return
+    mark = "✅" if ok == total else ("⚠️" if ok else "❌")
+    print(f"📊 {model} [{task}]: {seconds:.1f}s {mark} {ok}/{total}")
+
+def reset_stats() -> None:
+    """Xóa thống kê của process (test gọi ở đầu để không bị ảnh hưởng bởi test trước)"""
+    with _stats_lock:
+        _stats.clear()
+
+@contextlib.contextmanager
+def track(model: str, task: str):
+    """Đo 1 lời gọi: ValueError (response sai JSON/schema/đáp án) = thất bại;
+    caller có thể đặt result['ok']/result['total'] (vd. nhóm câu)"""
+    result = {'ok': 1, 'total': 1}
+    start = time.monotonic()
+    error = False
+    try:
+        yield result
+    except (asyncio.CancelledError, GeneratorExit, RateLimitTimeout):
+        # Bị hủy vì batch đã đủ câu / chưa tới lượt gọi API - không phải lỗi của model
+        result = None
+        raise
+    except ValueError:
+        result['ok'] = 0
+        raise
+    except BaseException:
+        # Lỗi mạng/API (500, timeout...) không nói gì về chất lượng response của model
+        error = True
+        raise
+    finally:
+        if result is not None:
+            record(model, task, time.monotonic() - start, result['ok'], result['total'], error)
+
+def get_stats() -> Dict[str, Dict[str, Any]]:
+    """{'model/task': {requests, calls, errors, success_rate, avg_latency}}"""
+    with _stats_lock:
+        items = [(key, dict(stat)) for key, stat in _stats.items()]
+    return {
+        f"{model}/{task}": {
+            'requests': stat['requests'],
+            'calls': stat['calls'],
+            'errors': stat['errors'],
+            'success_rate': round(stat['ok'] / stat['calls'], 3) if stat['calls'] else 0.0,
+            'avg_latency': round(stat['seconds'] / stat['requests'], 2) if stat['requests'] else 0.0
+        }
+        for (model, task), stat in items
+    }
@@ -0,0 +1,119 @@
+"""Prompt template biên dịch sẵn + ngân sách token cho prompt gửi Gemini
+
+PromptTemplate được tạo 1 lần khi import: bỏ thụt lề (khoảng trắng thừa cũng
+tốn token), tách sẵn phần chữ cố định và các chỗ {field}, tính trước số token
+của phần cố định. Mỗi lần render chỉ còn ghép chuỗi, rồi ghi lại số token
+input ước tính theo từng template (get_stats()).
+
+Dữ liệu dài (câu hỏi, lời giải...) đưa vào prompt qua compact_json() và
+fit_items(): JSON không thụt lề, cắt bớt field dài và bỏ bớt phần tử cho vừa
+ngân sách token.
+
+Cấu hình (env hoặc Streamlit secrets):
+- PROMPT_LOG_TOKENS: "0" để tắt log số token mỗi lần render
+"""
+import json
+import string
+import textwrap
+import threading
+from typing import Any, Dict, Optional, Sequence
+
+from db import _get_config
+from rate_limiter import estimate_tokens
+
+_stats: Dict[str, Dict[str, int]] = {}
+_stats_lock = threading.Lock()
+
+def compact_json(value: Any) -> str:
+    """JSON gọn nhất cho prompt: không thụt lề, không khoảng trắng sau ',' ':'"""
+    return json.dumps(value, ensure_ascii=False, separators=(',', ':'))
+
+def truncate(text: Any, max_chars: int) -> str:
+    """Cắt chuỗi về tối đa max_chars ký tự (giữ phần đầu, thêm '…')"""
+    text = '' if text is None else str(text).strip()
+    if max_chars <= 0:
+        return ''
+    if len(text) <= max_chars:
+        return text
+    return text[:max_chars - 1].rstrip() + '…'
+
+def fit_items(items: Sequence[Dict[str, Any]], max_tokens: int,
+              field_limits: Optional[Dict[str, int]] = None, min_chars: int = 40) -> str:
+    """Serialize list dict thành JSON gọn, vừa max_tokens.
+
+    field_limits: số ký tự tối đa ban đầu của từng field (field khác giữ nguyên).
+    Quá ngân sách thì giảm dần giới hạn (một nửa mỗi vòng, không dưới min_chars),
+    vẫn quá nữa thì bỏ bớt phần tử cuối và ghi chú số phần tử đã lược.
+    """
+    limits = dict(field_limits or {})
+
+    def _render(subset, dropped):
+        shrunk = [
+            {k: truncate(v, limits[k]) if k in limits and isinstance(v, str) else v for k, v in item.items()}
+            for item in subset
+        ]
+        text = compact_json(shrunk)
+        if dropped:
+            text += f"\n(… và {dropped} mục khác đã lược bớt)"
+        return text
+
+    items = list(items)
+    text = _render(items, 0)
+    while estimate_tokens(text) > max_tokens and limits and any(n > min_chars for n in limits.values()):
+        limits = {k: max(min_chars, n // 2) for k, n in limits.items()}
+        text = _render(items, 0)
+    keep = len(items)
+    while estimate_tokens(text) > max_tokens and keep > 1:
+        keep -= 1
+        text = _render(items[:keep], len(items) - keep)
+    return text
+
+class PromptTemplate:
+    """Template kiểu str.format ({field}, {{ }} là dấu ngoặc thật), biên dịch 1 lần"""
+
+    def __init__(self, name: str, text: str):
+        self.name = name
+        self._parts = []
+        fields = []
+        for literal, field, spec, conversion in string.Formatter().parse(textwrap.dedent(text).strip()):
+            self._parts.append((literal, field, spec, conversion))
+            if field and field not in fields:
+                fields.append(field)
+        self.fields = tuple(fields)
+        self.static_tokens = estimate_tokens(''.join(literal for literal, _, _, _ in self._parts))
+
+    def render(self, **values: Any) -> str:
+        missing = [f for f in self.fields if f not in values]
+        if missing:
+            raise KeyError(f"Prompt '{self.name}' thiếu field: {', '.join(missing)}")
+        out = []
+        for literal, field, spec, conversion in self._parts:
+            out.append(literal)
+            if field is None:
+                continue
+            value = values[field]
+            if conversion == 'r':
+                value = repr(value)
+            elif conversion == 's':
+                value = str(value)
+            out.append(format(value, spec or ''))
+        prompt = ''.join(out)
+        _record(self.name, estimate_tokens(prompt))
+        return prompt
+
+def _record(name: str, tokens: int):
+    with _stats_lock:
+        stat = _stats.setdefault(name, {'calls': 0, 'tokens_total': 0, 'tokens_max': 0})
+        stat['calls'] += 1
+        stat['tokens_total'] += tokens
+        stat['tokens_max'] = max(stat['tokens_max'], tokens)
+    if str(_get_config("PROMPT_LOG_TOKENS", "1")).lower() not in ("0", "false", "no"):
+        print(f"📏 Prompt '{name}': ~{tokens} input tokens")
+
+def get_stats() -> Dict[str, Dict[str, int]]:
+    """Số lần render + token input ước tính (tổng, trung bình, lớn nhất) theo template"""
+    with _stats_lock:
+        stats = {name: dict(stat) for name, stat in _stats.items()}
+    for stat in stats.values():
+        stat['tokens_avg'] = stat['tokens_total'] // stat['calls'] if stat['calls'] else 0
+    return stats
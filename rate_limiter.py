@@ -0,0 +1,322 @@
+"""Rate limiter dùng chung cho mọi lời gọi Gemini
+
+Token bucket theo 2 giới hạn của Gemini API: số request/phút (RPM) và số
+token/phút (TPM). Một limiter được chia sẻ giữa mọi thread trong process;
+bật GEMINI_RATE_LIMIT_SHARED để nhiều process (nhiều instance Azure/Streamlit)
+cùng trừ chung 1 bucket lưu trong database.
+
+Cấu hình (env hoặc Streamlit secrets):
+- GEMINI_RPM: request/phút, mặc định 5
+- GEMINI_TPM: token/phút, 0 = không giới hạn (mặc định)
+- GEMINI_RATE_LIMIT_SHARED: "1" để dùng bucket chung qua database
+- GEMINI_RATE_LIMIT_SHARED_RETRY: số giây dùng tạm bucket trong process khi
+  database lỗi rồi mới thử lại bucket chung, mặc định 60
+- GEMINI_BACKGROUND_RESERVE: số lượt luôn để dành cho request của user; request
+  nền (background_priority, vd. exam_pool) chỉ dùng phần dư, mặc định 1
+"""
+import asyncio
+import contextlib
+import contextvars
+import re
+import threading
+import time
+from typing import Any, Awaitable, Callable, Dict, Optional
+
+from db import _get_config, _get_int_config
+
+class RateLimitTimeout(Exception):
+    """Không lấy được lượt gọi API trong thời gian chờ cho phép"""
+
+# True trong background_priority(); coroutine gửi sang loop gemini_async mang theo context của thread gửi
+_background = contextvars.ContextVar("rate_limit_background", default=False)
+
+@contextlib.contextmanager
+def background_priority():
+    """Lời gọi Gemini trong khối này nhường lượt cho request của user.
+
+    Request nền chỉ được đi khi không có request thường nào đang chờ lượt và bucket RPM
+    còn dư hơn background_reserve lượt. Ưu tiên chỉ áp dụng cho bucket trong process.
+    """
+    token = _background.set(True)
+    try:
+        yield
+    finally:
+        _background.reset(token)
+
+class _Bucket:
+    """Token bucket: đầy `capacity`, hồi `capacity` token mỗi 60 giây"""
+
+    def __init__(self, per_minute: int):
+        self.capacity = float(per_minute)
+        self.rate = per_minute / 60.0
+        self.tokens = float(per_minute)
+        self.updated = time.monotonic()
+
+    def _refill(self, now: float):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self, amount: float, now: float) -> float:
+        self._refill(now)
+        # Request lớn hơn cả bucket: cho đi khi bucket đầy thay vì chờ mãi
+        amount = min(amount, self.capacity)
+        if self.tokens >= amount:
+            return 0.0
+        return (amount - self.tokens) / self.rate
+
+    def take(self, amount: float):
+        self.tokens -= min(amount, self.capacity)
+
+class RateLimiter:
+    """Giới hạn RPM/TPM cho 1 nhóm lời gọi API (thread-safe)"""
+
+    def __init__(self, name: str, rpm: int, tpm: int = 0, shared: bool = False, background_reserve: int = 1):
+        self.name = name
+        self.rpm = rpm
+        self.tpm = tpm
+        self.shared = shared
+        # reserve < rpm: RPM rất thấp thì request nền vẫn có lúc được đi khi bucket đầy
+        self.background_reserve = max(0, min(background_reserve, rpm - 1))
+        self._foreground_waiting = 0  # số request thường đang chờ lượt
+        self._requests = _Bucket(rpm) if rpm > 0 else None
+        self._tokens = _Bucket(tpm) if tpm > 0 else None
+        self._blocked_until = 0.0  # time.monotonic() - sau khi server trả 429 + Retry-After
+        self._shared_retry_at = 0.0  # time.monotonic() - bucket chung lỗi, tạm dùng bucket trong process
+        self._cond = threading.Condition()
+        self.stats = {'acquired': 0, 'waited_seconds': 0.0, 'throttled': 0}
+
+    def _try_take(self, tokens: int, started: float, background: bool = False) -> float:
+        """Gọi khi đang giữ self._cond: đủ lượt thì trừ luôn và trả về 0, không thì trả về số giây phải chờ"""
+        now = time.monotonic()
+        wait = max(0.0, self._blocked_until - now)
+        if self._requests is not None:
+            # Request nền chờ tới khi bucket còn dư background_reserve lượt sau khi trừ
+            wait = max(wait, self._requests.wait_time(1 + (self.background_reserve if background else 0), now))
+        if background and self._foreground_waiting:
+            wait = max(wait, 1.0)
+        if self._tokens is not None and tokens:
+            wait = max(wait, self._tokens.wait_time(tokens, now))
+        if wait > 0:
+            return wait
+        if self._requests is not None:
+            self._requests.take(1)
+        if self._tokens is not None and tokens:
+            self._tokens.take(tokens)
+        self.stats['acquired'] += 1
+        self.stats['waited_seconds'] += now - started
+        return 0.0
+
+    def acquire(self, tokens: int = 0, timeout: Optional[float] = None):
+        """Chờ tới khi được phép gửi 1 request ước tính `tokens` token"""
+        started = time.monotonic()
+        deadline = started + timeout if timeout is not None else None
+        if self._use_shared() and not self._acquire_shared(tokens, deadline):
+            raise RateLimitTimeout(f"Rate limiter '{self.name}': timeout")
+        background = _background.get()
+        waiting = False
+        with self._cond:
+            try:
+                while True:
+                    wait = self._try_take(tokens, started, background)
+                    if wait <= 0:
+                        return
+                    if deadline is not None and time.monotonic() + wait > deadline:
+                        raise RateLimitTimeout(f"Rate limiter '{self.name}': cần chờ {wait:.1f}s")
+                    if not background and not waiting:
+                        self._foreground_waiting += 1
+                        waiting = True
+                    self._cond.wait(wait)
+            finally:
+                if waiting:
+                    self._foreground_waiting -= 1
+                    self._cond.notify_all()
+
+    async def acquire_async(self, tokens: int = 0, timeout: Optional[float] = None):
+        """Bản asyncio của acquire: chờ bằng asyncio.sleep trên event loop, chỉ trừ lượt khi đã tới lượt.
+
+        Hủy task lúc đang chờ (batch đã đủ câu, hết deadline...) thì không giữ thread nào
+        và không tốn lượt gọi API.
+        """
+        started = time.monotonic()
+        deadline = started + timeout if timeout is not None else None
+        if self._use_shared() and not await self._acquire_shared_async(tokens, deadline):
+            raise RateLimitTimeout(f"Rate limiter '{self.name}': timeout")
+        background = _background.get()
+        waiting = False
+        try:
+            while True:
+                with self._cond:
+                    wait = self._try_take(tokens, started, background)
+                    if wait > 0 and not background and not waiting:
+                        self._foreground_waiting += 1
+                        waiting = True
+                if wait <= 0:
+                    return
+                if deadline is not None and time.monotonic() + wait > deadline:
+                    raise RateLimitTimeout(f"Rate limiter '{self.name}': cần chờ {wait:.1f}s")
+                # Ngủ tối đa 1s rồi tính lại: settle()/block_for() có thể đổi thời gian chờ
+                await asyncio.sleep(min(wait, 1.0))
+        finally:
+            if waiting:
+                with self._cond:
+                    self._foreground_waiting -= 1
+                    self._cond.notify_all()
+
+    def _use_shared(self) -> bool:
+        return self.shared and time.monotonic() >= self._shared_retry_at
+
+    def _acquire_shared(self, tokens: int, deadline: Optional[float]) -> bool:
+        """Trừ lượt ở bucket chung trong DB; lỗi DB thì chỉ dùng bucket trong process"""
+        while True:
+            wait = self._take_shared(tokens)
+            if wait <= 0:
+                return True
+            if deadline is not None and time.monotonic() + wait > deadline:
+                return False
+            time.sleep(min(wait, 5.0))
+
+    async def _acquire_shared_async(self, tokens: int, deadline: Optional[float]) -> bool:
+        """Bản asyncio của _acquire_shared: chỉ truy vấn DB ở thread phụ, chờ bằng asyncio.sleep"""
+        while True:
+            wait = await asyncio.to_thread(self._take_shared, tokens)
+            if wait <= 0:
+                return True
+            if deadline is not None and time.monotonic() + wait > deadline:
+                return False
+            await asyncio.sleep(min(wait, 5.0))
+
+    def _take_shared(self, tokens: int) -> float:
+        """1 lần thử trừ lượt ở bucket chung: 0 = đã trừ, > 0 = số giây phải chờ"""
+        from db import take_rate_limit_tokens
+        try:
+            return take_rate_limit_tokens(self.name, self.rpm, tokens, self.tpm)
+        except Exception as e:
+            # Không tắt hẳn bucket chung: DB lỗi tạm thời thì sau cooldown thử lại
+            cooldown = max(1, _get_int_config("GEMINI_RATE_LIMIT_SHARED_RETRY", 60))
+            print(f"⚠️ Shared rate limit unavailable, using local limiter for {cooldown}s: {e}")
+            self._shared_retry_at = time.monotonic() + cooldown
+            return 0.0
+
+    def settle(self, estimated_tokens: int, actual_tokens: Optional[int]):
+        """Điều chỉnh bucket TPM theo số token thực tế (usage_metadata) sau khi gọi xong"""
+        if self._tokens is None or not actual_tokens:
+            return
+        with self._cond:
+            self._tokens.tokens -= actual_tokens - estimated_tokens
+            self._cond.notify_all()
+
+    def block_for(self, seconds: float):
+        """Server báo 429: dừng mọi request của limiter này trong `seconds` giây"""
+        with self._cond:
+            self._blocked_until = max(self._blocked_until, time.monotonic() + seconds)
+            self.stats['throttled'] += 1
+            self._cond.notify_all()
+        if self._use_shared():
+            try:
+                from db import block_rate_limit
+                block_rate_limit(self.name, seconds)
+            except Exception as e:
+                print(f"⚠️ Could not share rate-limit backoff: {e}")
+
+_limiters: Dict[str, RateLimiter] = {}
+_limiters_lock = threading.Lock()
+
+def get_limiter(name: str = "gemini") -> RateLimiter:
+    """Limiter dùng chung của process theo tên (mặc định 1 bucket cho toàn bộ Gemini)"""
+    with _limiters_lock:
+        limiter = _limiters.get(name)
+        if limiter is None:
+            limiter = RateLimiter(
+                name,
+                rpm=_get_int_config("GEMINI_RPM", 5),
+                tpm=_get_int_config("GEMINI_TPM", 0),
+                shared=str(_get_config("GEMINI_RATE_LIMIT_SHARED", "0")).lower() in ("1", "true", "yes"),
+                background_reserve=_get_int_config("GEMINI_BACKGROUND_RESERVE", 1)
+            )
+            _limiters[name] = limiter
+        return limiter
+
+def estimate_tokens(text: Any) -> int:
+    """Ước tính thô số token input (~4 ký tự/token) khi chưa có số liệu thật"""
+    if not isinstance(text, str):
+        return 0
+    return len(text) // 4 + 1
+
+def is_rate_limit_error(exc: Exception) -> bool:
+    """Lỗi 429 thật của API (code/status của google-genai APIError), không đoán theo chữ trong message"""
+    if getattr(exc, 'code', None) == 429 or getattr(exc, 'status_code', None) == 429:
+        return True
+    return getattr(exc, 'status', None) == 'RESOURCE_EXHAUSTED'
+
+def time_left(deadline: Optional[float]) -> Optional[float]:
+    """Số giây còn lại tới deadline (time.monotonic()); None = không giới hạn"""
+    if deadline is None:
+        return None
+    return max(0.0, deadline - time.monotonic())
+
+def _wait_rate_limit(limiter: RateLimiter, exc: Exception, attempt: int, max_retries: int,
+                     deadline: Optional[float]):
+    """Server trả 429: chặn limiter theo Retry-After; chờ vượt deadline thì báo RateLimitTimeout luôn"""
+    wait = retry_after_seconds(exc)
+    limiter.block_for(wait)
+    if deadline is not None and time.monotonic() + wait > deadline:
+        raise RateLimitTimeout(f"Rate limiter '{limiter.name}': Retry-After {wait:.0f}s vượt deadline") from exc
+    print(f"⏳ Gemini 429 - chờ {wait:.0f}s theo Retry-After (lần {attempt + 1}/{max_retries})")
+
+def retry_after_seconds(exc: Exception, default: float = 30.0) -> float:
+    """Đọc thời gian chờ server yêu cầu (header Retry-After hoặc retryDelay trong body lỗi)"""
+    response = getattr(exc, 'response', None)
+    headers = getattr(response, 'headers', None)
+    if headers:
+        try:
+            value = headers.get('Retry-After') or headers.get('retry-after')
+            if value:
+                return max(0.0, float(value))
+        except (TypeError, ValueError):
+            pass
+    msg = str(exc)
+    match = re.search(r"retryDelay['\"]?\s*[:=]\s*['\"]?(\d+(?:\.\d+)?)s", msg) \
+        or re.search(r"retry in (\d+(?:\.\d+)?)\s*s", msg, flags=re.IGNORECASE)
+    if match:
+        return float(match.group(1))
+    return default
+
+def rate_limited_call(fn: Callable[[], Any], *, estimated_tokens: int = 0, limiter: Optional[RateLimiter] = None,
+                      max_rate_limit_retries: int = 3, timeout: Optional[float] = None) -> Any:
+    """Gọi fn() sau khi lấy lượt từ limiter; gặp 429 thì chờ đúng Retry-After rồi thử lại.
+
+    timeout là tổng thời gian cho cả lần gọi (mọi lần chờ lượt + Retry-After), không tính lại mỗi lần thử.
+    """
+    limiter = limiter or get_limiter()
+    deadline = time.monotonic() + timeout if timeout is not None else None
+    for attempt in range(max_rate_limit_retries + 1):
+        limiter.acquire(estimated_tokens, timeout=time_left(deadline))
+        try:
+            response = fn()
+        except Exception as e:
+            if not is_rate_limit_error(e) or attempt >= max_rate_limit_retries:
+                raise
+            _wait_rate_limit(limiter, e, attempt, max_rate_limit_retries, deadline)
+            continue
+        usage = getattr(response, 'usage_metadata', None)
+        limiter.settle(estimated_tokens, getattr(usage, 'total_token_count', None))
+        return response
+
+async def rate_limited_call_async(fn: Callable[[], Awaitable[Any]], *, estimated_tokens: int = 0,
+                                  limiter: Optional[RateLimiter] = None, max_rate_limit_retries: int = 3,
+                                  timeout: Optional[float] = None) -> Any:
+    """Bản async của rate_limited_call: chờ lượt ngay trên event loop (limiter.acquire_async)"""
+    limiter = limiter or get_limiter()
+    deadline = time.monotonic() + timeout if timeout is not None else None
+    for attempt in range(max_rate_limit_retries + 1):
+        await limiter.acquire_async(estimated_tokens, time_left(deadline))
+        try:
+            response = await fn()
+        except Exception as e:
+            if not is_rate_limit_error(e) or attempt >= max_rate_limit_retries:
+                raise
+            _wait_rate_limit(limiter, e, attempt, max_rate_limit_retries, deadline)
+            continue
+        usage = getattr(response, 'usage_metadata', None)
+        limiter.settle(estimated_tokens, getattr(usage, 'total_token_count', None))
+        return response
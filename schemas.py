@@ -0,0 +1,113 @@
+"""Schema JSON cho structured output của Gemini
+
+Truyền vào config['response_schema'] để Gemini trả đúng cấu trúc ngay từ đầu,
+và dùng lại với validate() để kiểm tra nhanh kết quả (thay cho regex sửa JSON).
+Định dạng dict theo types.Schema của google-genai (type viết hoa).
+"""
+from typing import Any, Dict, List
+
+QUESTION_FIELDS = ['question', 'options', 'step_by_step_thinking', 'correct_answer', 'explanation']
+
+QUESTION_SCHEMA: Dict[str, Any] = {
+    'type': 'OBJECT',
+    'properties': {
+        'question': {'type': 'STRING'},
+        'options': {'type': 'ARRAY', 'items': {'type': 'STRING'}},
+        'step_by_step_thinking': {'type': 'STRING'},
+        'correct_answer': {'type': 'STRING'},
+        'explanation': {'type': 'STRING'}
+    },
+    'required': QUESTION_FIELDS,
+    'property_ordering': QUESTION_FIELDS
+}
+
+# Nhiều câu trong 1 request: mỗi phần tử gắn seed_index của câu mẫu
+QUESTION_GROUP_SCHEMA: Dict[str, Any] = {
+    'type': 'ARRAY',
+    'items': {
+        'type': 'OBJECT',
+        'properties': {'seed_index': {'type': 'INTEGER'}, **QUESTION_SCHEMA['properties']},
+        'required': ['seed_index'] + QUESTION_FIELDS,
+        'property_ordering': ['seed_index'] + QUESTION_FIELDS
+    }
+}
+
+_STRING_LIST = {'type': 'ARRAY', 'items': {'type': 'STRING'}}
+
+TOPIC_GUIDE_FIELDS = [
+    'theory', 'detailed_concepts', 'step_by_step_method', 'mistake_analysis', 'common_mistakes',
+    'tips_for_accuracy', 'tips_for_speed', 'practice_drills', 'key_formulas'
+]
+
+TOPIC_GUIDE_SCHEMA: Dict[str, Any] = {
+    'type': 'OBJECT',
+    'properties': {
+        'theory': {'type': 'STRING'},
+        'detailed_concepts': {
+            'type': 'ARRAY',
+            'items': {
+                'type': 'OBJECT',
+                'properties': {
+                    'concept_name': {'type': 'STRING'},
+                    'explanation': {'type': 'STRING'},
+                    'example': {'type': 'STRING'}
+                },
+                'required': ['concept_name', 'explanation', 'example'],
+                'property_ordering': ['concept_name', 'explanation', 'example']
+            }
+        },
+        'step_by_step_method': _STRING_LIST,
+        'mistake_analysis': {
+            'type': 'ARRAY',
+            'items': {
+                'type': 'OBJECT',
+                'properties': {
+                    'question_summary': {'type': 'STRING'},
+                    'user_mistake': {'type': 'STRING'},
+                    'why_wrong': {'type': 'STRING'},
+                    'correct_approach': {'type': 'STRING'}
+                },
+                'required': ['question_summary', 'user_mistake', 'why_wrong', 'correct_approach'],
+                'property_ordering': ['question_summary', 'user_mistake', 'why_wrong', 'correct_approach']
+            }
+        },
+        'common_mistakes': _STRING_LIST,
+        'tips_for_accuracy': _STRING_LIST,
+        'tips_for_speed': _STRING_LIST,
+        'practice_drills': _STRING_LIST,
+        'key_formulas': _STRING_LIST
+    },
+    'required': TOPIC_GUIDE_FIELDS,
+    'property_ordering': TOPIC_GUIDE_FIELDS
+}
+
+_PY_TYPES = {
+    'STRING': str,
+    'NUMBER': (int, float),
+    'BOOLEAN': bool,
+    'ARRAY': list,
+    'OBJECT': dict,
+}
+
+def validate(value: Any, schema: Dict[str, Any], path: str = '$') -> List[str]:
+    """Kiểm tra value theo schema (type + required, đệ quy). Trả về danh sách lỗi, rỗng = hợp lệ."""
+    expected = schema.get('type')
+    if expected == 'INTEGER':
+        ok = isinstance(value, int) and not isinstance(value, bool)
+    else:
+        ok = isinstance(value, _PY_TYPES.get(expected, object))
+    if not ok:
+        return [f"{path}: expected {expected}, got {type(value).__name__}"]
+
+    errors = []
+    if expected == 'OBJECT':
+        for key in schema.get('required', []):
+            if key not in value:
+                errors.append(f"{path}.{key}: missing")
+        for key, sub in schema.get('properties', {}).items():
+            if key in value:
+                errors.extend(validate(value[key], sub, f"{path}.{key}"))
+    elif expected == 'ARRAY' and 'items' in schema:
+        for i, item in enumerate(value):
+            errors.extend(validate(item, schema['items'], f"{path}[{i}]"))
+    return errors
@@ -2,49 +2,86 @@ import google.genai as genai
 import os
 import json
 import re
+import threading
+import time
+from collections import OrderedDict
 from pathlib import Path
 from typing import List, Dict, Any
 from functools import lru_cache
 
+from prompts import PromptTemplate, fit_items
+from schemas import TOPIC_GUIDE_FIELDS, TOPIC_GUIDE_SCHEMA, validate
+import write_behind
+
+# LRU trong process đứng trước bảng study_guide_cache: topic -> [version, guide, lần kiểm tra version cuối]
+# (số topic GMAT ít, guide đọc nhiều hơn ghi rất nhiều). version None = guide vừa submit, chưa ghi xong DB.
+_guide_lru: "OrderedDict[str, list]" = OrderedDict()
+_guide_lru_lock = threading.Lock()
+_guide_lru_stats = {'hits': 0, 'revalidated': 0, 'misses': 0}
+
+def _guide_lru_config():
+    """(STUDY_GUIDE_LRU_SIZE, STUDY_GUIDE_LRU_TTL) - size 0 = tắt LRU"""
+    from db import _get_int_config
+    return max(0, _get_int_config("STUDY_GUIDE_LRU_SIZE", 64)), max(0, _get_int_config("STUDY_GUIDE_LRU_TTL", 30))
+
+def _guide_lru_put(topic_name: str, version, guide: Dict[str, Any]) -> None:
+    size, _ = _guide_lru_config()
+    if not size:
+        return
+    with _guide_lru_lock:
+        _guide_lru[topic_name] = [version, guide, time.monotonic()]
+        _guide_lru.move_to_end(topic_name)
+        while len(_guide_lru) > size:
+            _guide_lru.popitem(last=False)
+
+def get_guide_cache_stats() -> Dict[str, int]:
+    """Số lookup trúng LRU / phải kiểm tra version với DB / phải đọc guide từ DB"""
+    with _guide_lru_lock:
+        stats = dict(_guide_lru_stats)
+        stats['size'] = len(_guide_lru)
+    return stats
+
 def _get_cached_guide(topic_name: str) -> Dict[str, Any] | None:
-    """Lấy study guide từ cache DB nếu có"""
-    try:
-        from db import get_conn, _get_db_type
-        db_type = _get_db_type()
-        
-        with get_conn() as conn:
-            c = conn.cursor()
-            if db_type == "postgresql":
-                c.execute(
-                    """UPDATE study_guide_cache 
-                       SET accessed_count = accessed_count + 1, last_accessed_at = CURRENT_TIMESTAMP 
-                       WHERE topic = %s 
-                       RETURNING guide_data""",
-                    (topic_name,)
-                )
-                row = c.fetchone()
-                conn.commit()
-                if row:
-                    return row[0]  # JSONB automatically parsed
-            else:
-                c.execute("SELECT guide_data FROM study_guide_cache WHERE topic = ?", (topic_name,))
-                row = c.fetchone()
-                if row:
-                    c.execute(
-                        """UPDATE study_guide_cache 
-                           SET accessed_count = accessed_count + 1, last_accessed_at = CURRENT_TIMESTAMP 
-                           WHERE topic = ?""",
-                        (topic_name,)
-                    )
-                    conn.commit()
-                    return json.loads(row[0])
-        return None
-    except Exception as e:
-        print(f"⚠️ Cache lookup error for '{topic_name}': {e}")
-        return None
+    """Lấy study guide từ cache (LRU trong process, rồi DB) nếu có"""
+    return get_cached_guides([topic_name]).get(topic_name)
 
-def _save_guide_to_cache(topic_name: str, guide_data: Dict[str, Any]) -> None:
-    """Lưu study guide vào cache DB - increment version nếu update lại cùng topic"""
+def get_cached_guides(topics: List[str]) -> Dict[str, Dict[str, Any]]:
+    """Lấy study guide của nhiều topic -> {topic: guide} (topic chưa có cache thì không có key)
+
+    Cả danh sách topic chỉ tốn tối đa 1 round trip DB: các topic cần đọc được gom vào
+    1 truy vấn WHERE topic = ANY(...) / IN (...), thay vì 1 truy vấn cho mỗi topic.
+
+    Topic có trong LRU và mới kiểm tra version trong STUDY_GUIDE_LRU_TTL giây thì trả
+    luôn, không chạm DB. Entry quá TTL đi cùng truy vấn đó kèm version đang có; guide_data
+    chỉ được trả về + parse lại cho topic chưa có trong LRU hoặc đã đổi version (process khác ghi).
+    Chỉ đọc (không mở transaction ghi khi cache hit); lượt đọc được gom trong
+    hàng đợi write_behind và cập nhật accessed_count theo lô (_write_guide_access).
+    """
+    topic_names = list(dict.fromkeys(topics))
+    if not topic_names:
+        return {}
+    size, ttl = _guide_lru_config()
+    now = time.monotonic()
+    guides = {}
+    stale = {}  # topic -> version trong LRU, cần so với DB
+    if size:
+        with _guide_lru_lock:
+            for topic in topic_names:
+                entry = _guide_lru.get(topic)
+                if entry is None:
+                    continue
+                _guide_lru.move_to_end(topic)
+                if now - entry[2] < ttl:
+                    guides[topic] = dict(entry[1])
+                else:
+                    stale[topic] = entry[0]
+            _guide_lru_stats['hits'] += len(guides)
+    lookup = [t for t in topic_names if t not in guides]
+    if not lookup:
+        write_behind.submit('study_guide_access', list(guides))
+        return guides
+    # Entry quá TTL gửi kèm version đang có: cùng version thì DB trả guide_data NULL (không đọc + parse lại)
+    known = {t: v for t, v in stale.items() if v is not None}
     try:
         from db import get_conn, _get_db_type
         db_type = _get_db_type()
@@ -52,33 +89,128 @@ def _save_guide_to_cache(topic_name: str, guide_data: Dict[str, Any]) -> None:
         with get_conn() as conn:
             c = conn.cursor()
             if db_type == "postgresql":
-                import psycopg2.extras
-                # ON CONFLICT: Update guide_data + increment version + update timestamp
                 c.execute(
-                    """INSERT INTO study_guide_cache (topic, guide_data, version) 
-                       VALUES (%s, %s, 1) 
-                       ON CONFLICT (topic) DO UPDATE SET 
-                           guide_data = EXCLUDED.guide_data,
-                           version = study_guide_cache.version + 1,
-                           updated_at = CURRENT_TIMESTAMP""",
-                    (topic_name, psycopg2.extras.Json(guide_data))
+                    """SELECT topic, version, 
+                           CASE WHEN (topic, version) IN (SELECT * FROM unnest(%s::text[], %s::int[])) 
+                                THEN NULL ELSE guide_data END 
+                       FROM study_guide_cache WHERE topic = ANY(%s)""",
+                    (list(known), list(known.values()), lookup)
                 )
+                rows = c.fetchall()  # JSONB automatically parsed
             else:
-                # SQLite: Check if exists first
-                c.execute("SELECT version FROM study_guide_cache WHERE topic = ?", (topic_name,))
-                row = c.fetchone()
-                new_version = (row[0] + 1) if row else 1
-                
+                unchanged = "(topic, version) IN (VALUES " + ",".join(["(?, ?)"] * len(known)) + ")" if known else "0"
+                placeholders = ",".join("?" * len(lookup))
                 c.execute(
-                    """INSERT OR REPLACE INTO study_guide_cache 
-                       (topic, guide_data, version, updated_at) 
-                       VALUES (?, ?, ?, CURRENT_TIMESTAMP)""",
-                    (topic_name, json.dumps(guide_data, ensure_ascii=False), new_version)
+                    f"""SELECT topic, version, CASE WHEN {unchanged} THEN NULL ELSE guide_data END 
+                        FROM study_guide_cache WHERE topic IN ({placeholders})""",
+                    [x for item in known.items() for x in item] + lookup
                 )
-            conn.commit()
-            print(f"💾 Cached guide for '{topic_name}' to database")
+                rows = [(row[0], row[1], json.loads(row[2]) if row[2] is not None else None) for row in c.fetchall()]
     except Exception as e:
-        print(f"⚠️ Cache save error for '{topic_name}': {e}")
+        print(f"⚠️ Cache lookup error for {len(lookup)} topics: {e}")
+        return guides
+    
+    found = set()
+    revalidated = 0
+    with _guide_lru_lock:
+        for topic, version, guide in rows:
+            found.add(topic)
+            entry = _guide_lru.get(topic)
+            if guide is None and entry is not None:
+                entry[2] = now
+                guides[topic] = dict(entry[1])
+                revalidated += 1
+        _guide_lru_stats['revalidated'] += revalidated
+        _guide_lru_stats['misses'] += len(lookup) - revalidated
+        for topic in lookup:
+            if topic not in found:
+                _guide_lru.pop(topic, None)  # đã bị xóa khỏi DB
+    for topic, version, guide in rows:
+        if guide is not None:
+            _guide_lru_put(topic, version, guide)
+            guides[topic] = dict(guide)
+    if guides:
+        write_behind.submit('study_guide_access', list(guides))
+    return guides
+
+def _write_guide_access(key, batches: List[List[str]]) -> None:
+    """Handler write_behind: cộng dồn lượt đọc theo topic trong cả chu kỳ rồi cập nhật 1 lần
+
+    10 user cùng đọc 1 topic -> 1 dòng accessed_count + 10, không phải 10 lệnh UPDATE.
+    """
+    from collections import Counter
+    from db import get_conn, _get_db_type
+    counts = Counter(topic for topics in batches for topic in topics)
+    if not counts:
+        return
+    db_type = _get_db_type()
+    
+    with get_conn() as conn:
+        c = conn.cursor()
+        if db_type == "postgresql":
+            import psycopg2.extras
+            psycopg2.extras.execute_values(
+                c,
+                """UPDATE study_guide_cache AS s 
+                   SET accessed_count = s.accessed_count + v.hits, last_accessed_at = CURRENT_TIMESTAMP 
+                   FROM (VALUES %s) AS v(topic, hits) 
+                   WHERE s.topic = v.topic""",
+                list(counts.items())
+            )
+        else:
+            c.executemany(
+                """UPDATE study_guide_cache 
+                   SET accessed_count = accessed_count + ?, last_accessed_at = CURRENT_TIMESTAMP 
+                   WHERE topic = ?""",
+                [(hits, topic) for topic, hits in counts.items()]
+            )
+        conn.commit()
+
+def _save_guide_to_cache(topic_name: str, guide_data: Dict[str, Any]) -> None:
+    """Lưu study guide vào cache DB (qua write_behind, không chặn script) - LRU có guide mới ngay"""
+    _guide_lru_put(topic_name, None, dict(guide_data))
+    write_behind.submit('study_guide_cache', guide_data, key=topic_name)
+
+def _write_guide_to_cache(topic_name: str, guides: List[Dict[str, Any]]) -> None:
+    """Handler write_behind: lưu guide mới nhất của topic - increment version nếu update lại cùng topic"""
+    from db import get_conn, _get_db_type
+    db_type = _get_db_type()
+    guide_data = guides[-1]
+    
+    with get_conn() as conn:
+        c = conn.cursor()
+        if db_type == "postgresql":
+            import psycopg2.extras
+            # ON CONFLICT: Update guide_data + increment version + update timestamp
+            c.execute(
+                """INSERT INTO study_guide_cache (topic, guide_data, version) 
+                   VALUES (%s, %s, 1) 
+                   ON CONFLICT (topic) DO UPDATE SET 
+                       guide_data = EXCLUDED.guide_data,
+                       version = study_guide_cache.version + 1,
+                       updated_at = CURRENT_TIMESTAMP
+                   RETURNING version""",
+                (topic_name, psycopg2.extras.Json(guide_data))
+            )
+            new_version = c.fetchone()[0]
+        else:
+            # SQLite: Check if exists first
+            c.execute("SELECT version FROM study_guide_cache WHERE topic = ?", (topic_name,))
+            row = c.fetchone()
+            new_version = (row[0] + 1) if row else 1
+            
+            c.execute(
+                """INSERT OR REPLACE INTO study_guide_cache 
+                   (topic, guide_data, version, updated_at) 
+                   VALUES (?, ?, ?, CURRENT_TIMESTAMP)""",
+                (topic_name, json.dumps(guide_data, ensure_ascii=False), new_version)
+            )
+        conn.commit()
+    _guide_lru_put(topic_name, new_version, dict(guide_data))
+    print(f"💾 Cached guide for '{topic_name}' to database")
+
+write_behind.register('study_guide_access', _write_guide_access)
+write_behind.register('study_guide_cache', _write_guide_to_cache)
 
 @lru_cache(maxsize=1)
 def _get_api_key() -> str | None:
@@ -108,21 +240,6 @@ def _get_study_model():
         print(f"Lỗi khởi tạo Study Model: {e}")
         return None
 
-@lru_cache(maxsize=1)
-def _get_study_model():
-    """Khởi tạo model Gemini cho ôn tập"""
-    key = _get_api_key()
-    if not key:
-        print("GEMINI_API_KEY not found")
-        return None
-    
-    try:
-        # Create client with API key for google-genai v1.56+
-        client = genai.Client(api_key=key)
-        return client
-    except Exception as e:
-        print(f"Lỗi khởi tạo Study Model: {e}")
-        return None
 
 def _get_topic_knowledge_base():
     """Cơ sở dữ liệu kiến thức chi tiết cho từng topic GMAT"""
@@ -447,178 +564,17 @@ Bước 4: Thử ghép quy luật đã tìm được để suy ra số tiếp th
         }
     }
 
-def generate_study_guide(questions: List[Dict[str, Any]], user_answers: Dict[str, str]) -> Dict[str, Any]:
-    """
-    Tạo tài liệu ôn tập chi tiết dựa trên các câu hỏi trong bài thi
-    
-    Args:
-        questions: Danh sách các câu hỏi trong bài thi
-        user_answers: Dict chứa câu trả lời của user {q_0: 'A. ...', q_1: 'B. ...'}
-    
-    Returns:
-        Dict chứa nội dung ôn tập theo từng topic
-    """
-    model = _get_study_model()
-    if not model:
-        return {
-            "error": "Không thể kết nối đến AI. Vui lòng kiểm tra API key.",
-            "topics": []
-        }
-    
-    # Phân tích câu sai và đúng theo topic - GIỮ TOÀN BỘ THÔNG TIN
-    topic_analysis = {}
-    
-    for idx, q in enumerate(questions):
-        topic = q.get('topic', 'General')
-        qtype = q.get('type', 'general')
-        user_choice = user_answers.get(f"q_{idx}")
-        correct_answer = q.get('correct_answer', '')
-        
-        is_correct = False
-        if user_choice and correct_answer:
-            if user_choice.split('.')[0] == correct_answer.split('.')[0]:
-                is_correct = True
-        
-        if topic not in topic_analysis:
-            topic_analysis[topic] = {
-                'type': qtype,
-                'total': 0,
-                'correct': 0,
-                'wrong': 0,
-                'questions': [],
-                'wrong_questions': []  # Tách riêng câu sai để ưu tiên phân tích
-            }
-        
-        topic_analysis[topic]['total'] += 1
-        if is_correct:
-            topic_analysis[topic]['correct'] += 1
-        else:
-            topic_analysis[topic]['wrong'] += 1
-        
-        # Lưu TOÀN BỘ thông tin câu hỏi (không cắt ngắn)
-        question_data = {
-            'question': q.get('question', ''),
-            'options': q.get('options', []),
-            'user_choice': user_choice,
-            'correct_answer': correct_answer,
-            'explanation': q.get('explanation', ''),
-            'step_by_step_thinking': q.get('step_by_step_thinking', ''),
-            'is_correct': is_correct
-        }
-        
-        topic_analysis[topic]['questions'].append(question_data)
-        if not is_correct:
-            topic_analysis[topic]['wrong_questions'].append(question_data)
-    
-    # XỬ LÝ TỪNG CHỦ ĐỀ MỘT - ƯU TIÊN CHỦ ĐỀ CÓ NHIỀU CÂU SAI
-    sorted_topics = sorted(
-        topic_analysis.items(),
-        key=lambda x: (x[1]['wrong'], -x[1]['total']),  # Sắp theo số câu sai (nhiều nhất trước)
-        reverse=True
-    )
-    
-    all_topics_guides = []
-
-    def _looks_generic_guide(guide: Dict[str, Any]) -> bool:
-        """Heuristic to catch vague/short guides and force richer fallback."""
-        theory_val = guide.get('theory')
-        # Accept both string and structured theory; serialize safely
-        if isinstance(theory_val, dict):
-            theory = json.dumps(theory_val, ensure_ascii=False)
-        else:
-            theory = str(theory_val or '')
-        theory = theory.strip()
-        if len(theory) < 500:
-            return True
-        lowered = theory.lower()
-        generic_markers = [
-            'xem lại', 'cần ôn', 'ôn lại từ đầu', 'xem sách giáo khoa', 'luyện tập thêm để', 'cơ bản'
-        ]
-        if any(m in lowered for m in generic_markers):
-            return True
-        concepts = guide.get('detailed_concepts') or []
-        if len(concepts) < 3:
-            return True
-        for item in concepts:
-            if isinstance(item, dict) and len((item.get('explanation') or '')) < 80:
-                return True
-        steps = guide.get('step_by_step_method') or []
-        if len(steps) < 4:
-            return True
-        key_formulas = guide.get('key_formulas') or []
-        if len(key_formulas) < 3:
-            return True
-        return False
-    
-    for topic_name, data in sorted_topics:
-        accuracy = (data['correct'] / data['total'] * 100) if data['total'] > 0 else 0
-        wrong_count = data['wrong']
-        
-        # Chỉ phân tích chi tiết nếu có câu sai HOẶC accuracy < 100%
-        if wrong_count == 0 and accuracy == 100:
-            # Topic hoàn hảo - tạo guide đơn giản
-            all_topics_guides.append({
-                'topic': topic_name,
-                'accuracy': round(accuracy, 0),
-                'importance': 'low',
-                'priority_level': 3,
-                'key_concepts': [f"Bạn đã nắm vững {topic_name}!"],
-                'common_mistakes': [],
-                'study_tips': [f"Tiếp tục duy trì hiểu biết về {topic_name}"],
-                'practice_approach': f"Bạn không có lỗi nào ở {topic_name}. Tiếp tục!",
-                'formulas_or_rules': [],
-                'practice_drills': [],
-                'time_management_tip': 'Duy trì tốc độ hiện tại',
-                'stats': {
-                    'total': data['total'],
-                    'correct': data['correct'],
-                    'wrong': data['wrong']
-                }
-            })
-            continue
-    
-        # TẠO PROMPT CHI TIẾT CHO TỪNG TOPIC - BAO GỒM CÂU HỎI SAI ĐẦY ĐỦ
-        importance = 'high' if accuracy < 60 else ('medium' if accuracy < 80 else 'low')
-        priority = 1 if importance == 'high' else (2 if importance == 'medium' else 3)
-        
-        # 1. Check cache first (instant retrieval)
-        cached = _get_cached_guide(topic_name)
-        if cached:
-            print(f"✓ Loaded '{topic_name}' from cache (DB)")
-            all_topics_guides.append(cached)
-            continue
-        
-        # 2. Gọi AI nếu chưa có cache
-        model = _get_study_model()
-        if not model:
-            print(f"⚠️ AI model not available, using fallback for '{topic_name}'")
-            all_topics_guides.append(_get_fallback_guide(topic_name, data))
-            continue
-        
-        # Chuẩn bị chi tiết các câu SAI để phân tích
-        wrong_details = []
-        for q in data['wrong_questions']:
-            wrong_details.append({
-                'question': q['question'],
-                'options': q['options'],
-                'user_choice': q['user_choice'],
-                'correct_answer': q['correct_answer'],
-                'explanation': q['explanation'],
-                'step_by_step': q['step_by_step_thinking']
-            })
-        
-        # Prompt chi tiết cho TỪNG topic
-        topic_prompt = f"""
+_TOPIC_PROMPT = PromptTemplate('topic_guide', """
 Bạn là giáo viên GMAT chuyên nghiệp. Phân tích chi tiết chủ đề "{topic_name}" cho học sinh.
 
 THỐNG KÊ:
-- Tổng số câu: {data['total']}
-- Số câu đúng: {data['correct']}
+- Tổng số câu: {total}
+- Số câu đúng: {correct}
 - Số câu sai: {wrong_count}
 - Độ chính xác: {accuracy:.0f}%
 
 CÁC CÂU HỎI HỌC SINH TRẢ LỜI SAI (cần phân tích chi tiết):
-{json.dumps(wrong_details, ensure_ascii=False, indent=2)}
+{wrong_details}
 
 NHIỆM VỤ:
 1. **Lý thuyết chi tiết đầy đủ**: Giải thích TOÀN BỘ kiến thức về {topic_name}
@@ -716,218 +672,502 @@ YÊU CẦU QUAN TRỌNG:
 - Add comma after every field except the last one
 - Do NOT truncate - complete all fields fully
 - Test JSON validity before returning
-"""
+""")
 
-        try:
-            # Gọi API cho TỪNG topic
-            response = model.models.generate_content(
-                model='gemini-2.5-pro',
-                contents=topic_prompt,
-                config={
-                    'temperature': 0.3,  # Giảm để tập trung, cụ thể
-                    'max_output_tokens': 8192,  # Đủ cho 1 topic chi tiết
-                    'top_p': 0.9,
-                    'top_k': 30,
-                    'response_mime_type': 'application/json'
-                }
-            )
-            
-            text = response.text if hasattr(response, 'text') else str(response)
-            print(f"✅ Topic '{topic_name}': Generated {len(text)} chars")
-            
-            # Parse JSON response
-            text = text.replace('```json', '').replace('```', '').strip()
-            
-            # Fix multiple closing braces (common AI error)
-            # Replace }}} with }} at end of JSON
-            text = re.sub(r'\}\}\}+\s*$', '}}', text)
-            # Replace }]}} with }]} 
-            text = re.sub(r'\}\]\}\}+', '}]}', text)
-
-            def _repair_json_payload(payload: str) -> str:
-                """Advanced JSON repair with multi-stage healing."""
-                cleaned = payload.strip().rstrip('`').rstrip(',')
-                
-                # Stage 1: Fix unterminated strings (add closing quote before newline/brace)
-                cleaned = re.sub(r'"([^"]*?)\n\s*([,}\]])', r'"\1"\2', cleaned)
-                cleaned = re.sub(r'"([^"]*?)$', r'"\1"', cleaned)
-                
-                # Stage 2: Balance quotes globally
-                quote_count = len(re.findall(r'(?<!\\)"', cleaned))
-                if quote_count % 2 != 0:
-                    # Find last unbalanced quote position
-                    last_quote = cleaned.rfind('"')
-                    if last_quote > 0 and cleaned[last_quote-1] != '\\':
-                        # Add closing quote before next structural character
-                        next_struct = len(cleaned)
-                        for char_pos in range(last_quote + 1, len(cleaned)):
-                            if cleaned[char_pos] in [',', '}', ']', '\n']:
-                                next_struct = char_pos
-                                break
-                        cleaned = cleaned[:next_struct] + '"' + cleaned[next_struct:]
-                
-                # Stage 3: Fix missing commas between array/object elements
-                cleaned = re.sub(r'}\s*{', r'},{', cleaned)  # Between objects
-                cleaned = re.sub(r']\s*\[', r'],[', cleaned)  # Between arrays
-                cleaned = re.sub(r'"\s*"', r'","', cleaned)  # Between strings
-                
-                # Stage 4: Remove trailing commas
-                cleaned = re.sub(r',\s*(\}|\])', r'\1', cleaned)
-                
-                # Stage 5: Trim to last valid closing brace/bracket
-                last_brace = max(cleaned.rfind('}'), cleaned.rfind(']'))
-                if last_brace != -1:
-                    cleaned = cleaned[: last_brace + 1]
-                
-                # Stage 6: Ensure proper closure
-                open_braces = cleaned.count('{') - cleaned.count('}')
-                open_brackets = cleaned.count('[') - cleaned.count(']')
-                cleaned += '}' * open_braces + ']' * open_brackets
-                
-                return cleaned
+# Giới hạn ký tự ban đầu cho từng field của câu sai (fit_items giảm dần nếu vượt ngân sách)
+_WRONG_FIELD_LIMITS = {'question': 800, 'explanation': 500, 'step_by_step': 800}
 
-            # Validate JSON before parsing
-            if not text or text == '{}':
-                raise ValueError("Empty JSON response from API")
+def _build_topic_prompt(topic_name: str, data: Dict[str, Any], accuracy: float) -> str:
+    """Prompt phân tích chi tiết 1 topic, kèm các câu học sinh làm sai
 
-            # Multi-stage JSON parsing with progressive repair
+    Câu sai được serialize JSON gọn (không gửi lại cả danh sách options - đã có
+    user_choice/correct_answer) và cắt cho vừa STUDY_GUIDE_PROMPT_MAX_TOKENS.
+    """
+    from db import _get_int_config
+    wrong_details = [
+        {
+            'question': q['question'],
+            'user_choice': q['user_choice'],
+            'correct_answer': q['correct_answer'],
+            'explanation': q['explanation'],
+            'step_by_step': q['step_by_step_thinking']
+        }
+        for q in data['wrong_questions']
+    ]
+    budget = _get_int_config("STUDY_GUIDE_PROMPT_MAX_TOKENS", 4000) - _TOPIC_PROMPT.static_tokens
+    return _TOPIC_PROMPT.render(
+        topic_name=topic_name,
+        total=data['total'],
+        correct=data['correct'],
+        wrong_count=data['wrong'],
+        accuracy=accuracy,
+        wrong_details=fit_items(wrong_details, max(500, budget), _WRONG_FIELD_LIMITS)
+    )
+
+def _repair_json_payload(payload: str) -> str:
+    """Advanced JSON repair with multi-stage healing."""
+    cleaned = payload.strip().rstrip('`').rstrip(',')
+
+    # Stage 1: Fix unterminated strings (add closing quote before newline/brace)
+    cleaned = re.sub(r'"([^"]*?)\n\s*([,}\]])', r'"\1"\2', cleaned)
+    cleaned = re.sub(r'"([^"]*?)$', r'"\1"', cleaned)
+
+    # Stage 2: Balance quotes globally
+    quote_count = len(re.findall(r'(?<!\\)"', cleaned))
+    if quote_count % 2 != 0:
+        # Find last unbalanced quote position
+        last_quote = cleaned.rfind('"')
+        if last_quote > 0 and cleaned[last_quote-1] != '\\':
+            # Add closing quote before next structural character
+            next_struct = len(cleaned)
+            for char_pos in range(last_quote + 1, len(cleaned)):
+                if cleaned[char_pos] in [',', '}', ']', '\n']:
+                    next_struct = char_pos
+                    break
+            cleaned = cleaned[:next_struct] + '"' + cleaned[next_struct:]
+
+    # Stage 3: Fix missing commas between array/object elements
+    cleaned = re.sub(r'}\s*{', r'},{', cleaned)  # Between objects
+    cleaned = re.sub(r']\s*\[', r'],[', cleaned)  # Between arrays
+    cleaned = re.sub(r'"\s*"', r'","', cleaned)  # Between strings
+
+    # Stage 4: Remove trailing commas
+    cleaned = re.sub(r',\s*(\}|\])', r'\1', cleaned)
+
+    # Stage 5: Trim to last valid closing brace/bracket
+    last_brace = max(cleaned.rfind('}'), cleaned.rfind(']'))
+    if last_brace != -1:
+        cleaned = cleaned[: last_brace + 1]
+
+    # Stage 6: Ensure proper closure
+    open_braces = cleaned.count('{') - cleaned.count('}')
+    open_brackets = cleaned.count('[') - cleaned.count(']')
+    cleaned += '}' * open_braces + ']' * open_brackets
+
+    return cleaned
+
+def _parse_topic_guide(text: str, topic_name: str) -> Dict[str, Any]:
+    """Parse JSON guide của 1 topic (sửa JSON lỗi nhiều tầng). Không parse được/thiếu field -> raise"""
+    text = text.replace('```json', '').replace('```', '').strip()
+    
+    # Fix multiple closing braces (common AI error)
+    # Replace }}} with }} at end of JSON
+    text = re.sub(r'\}\}\}+\s*$', '}}', text)
+    # Replace }]}} with }]} 
+    text = re.sub(r'\}\]\}\}+', '}]}', text)
+
+    # Validate JSON before parsing
+    if not text or text == '{}':
+        raise ValueError("Empty JSON response from API")
+
+    # Multi-stage JSON parsing with progressive repair
+    parse_error = None
+
+    # Attempt 1: Direct parse (best case)
+    try:
+        topic_guide = json.loads(text)
+    except json.JSONDecodeError as e1:
+        parse_error = e1
+
+        # Attempt 2: Basic repair (unterminated strings, missing commas)
+        try:
+            repaired = _repair_json_payload(text)
+            print(f"ℹ️ Repairing JSON for topic '{topic_name}'")
+            topic_guide = json.loads(repaired)
             parse_error = None
-            
-            # Attempt 1: Direct parse (best case)
-            try:
-                topic_guide = json.loads(text)
-            except json.JSONDecodeError as e1:
-                parse_error = e1
-                
-                # Attempt 2: Basic repair (unterminated strings, missing commas)
+        except json.JSONDecodeError as e2:
+            parse_error = e2
+
+            # Attempt 3: Line-by-line truncation (drop bad tail)
+            lines = repaired.splitlines()
+            for trim_lines in range(1, min(10, len(lines))):
+                candidate = "\n".join(lines[:-trim_lines]).rstrip()
+                candidate = re.sub(r",\s*(\}|\])", r"\1", candidate)
+                # Ensure proper closure
+                open_braces = candidate.count('{') - candidate.count('}')
+                open_brackets = candidate.count('[') - candidate.count(']')
+                candidate += '}' * open_braces + ']' * open_brackets
                 try:
-                    repaired = _repair_json_payload(text)
-                    print(f"ℹ️ Repairing JSON for topic '{topic_name}'")
-                    topic_guide = json.loads(repaired)
+                    topic_guide = json.loads(candidate)
+                    print(f"✓ Recovered by trimming {trim_lines} lines")
                     parse_error = None
-                except json.JSONDecodeError as e2:
-                    parse_error = e2
-                    
-                    # Attempt 3: Line-by-line truncation (drop bad tail)
-                    lines = repaired.splitlines()
-                    for trim_lines in range(1, min(10, len(lines))):
-                        candidate = "\n".join(lines[:-trim_lines]).rstrip()
-                        candidate = re.sub(r",\s*(\}|\])", r"\1", candidate)
-                        # Ensure proper closure
-                        open_braces = candidate.count('{') - candidate.count('}')
-                        open_brackets = candidate.count('[') - candidate.count(']')
-                        candidate += '}' * open_braces + ']' * open_brackets
-                        try:
-                            topic_guide = json.loads(candidate)
-                            print(f"✓ Recovered by trimming {trim_lines} lines")
-                            parse_error = None
-                            break
-                        except json.JSONDecodeError:
-                            continue
-            
-            # If all parsing failed, raise last error to trigger fallback
-            if parse_error:
-                raise parse_error
-            
-            # Validate required fields
-            required_fields = ['theory', 'detailed_concepts', 'step_by_step_method', 'common_mistakes', 'tips_for_accuracy']
-            missing_fields = [f for f in required_fields if f not in topic_guide or not topic_guide[f]]
-            if missing_fields:
-                print(f"⚠️ Missing fields in response for '{topic_name}': {missing_fields}")
-                raise ValueError(f"Missing required fields: {missing_fields}")
-
-            # If content is too generic/short, fall back to curated knowledge base
-            knowledge_base = _get_topic_knowledge_base()
-            if _looks_generic_guide(topic_guide) and topic_name in knowledge_base:
-                print(f"ℹ️ Using knowledge base fallback for '{topic_name}' due to generic content")
-                kb_data = knowledge_base[topic_name]
-                topic_guide = {**kb_data}
-            
-            # Thêm metadata
-            topic_guide['topic'] = topic_name
-            topic_guide['accuracy'] = round(accuracy, 0)
-            topic_guide['importance'] = importance
-            topic_guide['priority_level'] = priority
-            topic_guide['stats'] = {
+                    break
+                except json.JSONDecodeError:
+                    continue
+
+    # If all parsing failed, raise last error to trigger fallback
+    if parse_error:
+        raise parse_error
+
+    return _validate_topic_guide(topic_guide, topic_name)
+
+def _validate_topic_guide(topic_guide: Dict[str, Any], topic_name: str) -> Dict[str, Any]:
+    """Guide phải đúng TOPIC_GUIDE_SCHEMA và có đủ các phần chính, sai -> raise để dùng fallback"""
+    if isinstance(topic_guide, dict):
+        # Phần phụ bị thiếu thì để trống, không bỏ cả guide
+        for field in TOPIC_GUIDE_FIELDS:
+            topic_guide.setdefault(field, '' if field == 'theory' else [])
+    errors = validate(topic_guide, TOPIC_GUIDE_SCHEMA)
+    if errors:
+        print(f"⚠️ Invalid guide structure for '{topic_name}': {errors[:3]}")
+        raise ValueError(f"Guide does not match schema: {'; '.join(errors[:3])}")
+    required_fields = ['theory', 'detailed_concepts', 'step_by_step_method', 'common_mistakes', 'tips_for_accuracy']
+    missing_fields = [f for f in required_fields if f not in topic_guide or not topic_guide[f]]
+    if missing_fields:
+        print(f"⚠️ Missing fields in response for '{topic_name}': {missing_fields}")
+        raise ValueError(f"Missing required fields: {missing_fields}")
+    return topic_guide
+
+# Config chung cho mọi lời gọi guide của 1 topic
+_TOPIC_GUIDE_CONFIG = {
+    'temperature': 0.3,  # Giảm để tập trung, cụ thể
+    'max_output_tokens': 8192,  # Đủ cho 1 topic chi tiết
+    'top_p': 0.9,
+    'top_k': 30,
+    'response_mime_type': 'application/json',
+    # Structured output theo schema -> JSON hợp lệ ngay, bước sửa JSON chỉ còn là dự phòng
+    'response_schema': TOPIC_GUIDE_SCHEMA
+}
+
+async def _generate_topic_guide_async(client, topic_name: str, data: Dict[str, Any], accuracy: float,
+                                      timeout: float | None = None) -> Dict[str, Any]:
+    """Gọi Gemini (client.aio, qua rate limiter dùng chung) và parse guide của 1 topic
+
+    Khi stream (GEMINI_STREAMING), JSON được parse dần trong lúc nhận; chỉ khi JSON
+    lỗi mới phải chạy bước sửa JSON nhiều tầng (_parse_topic_guide).
+    """
+    import gemini_async
+    import model_router
+    request = dict(
+        model=model_router.choose_model('study_guide', topic=topic_name),
+        contents=_build_topic_prompt(topic_name, data, accuracy),
+        config=_TOPIC_GUIDE_CONFIG,
+        timeout=timeout
+    )
+    with model_router.track(request['model'], 'study_guide'):
+        if gemini_async.streaming_enabled():
+            response = await gemini_async.generate_content_stream(client, abort_on_malformed=False, **request)
+            print(f"✅ Topic '{topic_name}': Streamed {len(response.text)} chars")
+            if response.data is not None:
+                return _validate_topic_guide(response.data, topic_name)
+            return _parse_topic_guide(response.text, topic_name)
+        response = await gemini_async.generate_content(client, **request)
+        text = response.text if hasattr(response, 'text') else str(response)
+        print(f"✅ Topic '{topic_name}': Generated {len(text)} chars")
+        return _parse_topic_guide(text, topic_name)
+
+def _fallback_topic_guide(topic_name: str, data: Dict[str, Any], accuracy: float,
+                          importance: str, priority: int) -> Dict[str, Any]:
+    """Guide dự phòng khi AI lỗi: lấy từ knowledge base, không có thì tạo guide chung"""
+    wrong_count = data['wrong']
+    knowledge_base = _get_topic_knowledge_base()
+    if topic_name in knowledge_base:
+        kb_data = knowledge_base[topic_name]
+        return {
+            'topic': topic_name,
+            'accuracy': round(accuracy, 0),
+            'importance': importance,
+            'priority_level': priority,
+            'theory': kb_data['theory'],
+            'detailed_concepts': kb_data.get('detailed_concepts', []),
+            'step_by_step_method': kb_data.get('step_by_step_method', []),
+            'mistake_analysis': [],
+            'common_mistakes': kb_data.get('common_mistakes', [f"Bạn sai {wrong_count} câu ở {topic_name}. Cần ôn lại lý thuyết."]),
+            'tips_for_accuracy': kb_data.get('tips_for_accuracy', []),
+            'tips_for_speed': kb_data.get('tips_for_speed', []),
+            'practice_drills': kb_data.get('practice_drills', []),
+            'key_formulas': kb_data.get('key_formulas', []),
+            'stats': {
                 'total': data['total'],
                 'correct': data['correct'],
                 'wrong': data['wrong']
             }
-            
-            # Save successful AI response to cache
-            _save_guide_to_cache(topic_name, topic_guide)
-            all_topics_guides.append(topic_guide)
-            
-        except Exception as e:
-            print(f"⚠️ Lỗi phân tích topic '{topic_name}': {e}")
-            import traceback
-            traceback.print_exc()
-            
-            # Thử lấy từ knowledge base, nếu không có thì tạo fallback
-            knowledge_base = _get_topic_knowledge_base()
-            if topic_name in knowledge_base:
-                kb_data = knowledge_base[topic_name]
-                all_topics_guides.append({
-                    'topic': topic_name,
-                    'accuracy': round(accuracy, 0),
-                    'importance': importance,
-                    'priority_level': priority,
-                    'theory': kb_data['theory'],
-                    'detailed_concepts': kb_data.get('detailed_concepts', []),
-                    'step_by_step_method': kb_data.get('step_by_step_method', []),
-                    'mistake_analysis': [],
-                    'common_mistakes': kb_data.get('common_mistakes', [f"Bạn sai {wrong_count} câu ở {topic_name}. Cần ôn lại lý thuyết."]),
-                    'tips_for_accuracy': kb_data.get('tips_for_accuracy', []),
-                    'tips_for_speed': kb_data.get('tips_for_speed', []),
-                    'practice_drills': kb_data.get('practice_drills', []),
-                    'key_formulas': kb_data.get('key_formulas', []),
-                    'stats': {
-                        'total': data['total'],
-                        'correct': data['correct'],
-                        'wrong': data['wrong']
-                    }
-                })
-            else:
-                # Fallback chung chung cho topic không trong knowledge base
-                all_topics_guides.append({
-                    'topic': topic_name,
-                    'accuracy': round(accuracy, 0),
-                    'importance': importance,
-                    'priority_level': priority,
-                    'theory': f"Cần ôn tập lại kiến thức cơ bản về {topic_name}. Hãy xem lại định nghĩa, công thức và cách áp dụng trong các bài toán. Luyện tập thêm để nắm vững.",
-                    'detailed_concepts': [
-                        {'concept_name': f'Khái niệm cơ bản {topic_name}', 'explanation': 'Cần ôn lại từ đầu', 'example': 'Xem sách giáo khoa'}
-                    ],
-                    'step_by_step_method': [
-                        'Bước 1: Đọc kỹ đề bài',
-                        'Bước 2: Xác định dạng bài',
-                        'Bước 3: Áp dụng công thức',
-                        'Bước 4: Kiểm tra kết quả'
-                    ],
-                    'mistake_analysis': [],
-                    'common_mistakes': [f"Bạn sai {wrong_count} câu ở {topic_name}. Cần ôn lại lý thuyết."],
-                    'tips_for_accuracy': [f"Ôn lại lý thuyết {topic_name} từ sách cơ bản"],
-                    'tips_for_speed': ["Luyện tập thêm để tăng tốc độ"],
-                    'practice_drills': [f"Làm thêm {max(5, wrong_count * 2)} bài tập về {topic_name}"],
-                    'key_formulas': ["Xem lại công thức cơ bản"],
-                    'stats': {
-                        'total': data['total'],
-                        'correct': data['correct'],
-                        'wrong': data['wrong']
-                    }
-                })
+        }
+    else:
+        # Fallback chung chung cho topic không trong knowledge base
+        return {
+            'topic': topic_name,
+            'accuracy': round(accuracy, 0),
+            'importance': importance,
+            'priority_level': priority,
+            'theory': f"Cần ôn tập lại kiến thức cơ bản về {topic_name}. Hãy xem lại định nghĩa, công thức và cách áp dụng trong các bài toán. Luyện tập thêm để nắm vững.",
+            'detailed_concepts': [
+                {'concept_name': f'Khái niệm cơ bản {topic_name}', 'explanation': 'Cần ôn lại từ đầu', 'example': 'Xem sách giáo khoa'}
+            ],
+            'step_by_step_method': [
+                'Bước 1: Đọc kỹ đề bài',
+                'Bước 2: Xác định dạng bài',
+                'Bước 3: Áp dụng công thức',
+                'Bước 4: Kiểm tra kết quả'
+            ],
+            'mistake_analysis': [],
+            'common_mistakes': [f"Bạn sai {wrong_count} câu ở {topic_name}. Cần ôn lại lý thuyết."],
+            'tips_for_accuracy': [f"Ôn lại lý thuyết {topic_name} từ sách cơ bản"],
+            'tips_for_speed': ["Luyện tập thêm để tăng tốc độ"],
+            'practice_drills': [f"Làm thêm {max(5, wrong_count * 2)} bài tập về {topic_name}"],
+            'key_formulas': ["Xem lại công thức cơ bản"],
+            'stats': {
+                'total': data['total'],
+                'correct': data['correct'],
+                'wrong': data['wrong']
+            }
+        }
+
+
+def _looks_generic_guide(guide: Dict[str, Any]) -> bool:
+    """Heuristic to catch vague/short guides and force richer fallback."""
+    theory_val = guide.get('theory')
+    # Accept both string and structured theory; serialize safely
+    if isinstance(theory_val, dict):
+        theory = json.dumps(theory_val, ensure_ascii=False)
+    else:
+        theory = str(theory_val or '')
+    theory = theory.strip()
+    if len(theory) < 500:
+        return True
+    lowered = theory.lower()
+    generic_markers = [
+        'xem lại', 'cần ôn', 'ôn lại từ đầu', 'xem sách giáo khoa', 'luyện tập thêm để', 'cơ bản'
+    ]
+    if any(m in lowered for m in generic_markers):
+        return True
+    concepts = guide.get('detailed_concepts') or []
+    if len(concepts) < 3:
+        return True
+    for item in concepts:
+        if isinstance(item, dict) and len((item.get('explanation') or '')) < 80:
+            return True
+    steps = guide.get('step_by_step_method') or []
+    if len(steps) < 4:
+        return True
+    key_formulas = guide.get('key_formulas') or []
+    if len(key_formulas) < 3:
+        return True
+    return False
+
+def _finalize_topic_guide(topic_guide: Dict[str, Any], topic_name: str, data: Dict[str, Any], accuracy: float,
+                          importance: str, priority: int) -> Dict[str, Any]:
+    """Thêm metadata cho guide AI vừa tạo (hoặc thay bằng knowledge base nếu quá chung chung) rồi lưu cache"""
+    # If content is too generic/short, fall back to curated knowledge base
+    knowledge_base = _get_topic_knowledge_base()
+    if _looks_generic_guide(topic_guide) and topic_name in knowledge_base:
+        print(f"ℹ️ Using knowledge base fallback for '{topic_name}' due to generic content")
+        kb_data = knowledge_base[topic_name]
+        topic_guide = {**kb_data}
+    
+    # Thêm metadata
+    topic_guide['topic'] = topic_name
+    topic_guide['accuracy'] = round(accuracy, 0)
+    topic_guide['importance'] = importance
+    topic_guide['priority_level'] = priority
+    topic_guide['stats'] = {
+        'total': data['total'],
+        'correct': data['correct'],
+        'wrong': data['wrong']
+    }
+    
+    # Save successful AI response to cache
+    _save_guide_to_cache(topic_name, topic_guide)
+    return topic_guide
+
+def iter_study_guide(questions: List[Dict[str, Any]], user_answers: Dict[str, str]):
+    """
+    Bản streaming của generate_study_guide: yield guide của từng topic ngay khi xong
+    (topic làm đúng hết + topic có cache trước, topic cần AI theo thứ tự hoàn thành).
+    
+    Yields:
+        Dict {'position': vị trí theo thứ tự ưu tiên, 'guide': guide của topic,
+              'completed': số topic đã xong, 'total': tổng số topic}
+    """
+    # Phân tích câu sai và đúng theo topic - GIỮ TOÀN BỘ THÔNG TIN
+    topic_analysis = {}
+    
+    for idx, q in enumerate(questions):
+        topic = q.get('topic', 'General')
+        qtype = q.get('type', 'general')
+        user_choice = user_answers.get(f"q_{idx}")
+        correct_answer = q.get('correct_answer', '')
+        
+        is_correct = False
+        if user_choice and correct_answer:
+            if user_choice.split('.')[0] == correct_answer.split('.')[0]:
+                is_correct = True
+        
+        if topic not in topic_analysis:
+            topic_analysis[topic] = {
+                'type': qtype,
+                'total': 0,
+                'correct': 0,
+                'wrong': 0,
+                'questions': [],
+                'wrong_questions': []  # Tách riêng câu sai để ưu tiên phân tích
+            }
+        
+        topic_analysis[topic]['total'] += 1
+        if is_correct:
+            topic_analysis[topic]['correct'] += 1
+        else:
+            topic_analysis[topic]['wrong'] += 1
+        
+        # Lưu TOÀN BỘ thông tin câu hỏi (không cắt ngắn)
+        question_data = {
+            'question': q.get('question', ''),
+            'options': q.get('options', []),
+            'user_choice': user_choice,
+            'correct_answer': correct_answer,
+            'explanation': q.get('explanation', ''),
+            'step_by_step_thinking': q.get('step_by_step_thinking', ''),
+            'is_correct': is_correct
+        }
+        
+        topic_analysis[topic]['questions'].append(question_data)
+        if not is_correct:
+            topic_analysis[topic]['wrong_questions'].append(question_data)
     
-    # Tạo tổng quan
-    total_correct = sum(d['correct'] for d in topic_analysis.values())
-    total_questions = sum(d['total'] for d in topic_analysis.values())
-    total_wrong = sum(d['wrong'] for d in topic_analysis.values())
+    # XỬ LÝ TỪNG CHỦ ĐỀ MỘT - ƯU TIÊN CHỦ ĐỀ CÓ NHIỀU CÂU SAI
+    sorted_topics = sorted(
+        topic_analysis.items(),
+        key=lambda x: (x[1]['wrong'], -x[1]['total']),  # Sắp theo số câu sai (nhiều nhất trước)
+        reverse=True
+    )
+    
+    from db import _get_int_config
+    guide_timeout = _get_int_config("STUDY_GUIDE_TIMEOUT", 240)  # giây cho mỗi topic (chờ rate limit + gọi API)
+    positions = {topic_name: idx for idx, (topic_name, _) in enumerate(sorted_topics)}
+    total = len(sorted_topics)
+    completed = 0
+
+    # 1. Phân loại topic theo thứ tự ưu tiên: topic làm đúng hết chỉ cần guide ngắn
+    ready = []  # (topic_name, guide) trả về ngay, không cần gọi AI
+    pending_topics = []  # (topic_name, data, accuracy, importance, priority) cần guide chi tiết
+    for topic_name, data in sorted_topics:
+        accuracy = (data['correct'] / data['total'] * 100) if data['total'] > 0 else 0
+        
+        # Chỉ phân tích chi tiết nếu có câu sai HOẶC accuracy < 100%
+        if data['wrong'] == 0 and accuracy == 100:
+            # Topic hoàn hảo - tạo guide đơn giản
+            ready.append((topic_name, {
+                'topic': topic_name,
+                'accuracy': round(accuracy, 0),
+                'importance': 'low',
+                'priority_level': 3,
+                'key_concepts': [f"Bạn đã nắm vững {topic_name}!"],
+                'common_mistakes': [],
+                'study_tips': [f"Tiếp tục duy trì hiểu biết về {topic_name}"],
+                'practice_approach': f"Bạn không có lỗi nào ở {topic_name}. Tiếp tục!",
+                'formulas_or_rules': [],
+                'practice_drills': [],
+                'time_management_tip': 'Duy trì tốc độ hiện tại',
+                'stats': {
+                    'total': data['total'],
+                    'correct': data['correct'],
+                    'wrong': data['wrong']
+                }
+            }))
+            continue
+    
+        importance = 'high' if accuracy < 60 else ('medium' if accuracy < 80 else 'low')
+        priority = 1 if importance == 'high' else (2 if importance == 'medium' else 3)
+        pending_topics.append((topic_name, data, accuracy, importance, priority))
+    
+    # 2. Check cache cho tất cả topic trong 1 truy vấn (instant retrieval)
+    cached_guides = get_cached_guides([t[0] for t in pending_topics])
+    for topic_name, guide in cached_guides.items():
+        print(f"✓ Loaded '{topic_name}' from cache")
+        ready.append((topic_name, guide))
+    pending_topics = [t for t in pending_topics if t[0] not in cached_guides]
+    
+    for topic_name, guide in sorted(ready, key=lambda item: positions[item[0]]):
+        completed += 1
+        yield {'position': positions[topic_name], 'guide': guide, 'completed': completed, 'total': total}
+    
+    if not pending_topics:
+        return
+    
+    # 3. Gọi AI song song cho các topic chưa có cache (rate limiter + GEMINI_CONCURRENCY giới hạn)
+    model = _get_study_model()
+    if not model:
+        for topic_name, data, accuracy, importance, priority in pending_topics:
+            print(f"⚠️ AI model not available, using fallback for '{topic_name}'")
+            completed += 1
+            yield {
+                'position': positions[topic_name],
+                'guide': _fallback_topic_guide(topic_name, data, accuracy, importance, priority),
+                'completed': completed,
+                'total': total
+            }
+        return
+    
+    import concurrent.futures
+    import gemini_async
+    print(f"🤖 Đang tạo guide cho {len(pending_topics)} topic song song...")
+    futures = gemini_async.submit_bounded([
+        (lambda t=t: _generate_topic_guide_async(model, t[0], t[1], t[2], timeout=guide_timeout))
+        for t in pending_topics
+    ])
+    future_to_topic = dict(zip(futures, pending_topics))
+    try:
+        for future in concurrent.futures.as_completed(futures):
+            topic_name, data, accuracy, importance, priority = future_to_topic[future]
+            try:
+                topic_guide = _finalize_topic_guide(future.result(), topic_name, data, accuracy, importance, priority)
+            except Exception as e:
+                print(f"⚠️ Lỗi phân tích topic '{topic_name}': {e!r}")
+                topic_guide = _fallback_topic_guide(topic_name, data, accuracy, importance, priority)
+            completed += 1
+            yield {'position': positions[topic_name], 'guide': topic_guide, 'completed': completed, 'total': total}
+    finally:
+        # Người dùng rời trang giữa chừng (generator bị đóng) -> hủy các topic chưa xong
+        for future in futures:
+            future.cancel()
+
+def summarize_study_guide(topic_guides: List[Dict[str, Any]]) -> Dict[str, Any]:
+    """Ghép guide các topic (theo thứ tự ưu tiên) thành kết quả đầy đủ kèm tổng quan"""
+    stats = [t.get('stats', {}) for t in topic_guides]
+    total_correct = sum(s.get('correct', 0) for s in stats)
+    total_questions = sum(s.get('total', 0) for s in stats)
+    total_wrong = sum(s.get('wrong', 0) for s in stats)
     overall_accuracy = (total_correct / total_questions * 100) if total_questions > 0 else 0
     
     return {
-        'overall_summary': f"Kết quả: {total_correct}/{total_questions} đúng ({overall_accuracy:.0f}%). Bạn cần tập trung ôn tập {total_wrong} câu sai, đặc biệt các chủ đề: {', '.join([t['topic'] for t in all_topics_guides[:3] if t.get('importance') in ['high', 'medium']])}.",
-        'topics': all_topics_guides
+        'overall_summary': f"Kết quả: {total_correct}/{total_questions} đúng ({overall_accuracy:.0f}%). Bạn cần tập trung ôn tập {total_wrong} câu sai, đặc biệt các chủ đề: {', '.join([t['topic'] for t in topic_guides[:3] if t.get('importance') in ['high', 'medium']])}.",
+        'topics': topic_guides
     }
 
+def study_model_error() -> Dict[str, Any] | None:
+    """Kết quả lỗi (dạng generate_study_guide) nếu không khởi tạo được model AI, None nếu dùng được.
+
+    Gọi trước iter_study_guide: iter_study_guide không tự kiểm tra và sẽ lặng lẽ trả guide
+    dự phòng từ knowledge base khi không có model.
+    """
+    if _get_study_model():
+        return None
+    return {
+        "error": "Không thể kết nối đến AI. Vui lòng kiểm tra API key.",
+        "topics": []
+    }
+
+def generate_study_guide(questions: List[Dict[str, Any]], user_answers: Dict[str, str]) -> Dict[str, Any]:
+    """
+    Tạo tài liệu ôn tập chi tiết dựa trên các câu hỏi trong bài thi
+    
+    Args:
+        questions: Danh sách các câu hỏi trong bài thi
+        user_answers: Dict chứa câu trả lời của user {q_0: 'A. ...', q_1: 'B. ...'}
+    
+    Returns:
+        Dict chứa nội dung ôn tập theo từng topic
+    """
+    error = study_model_error()
+    if error:
+        return error
+    
+    # Ghép lại theo thứ tự ưu tiên (nhiều câu sai trước)
+    guides = {}
+    for event in iter_study_guide(questions, user_answers):
+        guides[event['position']] = event['guide']
+    return summarize_study_guide([guides[pos] for pos in sorted(guides)])
+
 
 def _create_fallback_study_guide(topic_analysis: Dict[str, Any]) -> Dict[str, Any]:
     """
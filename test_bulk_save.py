@@ -0,0 +1,91 @@
+"""Test save_questions: lưu theo lô, đếm đúng số câu mới, bỏ qua câu trùng (theo fingerprint)"""
+import time
+from db import (init_db, save_questions, get_conn, question_fingerprint, _get_db_type,
+                get_cached_questions, get_cached_questions_by_topics, get_stratified_questions)
+
+def test_bulk_save():
+    print("=" * 60)
+    print("BULK SAVE_QUESTIONS TEST")
+    print("=" * 60)
+    
+    init_db()
+    db_type = _get_db_type()
+    print(f"\n✓ Database type: {db_type}")
+    
+    marker = f"__BULK_TEST_{int(time.time() * 1000)}__"
+    questions = [
+        {
+            'question': f"{marker} Câu {i}",
+            'options': ['A. 1', 'B. 2', 'C. 3', 'D. 4'],
+            'correct_answer': 'A. 1',
+            'explanation': 'Test',
+            'topic': f"Topic {i % 5}",
+            'type': 'math'
+        }
+        for i in range(2000)
+    ]
+    
+    try:
+        # 1. Lô lớn + câu trùng trong cùng lô
+        start = time.time()
+        saved = save_questions(questions + questions[:50])
+        print(f"✓ Saved {saved} questions in {time.time() - start:.2f}s")
+        assert saved == len(questions), f"Expected {len(questions)}, got {saved}"
+        
+        # 2. Lưu lại -> không có câu mới
+        saved_again = save_questions(questions[:100])
+        print(f"✓ Re-save returned {saved_again} new rows")
+        assert saved_again == 0
+        
+        # 3. Trộn câu cũ + câu mới
+        extra = [{**questions[0], 'question': f"{marker} Câu mới"}]
+        assert save_questions(questions[:10] + extra) == 1
+        print("✓ Mixed batch counts only new rows")
+        
+        # 4. Cùng câu nhưng khác khoảng trắng/dấu/thứ tự options -> trùng fingerprint
+        variant = {
+            **questions[1],
+            'question': f"  {marker} CAU   1 ",
+            'options': ['A. 4', 'B. 3', 'C. 1', 'D. 2'],
+            'correct_answer': 'C. 1'
+        }
+        assert question_fingerprint(variant) == question_fingerprint(questions[1])
+        assert save_questions([variant]) == 0
+        print("✓ Fingerprint ignores whitespace, diacritics and option order")
+        
+        # 5. Câu trùng cũ (fingerprint NULL sau migration 8) không bao giờ vào đề, trên cả 2 backend
+        ph = "%s" if db_type == "postgresql" else "?"
+        topic = f"{marker}topic"
+        with get_conn() as conn:
+            c = conn.cursor()
+            c.execute(
+                f"UPDATE questions SET topic = {ph} WHERE question IN ({ph}, {ph}, {ph})",
+                (topic, f"{marker} Câu 0", f"{marker} Câu 1", f"{marker} Câu 2")
+            )
+            c.execute(f"UPDATE questions SET fingerprint = NULL WHERE question = {ph}", (f"{marker} Câu 0",))
+            conn.commit()
+        samples = [
+            get_cached_questions(10, topic=topic),
+            get_cached_questions(10, randomize=False, topic=topic),
+            get_stratified_questions({(topic, None): 10}),
+            get_cached_questions_by_topics({topic: 1.0}, 2),
+            get_cached_questions_by_topics({topic: 1.0}, 1, exclude_hashes={question_fingerprint(questions[1])}),
+        ]
+        for picked in samples:
+            texts = {q['question'] for q in picked if q['topic'] == topic}
+            assert f"{marker} Câu 0" not in texts, texts
+            assert texts, "Câu có fingerprint vẫn phải được lấy"
+        print("✓ Rows with a NULL fingerprint are never sampled")
+    finally:
+        ph = "%s" if db_type == "postgresql" else "?"
+        with get_conn() as conn:
+            c = conn.cursor()
+            c.execute(f"DELETE FROM questions WHERE question LIKE {ph}", (f"{marker}%",))
+            conn.commit()
+    
+    print("\n" + "=" * 60)
+    print("ALL TESTS PASSED ✓")
+    print("=" * 60)
+
+if __name__ == "__main__":
+    test_bulk_save()
@@ -0,0 +1,62 @@
+"""Test connection pool: reuse kết nối, truy cập đồng thời, metrics"""
+import threading
+import time
+from db import get_conn, get_pool_stats, init_db, _get_db_type
+
+def test_pool_reuse():
+    print("=" * 60)
+    print("CONNECTION POOL TEST")
+    print("=" * 60)
+    
+    db_type = _get_db_type()
+    print(f"\n✓ Database type: {db_type}")
+    init_db()
+    
+    # 1. Mượn/trả nhiều lần - không được mở thêm kết nối mới mỗi lần
+    before = get_pool_stats()
+    start = time.time()
+    for _ in range(20):
+        with get_conn() as conn:
+            c = conn.cursor()
+            c.execute("SELECT 1")
+            c.fetchone()
+    elapsed = time.time() - start
+    after = get_pool_stats()
+    
+    opened = after['connections_opened'] - before['connections_opened']
+    print(f"✓ 20 checkouts in {elapsed:.3f}s, new connections opened: {opened}")
+    assert after['checkouts'] - before['checkouts'] == 20
+    if db_type == "postgresql":
+        assert opened <= after['max_size'], "Pool không tái sử dụng kết nối"
+    
+    # 2. Nhiều thread dùng pool cùng lúc
+    errors = []
+    
+    def worker():
+        try:
+            for _ in range(10):
+                with get_conn() as conn:
+                    c = conn.cursor()
+                    c.execute("SELECT 1")
+                    c.fetchone()
+        except Exception as e:
+            errors.append(e)
+    
+    threads = [threading.Thread(target=worker) for _ in range(8)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    
+    assert not errors, f"Lỗi khi truy cập đồng thời: {errors[0]}"
+    stats = get_pool_stats()
+    assert stats['in_use'] == 0, "Có kết nối chưa được trả về pool"
+    print(f"✓ 80 concurrent checkouts OK")
+    print(f"\n📊 Pool stats: {stats}")
+    
+    print("\n" + "=" * 60)
+    print("ALL TESTS PASSED ✓")
+    print("=" * 60)
+
+if __name__ == "__main__":
+    test_pool_reuse()
@@ -0,0 +1,147 @@
+"""Test exam_pool: sinh bộ câu vào pool, lấy đúng số câu của đề, phần dư trả lại pool (không gọi Gemini thật)"""
+import asyncio
+import json
+import os
+import time
+from unittest import mock
+
+import ai_logic
+import exam_pool
+import model_router
+import rate_limiter
+from db import init_db, get_conn, _get_db_type, add_pooled_question_set, claim_pooled_question_set, count_pooled_question_sets
+from rate_limiter import RateLimiter
+
+class _FakeResponse:
+    def __init__(self, text):
+        self.text = text
+        self.usage_metadata = None
+
+class _FakeModels:
+    def __init__(self, marker):
+        self.marker = marker
+        self.calls = 0
+        self.fail = False
+
+    async def generate_content(self, model, contents, config=None):
+        self.calls += 1
+        n = self.calls
+        await asyncio.sleep(0.01)
+        if self.fail:
+            raise RuntimeError("500 INTERNAL")
+        return _FakeResponse(json.dumps({
+            'question': f"{self.marker} AI {n}", 'options': ['A. 1', 'B. 2', 'C. 3', 'D. 4'],
+            'correct_answer': 'A. 1', 'explanation': 'e', 'step_by_step_thinking': 'Bước 1: ...'
+        }))
+
+class _FakeClient:
+    def __init__(self, marker):
+        self.aio = type('Aio', (), {})()
+        self.aio.models = _FakeModels(marker)
+
+def _questions(marker, n):
+    return [
+        {'question': f"{marker} Câu {i}", 'options': ['A. 1', 'B. 2'], 'correct_answer': 'A. 1', 'topic': 'Pool'}
+        for i in range(n)
+    ]
+
+def _pool_is_empty() -> bool:
+    with get_conn() as conn:
+        c = conn.cursor()
+        c.execute("SELECT COUNT(*) FROM exam_pool")
+        if c.fetchone()[0]:
+            print("⚠️  exam_pool đang có dữ liệu thật - test skipped")
+            return False
+    return True
+
+def _cleanup(marker):
+    ph = "%s" if _get_db_type() == "postgresql" else "?"
+    with get_conn() as conn:
+        c = conn.cursor()
+        c.execute("DELETE FROM exam_pool")
+        c.execute(f"DELETE FROM questions WHERE question LIKE {ph}", (f"{marker}%",))
+        conn.commit()
+
+@mock.patch.dict(os.environ, {"GEMINI_STREAMING": "0", "GEMINI_BATCH_SIZE": "1"})
+@mock.patch.dict(rate_limiter._limiters, {"gemini": RateLimiter("gemini", rpm=1000)})
+def test_refill():
+    print("=" * 60)
+    print("EXAM POOL REFILL TEST")
+    print("=" * 60)
+
+    init_db()
+    if not _pool_is_empty():
+        return
+    model_router.reset_stats()
+    marker = f"__POOL_REFILL_{int(time.time() * 1000)}__"
+    client = _FakeClient(marker)
+    original = ai_logic._get_model
+    ai_logic._get_model = lambda: client
+    seeds = [{'content': f"Seed {i}", 'topic': f"T{i % 3}", 'type': 'math'} for i in range(6)]
+    try:
+        # 1. Sinh đủ 1 bộ set_size câu, lưu câu vào DB, đưa bộ vào pool
+        assert exam_pool.refill_once(seeds, 7)
+        assert count_pooled_question_sets(7) == 1
+        ph = "%s" if _get_db_type() == "postgresql" else "?"
+        with get_conn() as conn:
+            c = conn.cursor()
+            c.execute(f"SELECT COUNT(*) FROM questions WHERE question LIKE {ph}", (f"{marker}%",))
+            assert c.fetchone()[0] == 7
+        claimed = claim_pooled_question_set(7)
+        assert len(claimed) == 7 and all(q['question'].startswith(marker) for q in claimed)
+        print(f"✓ refill_once: 1 bộ 7 câu vào pool ({client.aio.models.calls} request, phần dư bị hủy)")
+
+        # 2. Gemini lỗi hết -> False, pool không có bộ rỗng
+        client.aio.models.fail = True
+        assert not exam_pool.refill_once(seeds, 7)
+        assert count_pooled_question_sets() == 0
+        print("✓ Không tạo được câu nào thì không thêm bộ vào pool")
+    finally:
+        ai_logic._get_model = original
+        _cleanup(marker)
+
+    print("\n" + "=" * 60)
+    print("ALL TESTS PASSED ✓")
+    print("=" * 60)
+
+def test_claim_sizes():
+    print("=" * 60)
+    print("EXAM POOL CLAIM TEST")
+    print("=" * 60)
+
+    init_db()
+    if not _pool_is_empty():
+        return
+
+    marker = f"__POOL_TEST_{int(time.time() * 1000)}__"
+    try:
+        add_pooled_question_set(_questions(marker, 21))
+        assert count_pooled_question_sets(21) == 1
+
+        # 1. Đề nhỏ (10 câu -> 7 câu AI): lấy 7 câu, 14 câu còn lại trả về pool
+        claimed = claim_pooled_question_set(7)
+        assert [q['question'] for q in claimed] == [f"{marker} Câu {i}" for i in range(7)]
+        assert count_pooled_question_sets(21) == 0 and count_pooled_question_sets(14) == 1
+        print("✓ Đề nhỏ chỉ lấy đủ số câu, phần dư vẫn trong pool")
+
+        # 2. Không có bộ nào đủ câu -> None, pool giữ nguyên
+        assert claim_pooled_question_set(21) is None
+        assert count_pooled_question_sets() == 1
+        print("✓ Không có bộ đủ câu thì không lấy gì")
+
+        # 3. Bộ nhỏ nhất còn đủ câu được dùng trước
+        add_pooled_question_set(_questions(f"{marker}big", 21))
+        claimed = claim_pooled_question_set(14)
+        assert len(claimed) == 14 and all(q['question'].startswith(f"{marker} ") for q in claimed)
+        assert count_pooled_question_sets() == 1 and count_pooled_question_sets(21) == 1
+        print("✓ Phần dư được dùng trước bộ đầy đủ")
+    finally:
+        _cleanup(marker)
+
+    print("\n" + "=" * 60)
+    print("ALL TESTS PASSED ✓")
+    print("=" * 60)
+
+if __name__ == "__main__":
+    test_refill()
+    test_claim_sizes()
@@ -0,0 +1,88 @@
+"""Test LRU study guide trong process (hit không chạm DB, đổi version thì đọc lại) + get_cached_guides nhiều topic"""
+import os
+import time
+import json
+import study_guide
+import write_behind
+from db import init_db, get_conn, _get_db_type
+
+def test_guide_lru():
+    print("=" * 60)
+    print("STUDY GUIDE LRU TEST")
+    print("=" * 60)
+
+    init_db()
+    os.environ["STUDY_GUIDE_LRU_TTL"] = "1"
+    topic = f"__LRU_TEST_{int(time.time() * 1000)}__"
+    ph = "%s" if _get_db_type() == "postgresql" else "?"
+
+    try:
+        # 1. Lưu -> LRU có guide ngay, sau khi ghi xong thì biết version
+        study_guide._save_guide_to_cache(topic, {'theory': 'v1'})
+        assert study_guide._get_cached_guide(topic) == {'theory': 'v1'}
+        assert write_behind.flush(timeout=10)
+        assert study_guide._guide_lru[topic][0] == 1
+        print("✓ Guide vừa lưu có trong LRU, version cập nhật sau khi ghi DB")
+
+        # 2. Process khác ghi đè: trong TTL vẫn trả bản trong LRU (không chạm DB)
+        with get_conn() as conn:
+            c = conn.cursor()
+            c.execute(
+                f"UPDATE study_guide_cache SET guide_data = {ph}, version = version + 1 WHERE topic = {ph}",
+                (json.dumps({'theory': 'v2'}), topic)
+            )
+            conn.commit()
+        hits = study_guide.get_guide_cache_stats()['hits']
+        assert study_guide._get_cached_guide(topic) == {'theory': 'v1'}
+        assert study_guide.get_guide_cache_stats()['hits'] == hits + 1
+        print("✓ Lookup trong TTL lấy từ LRU")
+
+        # 3. Quá TTL -> kiểm tra version, khác thì đọc lại guide
+        time.sleep(1.1)
+        assert study_guide._get_cached_guide(topic) == {'theory': 'v2'}
+        time.sleep(1.1)
+        revalidated = study_guide.get_guide_cache_stats()['revalidated']
+        assert study_guide._get_cached_guide(topic) == {'theory': 'v2'}
+        assert study_guide.get_guide_cache_stats()['revalidated'] == revalidated + 1
+        print("✓ Đổi version thì đọc lại; cùng version chỉ kiểm tra, không parse lại")
+
+        # 4. Sửa dict trả về không làm hỏng bản trong LRU
+        study_guide._get_cached_guide(topic)['theory'] = 'mutated'
+        assert study_guide._get_cached_guide(topic) == {'theory': 'v2'}
+
+        # 5. Nhiều topic (hit LRU + quá TTL + chưa cache) -> đúng 1 truy vấn DB
+        other = f"{topic}_other"
+        study_guide._save_guide_to_cache(other, {'theory': 'other'})
+        assert write_behind.flush(timeout=10)
+        study_guide._guide_lru.pop(other, None)
+        time.sleep(1.1)
+        queries = []
+        with get_conn() as conn:
+            if _get_db_type() != "postgresql":
+                conn.set_trace_callback(queries.append)
+            try:
+                guides = study_guide.get_cached_guides([topic, other, f"{topic}_missing"])
+            finally:
+                if _get_db_type() != "postgresql":
+                    conn.set_trace_callback(None)
+        assert guides == {topic: {'theory': 'v2'}, other: {'theory': 'other'}}, guides
+        if _get_db_type() != "postgresql":
+            assert len([q for q in queries if q.lstrip().upper().startswith('SELECT')]) == 1, queries
+        print("✓ get_cached_guides: nhiều topic trong 1 truy vấn")
+        print(f"✓ Stats: {study_guide.get_guide_cache_stats()}")
+    finally:
+        os.environ.pop("STUDY_GUIDE_LRU_TTL", None)
+        write_behind.flush(timeout=10)
+        study_guide._guide_lru.pop(topic, None)
+        study_guide._guide_lru.pop(f"{topic}_other", None)
+        with get_conn() as conn:
+            c = conn.cursor()
+            c.execute(f"DELETE FROM study_guide_cache WHERE topic LIKE {ph}", (f"{topic}%",))
+            conn.commit()
+
+    print("\n" + "=" * 60)
+    print("ALL TESTS PASSED ✓")
+    print("=" * 60)
+
+if __name__ == "__main__":
+    test_guide_lru()
@@ -0,0 +1,61 @@
+"""Test parser JSON tăng dần cho Gemini streaming"""
+import json
+from json_stream import IncrementalJSONParser, MalformedJSONError
+
+def _feed_in_chunks(text, size):
+    parser = IncrementalJSONParser()
+    seen = []
+    for i in range(0, len(text), size):
+        seen.extend(parser.feed(text[i:i + size]))
+    return parser, seen
+
+def test_json_stream():
+    print("=" * 60)
+    print("INCREMENTAL JSON PARSER TEST")
+    print("=" * 60)
+    
+    question = {
+        "question": "Giá tăng từ 80 lên 100, tăng bao nhiêu %? Ký tự lạ: \\\"}{][,",
+        "options": ["A. 20%", "B. 25%", "C. 30%", "D. 35%"],
+        "step_by_step_thinking": "Bước 1: (100-80)/80 = 0.25\nBước 2: 25%",
+        "correct_answer": "B. 25%",
+        "explanation": "Tăng 25%",
+        "meta": {"nested": [1, {"a": "}"}], "n": 3.5, "ok": True, "none": None}
+    }
+    text = "```json\n" + json.dumps(question, ensure_ascii=False, indent=2) + "\n```"
+    
+    # 1. Mọi cách chia chunk đều ra cùng kết quả, field theo đúng thứ tự
+    for size in (1, 3, 7, 64, len(text)):
+        parser, seen = _feed_in_chunks(text, size)
+        assert parser.complete and parser.result() == question, f"chunk size {size}"
+        assert [k for k, _ in seen] == list(question.keys())
+    print("✓ Parse đúng với mọi kích thước chunk (1 → toàn bộ)")
+    
+    # 2. Field xuất hiện trước khi response kết thúc
+    cut = text.index('"step_by_step_thinking"')
+    parser = IncrementalJSONParser()
+    early = dict(parser.feed(text[:cut]))
+    assert early['options'] == question['options'] and not parser.complete
+    print(f"✓ Có 'question' + 'options' sau {cut}/{len(text)} ký tự")
+    
+    # 3. Sai cấu trúc -> báo lỗi ngay
+    for bad in ('Xin lỗi, tôi không thể', '{"question" "thiếu dấu hai chấm"}', '{"a": tru, "b": 1}', '{"a": ]'):
+        try:
+            IncrementalJSONParser().feed(bad)
+            assert False, f"Phải báo lỗi: {bad}"
+        except MalformedJSONError:
+            pass
+    print("✓ MalformedJSONError cho response sai cấu trúc")
+    
+    # 4. Dấu ',' thừa và xuống dòng thật trong string vẫn chấp nhận
+    parser = IncrementalJSONParser()
+    parser.feed('{"a": "dòng 1\ndòng 2", "b": [1, 2],\n}')
+    assert parser.result() == {"a": "dòng 1\ndòng 2", "b": [1, 2]}
+    print("✓ Chấp nhận trailing comma + newline trong string")
+    
+    print("\n" + "=" * 60)
+    print("ALL TESTS PASSED ✓")
+    print("=" * 60)
+
+if __name__ == "__main__":
+    test_json_stream()
@@ -0,0 +1,111 @@
+"""Test llm_cache: key ổn định, hit/miss, TTL, dọn cache theo dung lượng (không gọi Gemini thật)
+
+Chạy trên file SQLite tạm: evict_llm_responses xóa theo dung lượng của cả bảng,
+không được chạm vào cache thật của database đang cấu hình.
+"""
+import contextlib
+import os
+import tempfile
+import time
+import db
+import llm_cache
+from db import init_db, put_llm_response, evict_llm_responses
+
+class _FakeResponse:
+    def __init__(self, text):
+        self.text = text
+
+class _FakeModels:
+    def __init__(self):
+        self.calls = 0
+
+    def generate_content(self, model, contents, config=None):
+        self.calls += 1
+        return _FakeResponse(f'{{"n": {self.calls}}}')
+
+class _FakeClient:
+    def __init__(self):
+        self.models = _FakeModels()
+
+@contextlib.contextmanager
+def _temporary_sqlite():
+    """Tạm chuyển module db sang 1 file SQLite mới, xong thì trả lại backend cũ"""
+    saved = (db._db_type, db._db_path, db._sqlite_conn, set(db._schema_ready))
+    fd, path = tempfile.mkstemp(suffix=".db")
+    os.close(fd)
+    with db._sqlite_lock:
+        db._db_type, db._db_path, db._sqlite_conn = "sqlite", path, None
+        db._schema_ready.discard("sqlite")
+    try:
+        yield
+    finally:
+        with db._sqlite_lock:
+            if db._sqlite_conn is not None:
+                db._sqlite_conn.close()
+            db._db_type, db._db_path, db._sqlite_conn = saved[:3]
+            db._schema_ready.clear()
+            db._schema_ready.update(saved[3])
+        for suffix in ("", "-wal", "-shm"):
+            with contextlib.suppress(FileNotFoundError):
+                os.remove(path + suffix)
+
+def test_llm_cache():
+    print("=" * 60)
+    print("LLM RESPONSE CACHE TEST")
+    print("=" * 60)
+
+    marker = f"__LLM_CACHE_TEST_{int(time.time() * 1000)}__"
+
+    with _temporary_sqlite():
+        init_db()
+        # 1. Key: http_options (timeout) không ảnh hưởng, temperature/model thì có
+        config = {'temperature': 0.9, 'response_mime_type': 'application/json'}
+        key = llm_cache.cache_key('gemini-2.5-pro', marker, config)
+        assert key == llm_cache.cache_key('gemini-2.5-pro', marker, {**config, 'http_options': {'timeout': 5000}})
+        assert key != llm_cache.cache_key('gemini-2.5-pro', marker, {**config, 'temperature': 0.2})
+        assert key != llm_cache.cache_key('gemini-2.5-flash', marker, config)
+        print("✓ Cache key chỉ phụ thuộc model, prompt và generation config")
+
+        # 2. Lần 2 lấy từ cache, use_cache=False gọi lại API và ghi đè
+        client = _FakeClient()
+        first = llm_cache.generate_content(client, model='gemini-2.5-pro', contents=marker, config=config)
+        second = llm_cache.generate_content(client, model='gemini-2.5-pro', contents=marker, config=config)
+        assert client.models.calls == 1 and second.text == first.text and second.from_cache
+        third = llm_cache.generate_content(client, model='gemini-2.5-pro', contents=marker, config=config, use_cache=False)
+        assert client.models.calls == 2 and llm_cache.get(key) == third.text
+        assert db.get_llm_cache_stats()['hits'] == 2, "Mỗi lần hit tăng bộ đếm trong cùng câu UPDATE"
+        print("✓ Hit không gọi API; use_cache=False ghi đè entry cũ")
+
+        # 3. cache=False (sinh câu biến thể) -> luôn gọi API, không ghi entry
+        calls = client.models.calls
+        fresh = f"{marker}_variant"
+        for _ in range(2):
+            llm_cache.generate_content(client, model='gemini-2.5-pro', contents=fresh, config=config, cache=False)
+        assert client.models.calls == calls + 2
+        assert llm_cache.get(llm_cache.cache_key('gemini-2.5-pro', fresh, config)) is None
+        print("✓ cache=False không đọc/ghi cache")
+
+        # 4. Hết TTL -> miss
+        put_llm_response(f"{marker}_ttl", 'gemini-2.5-pro', '{}', ttl_seconds=-1)
+        assert llm_cache.get(f"{marker}_ttl") is None
+        print("✓ Entry hết hạn không được trả về")
+
+        # 5. Vượt dung lượng -> xóa entry ít dùng nhất
+        put_llm_response(f"{marker}_old", 'gemini-2.5-pro', 'x' * 1000, ttl_seconds=3600)
+        time.sleep(0.01)
+        put_llm_response(f"{marker}_new", 'gemini-2.5-pro', 'y' * 1000, ttl_seconds=3600)
+        evict_llm_responses(max_bytes=1500)
+        assert llm_cache.get(f"{marker}_old") is None
+        assert llm_cache.get(f"{marker}_new") is not None
+        print("✓ Dọn cache giữ lại entry mới dùng gần nhất")
+
+        stats = llm_cache.get_stats()
+        print(f"✓ Stats: {stats}")
+        assert stats['hits'] >= 2 and stats['misses'] >= 1
+
+    print("\n" + "=" * 60)
+    print("ALL TESTS PASSED ✓")
+    print("=" * 60)
+
+if __name__ == "__main__":
+    test_llm_cache()
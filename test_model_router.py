@@ -0,0 +1,60 @@
+"""Test chọn model theo việc + thống kê latency/tỉ lệ thành công (không gọi Gemini thật)"""
+import os
+import time
+import model_router
+from model_router import choose_model, fast_model, pro_model, track
+
+def test_model_router():
+    print("=" * 60)
+    print("MODEL ROUTER TEST")
+    print("=" * 60)
+    model_router.reset_stats()
+
+    # 1. Câu thường -> model nhanh; việc khó / lần thử lại -> pro
+    assert choose_model('variant', 'math', 'Percentages') == fast_model()
+    assert choose_model('variant', 'data_sufficiency', 'Algebra') == pro_model()
+    assert choose_model('variant', 'math', 'Percentages', attempt=2) == pro_model()
+    assert choose_model('study_guide') == pro_model()
+    print(f"✓ variant -> {fast_model()}, data_sufficiency/retry/study_guide -> {pro_model()}")
+
+    # 2. Thất bại được ghi nhận, model nhanh tệ quá thì chuyển hẳn sang pro
+    for _ in range(10):
+        try:
+            with track(fast_model(), 'test_task'):
+                raise ValueError("Correct answer does not align with options")
+        except ValueError:
+            pass
+    with track(fast_model(), 'test_task') as outcome:
+        outcome['ok'], outcome['total'] = 3, 5
+    stats = model_router.get_stats()[f"{fast_model()}/test_task"]
+    assert stats['requests'] == 11 and stats['calls'] == 15 and stats['success_rate'] == 0.2
+    assert choose_model('test_task') == pro_model()
+    print(f"✓ Stats: {stats} -> chuyển sang {pro_model()}")
+
+    # 3. Lỗi mạng/API (500, timeout) không tính là model trả lời sai
+    for _ in range(12):
+        try:
+            with track(fast_model(), 'transport_task'):
+                raise ConnectionError("500 INTERNAL")
+        except ConnectionError:
+            pass
+    stats = model_router.get_stats()[f"{fast_model()}/transport_task"]
+    assert stats['requests'] == 12 and stats['errors'] == 12 and stats['calls'] == 0
+    assert choose_model('transport_task') == fast_model()
+    print("✓ Lỗi API chỉ được đếm riêng, vẫn dùng model nhanh")
+
+    # 4. Chỉ xét kết quả trong cửa sổ: hết cửa sổ thì thử lại model nhanh
+    os.environ["GEMINI_FAST_WINDOW_SECONDS"] = "1"
+    try:
+        time.sleep(1.1)
+        assert choose_model('test_task') == fast_model()
+    finally:
+        os.environ.pop("GEMINI_FAST_WINDOW_SECONDS", None)
+    print("✓ Thất bại cũ hết cửa sổ -> quay lại model nhanh")
+
+    print("\n" + "=" * 60)
+    print("ALL TESTS PASSED ✓")
+    print("=" * 60)
+
+if __name__ == "__main__":
+    test_model_router()
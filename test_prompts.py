@@ -0,0 +1,45 @@
+"""Test PromptTemplate + ngân sách token (không gọi Gemini thật)"""
+from prompts import PromptTemplate, fit_items, get_stats
+from rate_limiter import estimate_tokens
+
+def test_prompts():
+    print("=" * 60)
+    print("PROMPT TEMPLATE TEST")
+    print("=" * 60)
+
+    # 1. Bỏ thụt lề, giữ {{ }} và format spec
+    template = PromptTemplate('test_template', """
+        Chủ đề: {topic}
+        Độ chính xác: {accuracy:.0f}%
+        {{"question": "..."}}
+        """)
+    prompt = template.render(topic='Ratios', accuracy=66.6)
+    assert prompt == 'Chủ đề: Ratios\nĐộ chính xác: 67%\n{"question": "..."}', prompt
+    assert template.fields == ('topic', 'accuracy')
+    try:
+        template.render(topic='Ratios')
+        assert False, "Thiếu field phải báo lỗi"
+    except KeyError:
+        pass
+    print("✓ Template render đúng, thiếu field thì báo lỗi")
+
+    # 2. fit_items: cắt field dài, vẫn quá thì bỏ bớt phần tử
+    items = [{'question': 'q' * 2000, 'explanation': 'e' * 2000, 'user_choice': 'A. 1'} for _ in range(10)]
+    text = fit_items(items, 1000, {'question': 800, 'explanation': 500})
+    assert estimate_tokens(text) <= 1000 and text.count('"user_choice":"A. 1"') == 10
+    tight = fit_items(items, 150, {'question': 800, 'explanation': 500})
+    assert estimate_tokens(tight) <= 150 and 'mục khác đã lược bớt' in tight
+    small = fit_items(items[:1], 10000, {'question': 800})
+    assert len(small) < 3000
+    print(f"✓ fit_items: {estimate_tokens(text)}/1000 và {estimate_tokens(tight)}/150 tokens")
+
+    stats = get_stats()['test_template']
+    assert stats['calls'] == 1 and stats['tokens_max'] > 0
+    print(f"✓ Stats: {stats}")
+
+    print("\n" + "=" * 60)
+    print("ALL TESTS PASSED ✓")
+    print("=" * 60)
+
+if __name__ == "__main__":
+    test_prompts()
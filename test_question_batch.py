@@ -0,0 +1,97 @@
+"""Test generate_question_batch: đủ câu thì hủy phần dư, nhóm chỉ gửi lại câu gốc bị lỗi (không gọi Gemini thật)"""
+import asyncio
+import json
+import os
+import re
+import time
+from unittest import mock
+
+import ai_logic
+import model_router
+import rate_limiter
+from rate_limiter import RateLimiter
+
+class _FakeResponse:
+    def __init__(self, text):
+        self.text = text
+        self.usage_metadata = None
+
+def _question(text, correct='A. 1'):
+    return {'question': text, 'options': ['A. 1', 'B. 2', 'C. 3', 'D. 4'], 'correct_answer': correct,
+            'explanation': 'e', 'step_by_step_thinking': 'Bước 1: ...'}
+
+class _FakeModels:
+    """Câu gốc có 'slow' trong nội dung chờ lâu; ghi lại prompt và request bị hủy"""
+
+    def __init__(self):
+        self.prompts = []
+        self.cancelled = 0
+        self.bad_first = set()  # seed_index trả đáp án lệch ở request nhóm đầu tiên
+
+    async def generate_content(self, model, contents, config=None):
+        self.prompts.append(contents)
+        try:
+            await asyncio.sleep(3 if 'slow' in contents else 0.05)
+        except asyncio.CancelledError:
+            self.cancelled += 1
+            raise
+        match = re.search(r"Dưới đây là (\d+) câu mẫu", contents)
+        if not match:
+            return _FakeResponse(json.dumps(_question(f"Q {len(self.prompts)}")))
+        items = []
+        for i in range(int(match.group(1))):
+            bad = len(self.prompts) == 1 and i in self.bad_first
+            items.append({'seed_index': i, **_question(f"G {len(self.prompts)}.{i}", 'Z. 9' if bad else 'A. 1')})
+        return _FakeResponse(json.dumps(items))
+
+class _FakeClient:
+    def __init__(self):
+        self.aio = type('Aio', (), {})()
+        self.aio.models = _FakeModels()
+
+def _seed(content, topic):
+    return {'content': content, 'topic': topic, 'type': 'math'}
+
+@mock.patch.dict(os.environ, {"GEMINI_STREAMING": "0"})
+@mock.patch.dict(rate_limiter._limiters, {"gemini": RateLimiter("gemini", rpm=1000)})
+def test_question_batch():
+    print("=" * 60)
+    print("QUESTION BATCH TEST")
+    print("=" * 60)
+
+    model_router.reset_stats()
+    client = _FakeClient()
+    original = ai_logic._get_model
+    ai_logic._get_model = lambda: client
+    try:
+        # 1. 8 câu gốc, cần 5: 5 câu nhanh xong thì 3 câu chậm bị hủy ngay, không chờ hết
+        seeds = [_seed(f"fast {i}", f"T{i}") for i in range(5)] + [_seed(f"slow {i}", f"S{i}") for i in range(3)]
+        start = time.time()
+        result = ai_logic.generate_question_batch(seeds, num_questions=5, concurrency=8, batch_size=1)
+        elapsed = time.time() - start
+        time.sleep(0.2)
+        assert len(result) == 5, len(result)
+        assert elapsed < 2, f"Phải hủy câu dư thay vì chờ: {elapsed:.1f}s"
+        assert client.aio.models.cancelled == 3, client.aio.models.cancelled
+        print(f"✓ Đủ 5/8 câu sau {elapsed:.2f}s, hủy {client.aio.models.cancelled} request còn lại")
+
+        # 2. Nhóm 3 câu cùng topic: câu [1] sai đáp án -> lần 2 chỉ gửi lại đúng câu đó
+        client.aio.models.prompts.clear()
+        client.aio.models.bad_first = {1}
+        seeds = [_seed(f"group {i}", "Ratios") for i in range(3)]
+        result = ai_logic.generate_question_batch(seeds, concurrency=1, batch_size=3)
+        prompts = client.aio.models.prompts
+        assert len(result) == 3, result
+        assert len(prompts) == 2, len(prompts)
+        assert "Dưới đây là 1 câu mẫu" in prompts[1] and "group 1" in prompts[1]
+        assert "group 0" not in prompts[1] and "group 2" not in prompts[1]
+        print("✓ Request nhóm thứ 2 chỉ chứa câu gốc bị lỗi")
+    finally:
+        ai_logic._get_model = original
+
+    print("\n" + "=" * 60)
+    print("ALL TESTS PASSED ✓")
+    print("=" * 60)
+
+if __name__ == "__main__":
+    test_question_batch()
@@ -0,0 +1,179 @@
+"""Test token bucket rate limiter (không gọi Gemini thật)"""
+import asyncio
+import threading
+import time
+import db
+from rate_limiter import (RateLimiter, RateLimitTimeout, rate_limited_call, retry_after_seconds,
+                          is_rate_limit_error, background_priority)
+
+class _FakeRateLimitError(Exception):
+    code = 429
+
+def test_rate_limiter():
+    print("=" * 60)
+    print("RATE LIMITER TEST")
+    print("=" * 60)
+    
+    # 1. Burst tới capacity, sau đó chờ theo tốc độ hồi
+    limiter = RateLimiter("test_burst", rpm=60)
+    start = time.time()
+    for _ in range(60):
+        limiter.acquire()
+    assert time.time() - start < 0.5, "Burst đầu tiên không được chờ"
+    start = time.time()
+    limiter.acquire()
+    waited = time.time() - start
+    print(f"✓ Request thứ 61 chờ {waited:.2f}s (kỳ vọng ~1s)")
+    assert 0.8 <= waited <= 1.5
+    
+    # 2. Nhiều thread dùng chung 1 limiter
+    limiter = RateLimiter("test_threads", rpm=600)
+    for _ in range(600):
+        limiter.acquire()
+    start = time.time()
+    threads = [threading.Thread(target=limiter.acquire) for _ in range(10)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    waited = time.time() - start
+    print(f"✓ 10 thread chờ tổng {waited:.2f}s (kỳ vọng ~1s ở 600 RPM)")
+    assert 0.8 <= waited <= 1.5
+    
+    # 3. Timeout
+    limiter = RateLimiter("test_timeout", rpm=1)
+    limiter.acquire()
+    try:
+        limiter.acquire(timeout=0.1)
+        assert False, "Phải báo RateLimitTimeout"
+    except RateLimitTimeout:
+        print("✓ RateLimitTimeout khi không kịp lấy lượt")
+    
+    # 4. Retry-After được tôn trọng
+    assert retry_after_seconds(Exception("Please retry in 27.5s.")) == 27.5
+    assert retry_after_seconds(Exception("{'retryDelay': '12s'}")) == 12.0
+    calls = {'n': 0}
+    
+    def flaky():
+        calls['n'] += 1
+        if calls['n'] == 1:
+            raise _FakeRateLimitError("429 RESOURCE_EXHAUSTED {'retryDelay': '1s'}")
+        return "ok"
+    
+    start = time.time()
+    assert rate_limited_call(flaky, limiter=RateLimiter("test_429", rpm=100)) == "ok"
+    waited = time.time() - start
+    print(f"✓ 429 -> chờ {waited:.2f}s theo Retry-After rồi thử lại")
+    assert waited >= 0.9 and calls['n'] == 2
+    
+    # 5. Async: hủy task đang chờ lượt -> không giữ thread, không trừ lượt
+    async def _cancel_while_waiting():
+        limiter = RateLimiter("test_async_cancel", rpm=60)
+        for _ in range(60):
+            await limiter.acquire_async()
+        threads = threading.active_count()
+        task = asyncio.ensure_future(limiter.acquire_async())
+        await asyncio.sleep(0.2)
+        assert threading.active_count() == threads, "Không được chờ lượt trên thread phụ"
+        task.cancel()
+        try:
+            await task
+        except asyncio.CancelledError:
+            pass
+        acquired = limiter.stats['acquired']
+        await asyncio.sleep(1.0)
+        # Lượt hồi sau ~1s vẫn còn cho request kế tiếp, không bị task đã hủy lấy mất
+        start = time.time()
+        await limiter.acquire_async()
+        assert limiter.stats['acquired'] == acquired + 1
+        return time.time() - start
+
+    waited = asyncio.run(_cancel_while_waiting())
+    print(f"✓ Hủy task đang chờ không tốn lượt (request sau chờ {waited:.2f}s)")
+    assert waited < 0.3
+
+    # 6. timeout là tổng cho cả lần gọi: Retry-After vượt deadline -> RateLimitTimeout ngay, không ngủ
+    calls['n'] = 0
+
+    def always_429():
+        calls['n'] += 1
+        raise _FakeRateLimitError("429 RESOURCE_EXHAUSTED {'retryDelay': '5s'}")
+
+    start = time.time()
+    try:
+        rate_limited_call(always_429, limiter=RateLimiter("test_deadline", rpm=100), timeout=2)
+        assert False, "Phải báo RateLimitTimeout"
+    except RateLimitTimeout:
+        pass
+    assert time.time() - start < 0.5 and calls['n'] == 1
+    print("✓ Retry-After vượt deadline -> RateLimitTimeout, không chờ thêm")
+
+    # 7. Chỉ lỗi 429 thật mới tính là rate limit, không đoán theo chữ trong message
+    assert not is_rate_limit_error(Exception("500 INTERNAL: quota service unavailable"))
+    assert not is_rate_limit_error(Exception("question 429 failed validation"))
+    assert is_rate_limit_error(_FakeRateLimitError("Too many requests"))
+    print("✓ is_rate_limit_error theo code/status")
+
+    # 8. Bucket chung (DB) lỗi -> tạm dùng bucket trong process, hết cooldown thì thử lại DB
+    original = db.take_rate_limit_tokens
+    attempts = {'n': 0}
+
+    def broken_bucket(*args, **kwargs):
+        attempts['n'] += 1
+        raise RuntimeError("connection refused")
+
+    db.take_rate_limit_tokens = broken_bucket
+    try:
+        limiter = RateLimiter("test_shared_retry", rpm=100, shared=True)
+        limiter.acquire()
+        limiter.acquire()
+        assert attempts['n'] == 1 and limiter.shared, "Trong cooldown không gọi lại DB"
+        limiter._shared_retry_at = 0.0  # hết cooldown
+        limiter.acquire()
+        assert attempts['n'] == 2
+    finally:
+        db.take_rate_limit_tokens = original
+    print("✓ Bucket chung lỗi được thử lại sau cooldown")
+
+    # 9. Request nền (exam_pool) không lấy phần lượt để dành, nhường request của user đang chờ
+    limiter = RateLimiter("test_background", rpm=60, background_reserve=5)
+    for _ in range(55):
+        limiter.acquire()
+    with background_priority():
+        try:
+            limiter.acquire(timeout=0.1)
+            assert False, "Request nền không được dùng lượt để dành"
+        except RateLimitTimeout:
+            pass
+    start = time.time()
+    for _ in range(5):
+        limiter.acquire()
+    assert time.time() - start < 0.1, "Request thường dùng ngay lượt để dành"
+
+    order = []
+
+    def background_call():
+        with background_priority():
+            limiter.acquire()
+        order.append('background')
+
+    def user_call():
+        limiter.acquire()
+        order.append('user')
+
+    threads = [threading.Thread(target=background_call)]
+    threads[0].start()
+    time.sleep(0.1)
+    threads.append(threading.Thread(target=user_call))
+    threads[1].start()
+    for t in threads:
+        t.join()
+    assert order == ['user', 'background'], order
+    print("✓ Request nền chừa lượt để dành và nhường request của user đang chờ")
+
+    print("\n" + "=" * 60)
+    print("ALL TESTS PASSED ✓")
+    print("=" * 60)
+
+if __name__ == "__main__":
+    test_rate_limiter()
@@ -0,0 +1,51 @@
+"""Test schema structured output + validator nhanh"""
+from schemas import QUESTION_SCHEMA, QUESTION_GROUP_SCHEMA, TOPIC_GUIDE_SCHEMA, validate
+
+def test_schemas():
+    print("=" * 60)
+    print("SCHEMA VALIDATOR TEST")
+    print("=" * 60)
+    
+    question = {
+        "question": "Giá tăng từ 80 lên 100, tăng bao nhiêu %?",
+        "options": ["A. 20%", "B. 25%", "C. 30%", "D. 35%"],
+        "step_by_step_thinking": "Bước 1: (100-80)/80 = 0.25",
+        "correct_answer": "B. 25%",
+        "explanation": "Tăng 25%"
+    }
+    assert validate(question, QUESTION_SCHEMA) == []
+    print("✓ Câu hỏi hợp lệ")
+    
+    errors = validate({**question, "options": "A. 20%"}, QUESTION_SCHEMA)
+    assert errors == ["$.options: expected ARRAY, got str"], errors
+    errors = validate({k: v for k, v in question.items() if k != "correct_answer"}, QUESTION_SCHEMA)
+    assert errors == ["$.correct_answer: missing"], errors
+    print("✓ Báo lỗi sai kiểu / thiếu trường")
+    
+    group = [{**question, "seed_index": 0}, {**question, "seed_index": True}]
+    errors = validate(group, QUESTION_GROUP_SCHEMA)
+    assert errors == ["$[1].seed_index: expected INTEGER, got bool"], errors
+    print("✓ Mảng câu hỏi: kiểm tra từng phần tử")
+    
+    guide = {
+        "theory": "Lý thuyết...",
+        "detailed_concepts": [{"concept_name": "A", "explanation": "B", "example": "C"}],
+        "step_by_step_method": ["Bước 1"],
+        "mistake_analysis": [],
+        "common_mistakes": ["Lỗi 1"],
+        "tips_for_accuracy": ["Mẹo 1"],
+        "tips_for_speed": [],
+        "practice_drills": [],
+        "key_formulas": []
+    }
+    assert validate(guide, TOPIC_GUIDE_SCHEMA) == []
+    errors = validate({**guide, "detailed_concepts": [{"concept_name": "A"}]}, TOPIC_GUIDE_SCHEMA)
+    assert len(errors) == 2, errors
+    print("✓ Topic guide: kiểm tra object lồng nhau")
+    
+    print("\n" + "=" * 60)
+    print("ALL TESTS PASSED ✓")
+    print("=" * 60)
+
+if __name__ == "__main__":
+    test_schemas()
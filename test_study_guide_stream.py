@@ -0,0 +1,127 @@
+"""Test iter_study_guide: thứ tự yield (không cần AI -> cache -> AI theo thứ tự xong), hủy khi đóng generator"""
+import asyncio
+import json
+import os
+import time
+from unittest import mock
+
+import rate_limiter
+import study_guide
+import write_behind
+from db import init_db, get_conn, _get_db_type
+from rate_limiter import RateLimiter
+
+class _FakeResponse:
+    def __init__(self, text):
+        self.text = text
+        self.usage_metadata = None
+
+class _FakeModels:
+    """Topic có 'slow' trong tên trả lời sau 3s, còn lại sau 0.05s; ghi lại request bị hủy"""
+
+    def __init__(self):
+        self.topics = []
+        self.cancelled = []
+
+    async def generate_content(self, model, contents, config=None):
+        topic = next(t for t in self.known if f"'{t}'" in contents or t in contents)
+        self.topics.append(topic)
+        try:
+            await asyncio.sleep(3 if 'slow' in topic else 0.05)
+        except asyncio.CancelledError:
+            self.cancelled.append(topic)
+            raise
+        return _FakeResponse(json.dumps({
+            'theory': f"Lý thuyết {topic}. " + 'x' * 600,
+            'detailed_concepts': [{'concept_name': 'c', 'explanation': 'y' * 100, 'example': 'e'}] * 3,
+            'step_by_step_method': ['b1', 'b2', 'b3', 'b4'],
+            'common_mistakes': ['m'],
+            'tips_for_accuracy': ['t'],
+            'key_formulas': ['f1', 'f2', 'f3']
+        }, ensure_ascii=False))
+
+class _FakeClient:
+    def __init__(self, topics):
+        self.aio = type('Aio', (), {})()
+        self.aio.models = _FakeModels()
+        self.aio.models.known = topics
+
+def _exam(spec):
+    """spec: [(topic, số câu đúng, số câu sai)] -> (questions, user_answers)"""
+    questions, answers = [], {}
+    for topic, correct, wrong in spec:
+        for i in range(correct + wrong):
+            answers[f"q_{len(questions)}"] = 'A. 1' if i < correct else 'B. 2'
+            questions.append({'topic': topic, 'type': 'math', 'question': f"{topic} {i}",
+                              'options': ['A. 1', 'B. 2'], 'correct_answer': 'A. 1'})
+    return questions, answers
+
+# LLM_CACHE_ENABLED=0: lần chạy thứ 2 phải gọi lại (fake) AI
+@mock.patch.dict(os.environ, {"GEMINI_STREAMING": "0", "LLM_CACHE_ENABLED": "0"})
+@mock.patch.dict(rate_limiter._limiters, {"gemini": RateLimiter("gemini", rpm=1000)})
+def test_study_guide_stream():
+    print("=" * 60)
+    print("STUDY GUIDE STREAM TEST")
+    print("=" * 60)
+
+    init_db()
+    marker = f"__GUIDE_STREAM_{int(time.time() * 1000)}__"
+    perfect, cached, ai_slow, ai_fast = (f"{marker}{name}" for name in ('perfect', 'cached', 'slow', 'fast'))
+    client = _FakeClient([perfect, cached, ai_slow, ai_fast])
+    original = study_guide._get_study_model
+    study_guide._get_study_model = lambda: client
+    try:
+        # 1. Thứ tự: topic làm đúng hết + topic có cache trước, rồi topic AI theo thứ tự xong
+        study_guide._save_guide_to_cache(cached, {'topic': cached, 'theory': 'cached'})
+        questions, answers = _exam([(perfect, 2, 0), (cached, 1, 1), (ai_slow, 0, 3), (ai_fast, 1, 2)])
+        start = time.time()
+        events = list(study_guide.iter_study_guide(questions, answers))
+        order = [event['guide']['topic'] for event in events]
+        assert order[:2] in ([perfect, cached], [cached, perfect]), order
+        assert order[2:] == [ai_fast, ai_slow], order
+        assert [event['completed'] for event in events] == [1, 2, 3, 4]
+        assert all(event['total'] == 4 for event in events)
+        # position theo số câu sai (nhiều nhất trước): slow 3, fast 2, cached 1, perfect 0
+        positions = {event['guide']['topic']: event['position'] for event in events}
+        assert positions == {ai_slow: 0, ai_fast: 1, cached: 2, perfect: 3}, positions
+        assert sorted(client.aio.models.topics) == sorted([ai_slow, ai_fast]), "Topic có cache không gọi AI"
+        assert all('Lý thuyết' in event['guide']['theory'] for event in events[2:]), "Guide AI, không phải fallback"
+        print(f"✓ Thứ tự yield: {[t.replace(marker, '') for t in order]} ({time.time() - start:.1f}s)")
+
+        # 2. Đóng generator giữa chừng (user rời trang) -> hủy topic AI chưa xong
+        client.aio.models.topics.clear()
+        write_behind.flush(timeout=10)  # guide vừa tạo được ghi (và đưa vào LRU) trước khi xóa
+        study_guide._guide_lru.pop(ai_slow, None)
+        study_guide._guide_lru.pop(ai_fast, None)
+        with get_conn() as conn:
+            c = conn.cursor()
+            ph = "%s" if _get_db_type() == "postgresql" else "?"
+            c.execute(f"DELETE FROM study_guide_cache WHERE topic IN ({ph}, {ph})", (ai_slow, ai_fast))
+            conn.commit()
+        questions, answers = _exam([(ai_slow, 0, 3), (ai_fast, 0, 2)])
+        stream = study_guide.iter_study_guide(questions, answers)
+        first = next(stream)
+        assert first['guide']['topic'] == ai_fast
+        stream.close()
+        deadline = time.time() + 2
+        while ai_slow not in client.aio.models.cancelled and time.time() < deadline:
+            time.sleep(0.05)
+        assert client.aio.models.cancelled == [ai_slow], client.aio.models.cancelled
+        print("✓ Đóng generator hủy request AI đang chạy")
+    finally:
+        study_guide._get_study_model = original
+        write_behind.flush(timeout=10)
+        for topic in (perfect, cached, ai_slow, ai_fast):
+            study_guide._guide_lru.pop(topic, None)
+        with get_conn() as conn:
+            c = conn.cursor()
+            ph = "%s" if _get_db_type() == "postgresql" else "?"
+            c.execute(f"DELETE FROM study_guide_cache WHERE topic LIKE {ph}", (f"{marker}%",))
+            conn.commit()
+
+    print("\n" + "=" * 60)
+    print("ALL TESTS PASSED ✓")
+    print("=" * 60)
+
+if __name__ == "__main__":
+    test_study_guide_stream()
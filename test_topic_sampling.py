@@ -0,0 +1,61 @@
+"""Test get_cached_questions_by_topics: chia quota theo trọng số topic, lấy bù khi topic thiếu câu"""
+import time
+from db import (init_db, save_questions, get_conn, question_fingerprint, _get_db_type,
+                _allocate_quotas, get_cached_questions_by_topics)
+
+def test_topic_sampling():
+    print("=" * 60)
+    print("WEIGHTED TOPIC SAMPLING TEST")
+    print("=" * 60)
+
+    # 1. Largest remainder: tổng quota đúng bằng total, trọng số 0 bị bỏ
+    assert _allocate_quotas({'a': 0.45, 'b': 0.3, 'c': 0.25}, 21) == {'a': 10, 'b': 6, 'c': 5}
+    assert sum(_allocate_quotas({'a': 1, 'b': 1, 'c': 1}, 10).values()) == 10
+    assert _allocate_quotas({'a': 1, 'b': 0}, 3) == {'a': 3}
+    assert _allocate_quotas({}, 5) == {} and _allocate_quotas({'a': 1}, 0) == {}
+    print("✓ _allocate_quotas chia đúng tổng theo trọng số")
+
+    init_db()
+    marker = f"__TOPIC_SAMPLING_{int(time.time() * 1000)}__"
+    weak, other, small = f"{marker}weak", f"{marker}other", f"{marker}small"
+    questions = [
+        {'question': f"{marker} {topic} {i}", 'options': ['A. 1', 'B. 2'], 'correct_answer': 'A. 1',
+         'explanation': 'Test', 'topic': topic, 'type': 'math'}
+        for topic, n in ((weak, 20), (other, 20), (small, 2))
+        for i in range(n)
+    ]
+    try:
+        save_questions(questions)
+
+        # 2. Mỗi topic đủ câu -> lấy đúng quota, không trùng câu
+        picked = get_cached_questions_by_topics({weak: 0.7, other: 0.3}, 10)
+        counts = {t: sum(1 for q in picked if q['topic'] == t) for t in (weak, other)}
+        assert counts == {weak: 7, other: 3}, counts
+        assert len({q['question'] for q in picked}) == 10
+        print(f"✓ Quota theo trọng số: {counts[weak]} câu topic yếu + {counts[other]} câu topic khác")
+
+        # 3. Topic thiếu câu -> lấy hết câu của topic đó, phần thiếu bù từ topic khác
+        picked = get_cached_questions_by_topics({small: 1.0}, 6)
+        assert len(picked) == 6
+        assert sum(1 for q in picked if q['topic'] == small) == 2
+        print("✓ Topic thiếu câu được bù từ ngân hàng đề")
+
+        # 4. exclude_hashes: câu đã có trong đề không bị lấy lại
+        exclude = {question_fingerprint(q) for q in questions if q['topic'] == weak}
+        picked = get_cached_questions_by_topics({weak: 0.5, other: 0.5}, 10, exclude_hashes=exclude)
+        assert len(picked) == 10 and not any(question_fingerprint(q) in exclude for q in picked)
+        assert sum(1 for q in picked if q['topic'] == other) >= 5
+        print("✓ Câu trong exclude_hashes bị loại, quota chuyển sang câu khác")
+    finally:
+        ph = "%s" if _get_db_type() == "postgresql" else "?"
+        with get_conn() as conn:
+            c = conn.cursor()
+            c.execute(f"DELETE FROM questions WHERE question LIKE {ph}", (f"{marker}%",))
+            conn.commit()
+
+    print("\n" + "=" * 60)
+    print("ALL TESTS PASSED ✓")
+    print("=" * 60)
+
+if __name__ == "__main__":
+    test_topic_sampling()
@@ -0,0 +1,64 @@
+"""Test hàng đợi ghi nền: gộp lô theo key, thử lại lỗi tạm thời, flush/drain"""
+import sqlite3
+import threading
+import write_behind
+
+def test_write_behind():
+    print("=" * 60)
+    print("WRITE-BEHIND QUEUE TEST")
+    print("=" * 60)
+
+    calls = []
+    script_thread = threading.current_thread()
+
+    def handler(key, items):
+        assert threading.current_thread() is not script_thread, "Phải ghi trên thread nền"
+        calls.append((key, list(items)))
+
+    write_behind.register('test_batch', handler)
+
+    # 1. Nhiều lệnh cùng key -> 1 lần gọi handler
+    for i in range(5):
+        write_behind.submit('test_batch', i, key='user_a')
+    write_behind.submit('test_batch', 99, key='user_b')
+    assert write_behind.flush(timeout=5)
+    assert sorted(calls) == [('user_a', [0, 1, 2, 3, 4]), ('user_b', [99])], calls
+    print(f"✓ 6 lệnh ghi -> {len(calls)} lần gọi handler")
+
+    # 2. Lỗi tạm thời (database locked) -> thử lại
+    attempts = {'n': 0}
+
+    def flaky(key, items):
+        attempts['n'] += 1
+        if attempts['n'] < 3:
+            raise sqlite3.OperationalError("database is locked")
+
+    write_behind.register('test_flaky', flaky)
+    write_behind.submit('test_flaky', 'x')
+    assert write_behind.flush(timeout=10)
+    assert attempts['n'] == 3
+    print("✓ Lỗi tạm thời được thử lại tới khi ghi thành công")
+
+    # 3. Lỗi không tạm thời -> bỏ lô, không chặn các lô khác
+    def broken(key, items):
+        raise ValueError("bad payload")
+
+    write_behind.register('test_broken', broken)
+    dropped = write_behind.get_stats()['dropped']
+    write_behind.submit('test_broken', 'y')
+    assert write_behind.flush(timeout=5)
+    assert write_behind.get_stats()['dropped'] == dropped + 1
+    print(f"✓ Stats: {write_behind.get_stats()}")
+
+    # 4. drain khi tắt process ghi nốt hàng đợi
+    write_behind.submit('test_batch', 'last', key='user_c')
+    write_behind.drain(timeout=5)
+    assert ('user_c', ['last']) in calls
+    print("✓ drain() ghi nốt lệnh còn lại")
+
+    print("\n" + "=" * 60)
+    print("ALL TESTS PASSED ✓")
+    print("=" * 60)
+
+if __name__ == "__main__":
+    test_write_behind()
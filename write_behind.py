@@ -0,0 +1,197 @@
+"""Hàng đợi ghi DB chạy nền (write-behind) cho các lệnh ghi không quan trọng
+
+Script Streamlit chỉ đưa việc ghi vào hàng đợi rồi chạy tiếp; 1 thread nền gom
+các lệnh ghi cùng loại lại và ghi theo lô khi đủ WRITE_BEHIND_BATCH_SIZE lệnh
+hoặc sau WRITE_BEHIND_FLUSH_SECONDS giây. Lỗi tạm thời (mất kết nối, database
+locked) được thử lại với backoff; khi tắt process, hàng đợi được ghi nốt.
+
+Mỗi loại ghi đăng ký 1 handler(key, items): các lệnh cùng (kind, key) trong 1 lô
+được gộp thành 1 lần gọi handler (vd. mọi câu sai của cùng 1 user).
+
+Cấu hình (env hoặc Streamlit secrets):
+- WRITE_BEHIND_ENABLED: "0" để ghi đồng bộ như trước
+- WRITE_BEHIND_FLUSH_SECONDS: chu kỳ ghi, mặc định 2
+- WRITE_BEHIND_BATCH_SIZE: số lệnh chờ tối đa trước khi ghi ngay, mặc định 50
+- WRITE_BEHIND_MAX_RETRIES: số lần thử lại khi lỗi tạm thời, mặc định 3
+"""
+import atexit
+import sqlite3
+import threading
+import time
+from typing import Any, Callable, Dict, Hashable, List, Optional
+
+from db import (
+    PSYCOPG2_AVAILABLE,
+    _get_config,
+    _get_int_config,
+    save_questions as _db_save_questions,
+    save_wrong_answers_bulk,
+)
+
+if PSYCOPG2_AVAILABLE:
+    import psycopg2
+
+_handlers: Dict[str, Callable[[Optional[Hashable], List[Any]], None]] = {}
+_pending: Dict[tuple, List[Any]] = {}  # (kind, key) -> items, giữ thứ tự submit
+_pending_count = 0
+_cond = threading.Condition()
+_flush_requested = False
+_in_flight = 0  # số lô worker đang ghi (flush() chờ cả phần này)
+_worker: Optional[threading.Thread] = None
+_stop = threading.Event()
+_stats = {'submitted': 0, 'written': 0, 'batches': 0, 'retries': 0, 'dropped': 0}
+
+def enabled() -> bool:
+    return str(_get_config("WRITE_BEHIND_ENABLED", "1")).lower() not in ("0", "false", "no")
+
+def _count(name: str, amount: int = 1):
+    with _cond:
+        _stats[name] += amount
+
+def register(kind: str, handler: Callable[[Optional[Hashable], List[Any]], None]) -> None:
+    """Đăng ký handler(key, items) cho 1 loại ghi - handler raise khi lỗi để được thử lại"""
+    _handlers[kind] = handler
+
+def _is_transient(exc: Exception) -> bool:
+    if PSYCOPG2_AVAILABLE and isinstance(exc, (psycopg2.OperationalError, psycopg2.InterfaceError)):
+        return True
+    # SQLite: "database is locked" khi nhiều thread cùng ghi
+    return isinstance(exc, sqlite3.OperationalError) and 'locked' in str(exc).lower()
+
+def _write(kind: str, key: Optional[Hashable], items: List[Any]) -> bool:
+    """Gọi handler, thử lại lỗi tạm thời; trả về False nếu phải bỏ lô này"""
+    max_retries = max(0, _get_int_config("WRITE_BEHIND_MAX_RETRIES", 3))
+    for attempt in range(max_retries + 1):
+        try:
+            _handlers[kind](key, items)
+            return True
+        except Exception as e:
+            if attempt < max_retries and _is_transient(e):
+                _count('retries')
+                delay = 0.5 * 2 ** attempt
+                print(f"⚠️ [write_behind] {kind}: lỗi tạm thời, thử lại sau {delay:.1f}s ({e})")
+                time.sleep(delay)
+                continue
+            print(f"❌ [write_behind] {kind}: bỏ {len(items)} lệnh ghi ({e!r})")
+            return False
+    return False
+
+def submit(kind: str, item: Any, key: Optional[Hashable] = None) -> None:
+    """Đưa 1 lệnh ghi vào hàng đợi (WRITE_BEHIND_ENABLED=0 thì ghi luôn)"""
+    global _pending_count
+    if kind not in _handlers:
+        raise KeyError(f"write_behind: chưa đăng ký handler cho '{kind}'")
+    _count('submitted')
+    if not enabled():
+        _count('written' if _write(kind, key, [item]) else 'dropped')
+        return
+    _ensure_worker()
+    with _cond:
+        _pending.setdefault((kind, key), []).append(item)
+        _pending_count += 1
+        if _pending_count >= max(1, _get_int_config("WRITE_BEHIND_BATCH_SIZE", 50)):
+            _cond.notify_all()
+
+def _take_batch() -> Dict[tuple, List[Any]]:
+    global _pending, _pending_count, _flush_requested, _in_flight
+    batch, _pending, _pending_count = _pending, {}, 0
+    _flush_requested = False
+    _in_flight += 1
+    return batch
+
+def _write_batch(batch: Dict[tuple, List[Any]]) -> None:
+    global _in_flight
+    try:
+        for (kind, key), items in batch.items():
+            _count('written' if _write(kind, key, items) else 'dropped', len(items))
+        if batch:
+            _count('batches')
+    finally:
+        with _cond:
+            _in_flight -= 1
+            _cond.notify_all()
+
+def _worker_loop():
+    while True:
+        interval = max(0.1, float(_get_int_config("WRITE_BEHIND_FLUSH_SECONDS", 2)))
+        batch_size = max(1, _get_int_config("WRITE_BEHIND_BATCH_SIZE", 50))
+        with _cond:
+            _cond.wait_for(
+                lambda: _stop.is_set() or _flush_requested or _pending_count >= batch_size,
+                timeout=interval
+            )
+            batch = _take_batch()
+        _write_batch(batch)
+        if _stop.is_set():
+            with _cond:
+                if not _pending:
+                    return
+
+def _ensure_worker():
+    global _worker
+    with _cond:
+        if _worker is not None and _worker.is_alive():
+            return
+        _stop.clear()
+        _worker = threading.Thread(target=_worker_loop, name="db-write-behind", daemon=True)
+        _worker.start()
+
+def flush(timeout: Optional[float] = 10.0) -> bool:
+    """Ghi ngay mọi lệnh đang chờ; trả về True nếu hàng đợi đã trống trước timeout"""
+    global _flush_requested
+    if _worker is None or not _worker.is_alive():
+        # Không có worker (chưa submit hoặc đã tắt) -> ghi trên thread hiện tại
+        with _cond:
+            batch = _take_batch()
+        _write_batch(batch)
+        return True
+    with _cond:
+        _flush_requested = True
+        _cond.notify_all()
+        return _cond.wait_for(lambda: not _pending and _in_flight == 0, timeout=timeout)
+
+def drain(timeout: float = 10.0) -> None:
+    """Ghi nốt hàng đợi rồi dừng worker (gọi khi tắt process)"""
+    if _worker is None:
+        return
+    pending = _pending_count
+    _stop.set()
+    with _cond:
+        _cond.notify_all()
+    _worker.join(timeout)
+    if _worker.is_alive():
+        print(f"⚠️ [write_behind] Hết {timeout:.0f}s mà chưa ghi xong hàng đợi")
+    elif pending:
+        print(f"💾 [write_behind] Đã ghi nốt {pending} lệnh trước khi tắt")
+
+# Chạy trước db.close_pool (atexit chạy ngược thứ tự đăng ký, db được import trước)
+atexit.register(drain)
+
+def get_stats() -> Dict[str, int]:
+    with _cond:
+        stats = dict(_stats)
+        stats['pending'] = _pending_count
+    return stats
+
+# --- Các loại ghi dùng chung ---
+
+def _write_questions(key, batches: List[List[Dict[str, Any]]]) -> None:
+    questions = [q for batch in batches for q in batch]
+    saved = _db_save_questions(questions)
+    print(f"💾 [write_behind] Đã lưu {saved}/{len(questions)} câu mới vào DB")
+
+def _write_wrong_answers(user_id, batches: List[List[Dict[str, Any]]]) -> None:
+    save_wrong_answers_bulk(user_id, [item for batch in batches for item in batch])
+
+register('questions', _write_questions)
+register('wrong_answers', _write_wrong_answers)
+
+def save_questions(questions: List[Dict[str, Any]]) -> None:
+    """db.save_questions qua hàng đợi (các lô cùng chu kỳ gộp thành 1 transaction)"""
+    if questions:
+        submit('questions', list(questions))
+
+def save_wrong_answers(user_id: str, items: List[Dict[str, Any]]) -> None:
+    """db.save_wrong_answers_bulk qua hàng đợi (gộp theo user)"""
+    if user_id and items:
+        submit('wrong_answers', list(items), key=user_id)